@@ -1,32 +1,40 @@
 import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
+from logging.handlers import RotatingFileHandler
 import os
 from flask import Flask, request, current_app
-from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
 from flask_login import LoginManager
-from flask_cognito_auth import CognitoAuthManager
 from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from elasticsearch import Elasticsearch
-from redis import Redis
-import rq
+from redis import BlockingConnectionPool
 from config import Config
 from werkzeug.middleware.proxy_fix import ProxyFix
-
-db = SQLAlchemy()
-migrate = Migrate()
+from werkzeug.utils import cached_property
+from app.replicas import RoutingSQLAlchemy
+from app.instrumentation import SQLInstrumentation
+from app.metrics import Metrics, TimedRedis, timed_transport
+from app.profiling import ProfilingMiddleware
+from app.logs import DedupSMTPHandler, JSONFormatter, start_queue_logging
+from app.cache import Cache
+from app.followgraph import FollowGraph
+from app.recent import RecentPosts
+
+db = RoutingSQLAlchemy()
 login = LoginManager()
 login.login_message = _l('Please log in to access this page.')
 mail = Mail()
 bootstrap = Bootstrap()
 moment = Moment()
 babel = Babel()
+sql_instrumentation = SQLInstrumentation()
+metrics_registry = Metrics()
+cache = Cache()
+follow_graph = FollowGraph()
+recent_posts = RecentPosts()
 
 
-def get_redis_client(url, password=None):
+def redis_url(url, password=None):
     # redis.Redis.from_url() doesn't support passing the password separately
     # Author: Owen Taylor
     # Source: https://github.com/andymccurdy/redis-py/issues/1347
@@ -39,35 +47,88 @@ def get_redis_client(url, password=None):
             netloc += f':{parts.port}'
 
         url = urlunparse((parts.scheme, netloc, parts.path, parts.params, parts.query, parts.fragment))
-
-    return Redis.from_url(url, decode_components=True)
+    return url
+
+
+def get_redis_client(url, password=None, max_connections=50):
+    # requests wait for a free connection instead of failing
+    pool = BlockingConnectionPool.from_url(
+        redis_url(url, password), max_connections=max_connections)
+    return TimedRedis(connection_pool=pool)
+
+
+class Microblog(Flask):
+    """The application, with clients for external services.
+
+    Clients are created on first use, so that starting a process (a web
+    worker, an RQ job or a CLI command) doesn't pay for the ones it never
+    uses, and so that processes forked from a preloaded application each
+    open their own connections.
+    """
+    @cached_property
+    def elasticsearch(self):
+        if not self.config['ELASTICSEARCH_URL']:
+            return None
+        from elasticsearch import Elasticsearch
+        return Elasticsearch([self.config['ELASTICSEARCH_URL']],
+                             http_auth=(self.config['ELASTICSEARCH_USER'],
+                                        self.config['ELASTICSEARCH_PSW']),
+                             transport_class=timed_transport(),
+                             maxsize=self.config['REQUEST_CONCURRENCY'])
+
+    @cached_property
+    def redis(self):
+        return get_redis_client(self.config['REDIS_URL'],
+                                self.config['REDIS_PSW'],
+                                self.config['REDIS_MAX_CONNECTIONS'])
+
+    @cached_property
+    def http(self):
+        """Session for calls to HTTP services, which reuses connections."""
+        import requests
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=self.config['REQUEST_CONCURRENCY'])
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    @cached_property
+    def task_queue(self):
+        import rq
+        return rq.Queue('microblog-tasks', connection=self.redis)
 
 
 def create_app(config_class=Config):
-    app = Flask(__name__)
+    app = Microblog(__name__)
     app.config.from_object(config_class)
     # tell Flask it is running behind a reverse proxy, so it can set response headers accordingly
     app.wsgi_app = ProxyFix(app.wsgi_app)
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app, app)
 
     db.init_app(app)
-    migrate.init_app(app, db)
+    if os.environ.get('FLASK_RUN_FROM_CLI') == 'true':
+        # only the flask command needs Flask-Migrate, which imports alembic
+        from flask_migrate import Migrate
+        Migrate(app, db)
     login.init_app(app)
     mail.init_app(app)
     bootstrap.init_app(app)
     moment.init_app(app)
     babel.init_app(app)
-    cognito = CognitoAuthManager(app)
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']], \
-                                      http_auth=(app.config['ELASTICSEARCH_USER'], app.config['ELASTICSEARCH_PSW'])) \
-        if app.config['ELASTICSEARCH_URL'] else None
-    app.redis = get_redis_client(app.config['REDIS_URL'], app.config['REDIS_PSW'])
-    app.task_queue = rq.Queue('microblog-tasks', connection=app.redis)
+    sql_instrumentation.init_app(app)
+    metrics_registry.init_app(app)
+    cache.init_app(app)
+    follow_graph.init_app(app)
+    recent_posts.init_app(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
 
     if app.config['AUTH_USE_AWS_COGNITO']:
         # use AWS cognito based authentication module
+        from flask_cognito_auth import CognitoAuthManager
+        CognitoAuthManager(app)
         from app.cognito import bp as cognito_bp
         app.register_blueprint(cognito_bp, url_prefix='/cognito')
         login.login_view = 'cognito.login'
@@ -83,7 +144,12 @@ def create_app(config_class=Config):
     from app.api import bp as api_bp
     app.register_blueprint(api_bp, url_prefix='/api')
 
+    from app.admin import bp as admin_bp
+    app.register_blueprint(admin_bp, url_prefix='/admin')
+
     if not app.debug and not app.testing:
+        handlers = []
+        access_handler = None
         if app.config['MAIL_SERVER']:
             auth = None
             if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
@@ -92,29 +158,41 @@ def create_app(config_class=Config):
             secure = None
             if app.config['MAIL_USE_TLS']:
                 secure = ()
-            mail_handler = SMTPHandler(
+            mail_handler = DedupSMTPHandler(
                 mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
                 fromaddr=app.config['ADMINS'][0],
                 toaddrs=app.config['ADMINS'], subject='{}Microblog Failure'.format(app.config['MAIL_SUBJECT_PREFIX']),
-                credentials=auth, secure=secure)
+                credentials=auth, secure=secure,
+                interval=app.config['LOG_MAIL_INTERVAL'],
+                max_mails=app.config['LOG_MAIL_MAX'])
             mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
+            handlers.append(mail_handler)
 
         if app.config['LOG_TO_STDOUT']:
             stream_handler = logging.StreamHandler()
             stream_handler.setLevel(logging.INFO)
-            app.logger.addHandler(stream_handler)
+            handlers.append(stream_handler)
+            if app.config['LOG_ACCESS']:
+                access_handler = logging.StreamHandler()
         else:
             if not os.path.exists('logs'):
                 os.mkdir('logs')
-            file_handler = RotatingFileHandler('logs/microblog.log',
-                                               maxBytes=10240, backupCount=10)
+            file_handler = RotatingFileHandler(
+                'logs/microblog.log', maxBytes=app.config['LOG_MAX_BYTES'],
+                backupCount=app.config['LOG_BACKUP_COUNT'])
             file_handler.setFormatter(logging.Formatter(
                 '%(asctime)s %(levelname)s: %(message)s '
                 '[in %(pathname)s:%(lineno)d]'))
             file_handler.setLevel(logging.INFO)
-            app.logger.addHandler(file_handler)
-
+            handlers.append(file_handler)
+            if app.config['LOG_ACCESS']:
+                access_handler = RotatingFileHandler(
+                    'logs/access.log', maxBytes=app.config['LOG_MAX_BYTES'],
+                    backupCount=app.config['LOG_BACKUP_COUNT'])
+        if access_handler is not None:
+            access_handler.setFormatter(JSONFormatter())
+
+        start_queue_logging(app, handlers, access_handler)
         app.logger.setLevel(logging.INFO)
         app.logger.info('Microblog startup')
 
@@ -0,0 +1,39 @@
+from functools import wraps
+from flask import render_template, current_app, abort, send_from_directory
+from flask_login import current_user, login_required
+from flask_babel import _
+from app.admin import bp
+from app.profiling import generate_profile_token, latest_profiles
+
+
+def admin_required(f):
+    @wraps(f)
+    @login_required
+    def decorated_function(*args, **kwargs):
+        if not current_user.email or \
+                current_user.email not in current_app.config['ADMINS']:
+            abort(403)
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+@bp.route('/profiles')
+@admin_required
+def profiles():
+    token = generate_profile_token(
+        current_user.email,
+        expires_in=current_app.config['PROFILE_TOKEN_EXPIRES_IN'])
+    return render_template(
+        'admin/profiles.html', title=_('Profiles'), token=token,
+        enabled=bool(current_app.config['PROFILE_DIR']),
+        profiles=latest_profiles(current_app.config['PROFILE_DIR']))
+
+
+@bp.route('/profiles/<name>.<any(prof, collapsed):ext>')
+@admin_required
+def download_profile(name, ext):
+    if not current_app.config['PROFILE_DIR']:
+        abort(404)
+    return send_from_directory(
+        current_app.config['PROFILE_DIR'], '{}.{}'.format(name, ext),
+        as_attachment=True)
@@ -1,6 +1,7 @@
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from app.models import User
 from app.api.errors import error_response
+from app.replicas import primary_reads
 
 basic_auth = HTTPBasicAuth()
 token_auth = HTTPTokenAuth()
@@ -8,7 +9,8 @@ token_auth = HTTPTokenAuth()
 
 @basic_auth.verify_password
 def verify_password(username, password):
-    user = User.query.filter_by(username=username).first()
+    with primary_reads():
+        user = User.query.filter_by(username=username).first()
     if user and user.check_password(password):
         return user
 
@@ -20,7 +22,10 @@ def basic_auth_error(status):
 
 @token_auth.verify_token
 def verify_token(token):
-    return User.check_token(token) if token else None
+    if not token:
+        return None
+    with primary_reads():
+        return User.check_token(token)
 
 
 @token_auth.error_handler
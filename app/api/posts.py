@@ -0,0 +1,109 @@
+from hashlib import md5
+from flask import jsonify, request, current_app
+from werkzeug.http import is_resource_modified
+from app.models import User, Post
+from app.api import bp
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.pagination import item_cursor, items_since, keyset_page
+from app.viewmodels import post_rows, post_views
+
+
+def _page_validators(items):
+    # validators are derived from the newest item of the page; the id of the
+    # oldest item and the page length are mixed into the ETag as well, so
+    # that older posts entering the page (e.g. after a follow) invalidate it
+    if not items:
+        return md5(b'empty').hexdigest(), None
+    newest, oldest = items[0], items[-1]
+    etag = md5('{}|{}|{}|{}'.format(newest.id, newest.timestamp.isoformat(),
+                                    oldest.id, len(items)).encode('utf-8'))
+    return etag.hexdigest(), newest.timestamp
+
+
+def _not_modified(etag, last_modified):
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+def post_collection_response(query, endpoint, **kwargs):
+    """Return a conditional, cursor paginated response for a post query."""
+    cursor = request.args.get('cursor') or None
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    try:
+        rows, next_cursor = keyset_page(post_rows(query), Post, cursor,
+                                        per_page)
+    except ValueError:
+        return bad_request('invalid cursor')
+    return post_page_response(post_views(rows), cursor, per_page, next_cursor,
+                              endpoint, **kwargs)
+
+
+def post_page_response(items, cursor, per_page, next_cursor, endpoint,
+                       **kwargs):
+    """Return a conditional response for a page of post views."""
+    etag, last_modified = _page_validators(items)
+    if not is_resource_modified(request.environ, etag=etag,
+                                last_modified=last_modified):
+        return _not_modified(etag, last_modified)
+    response = jsonify(Post.to_cursor_collection_dict(
+        items, cursor, per_page, next_cursor, endpoint, **kwargs))
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    return response
+
+
+@bp.route('/posts/<int:id>', methods=['GET'])
+@token_auth.login_required
+def get_post(id):
+    return jsonify(Post.query.get_or_404(id).to_dict())
+
+
+@bp.route('/posts', methods=['GET'])
+@token_auth.login_required
+def get_posts():
+    return post_collection_response(Post.query, 'api.get_posts')
+
+
+@bp.route('/users/<int:id>/posts', methods=['GET'])
+@token_auth.login_required
+def get_user_posts(id):
+    user = User.query.get_or_404(id)
+    return post_collection_response(Post.query.filter_by(user_id=user.id),
+                                    'api.get_user_posts', id=id)
+
+
+@bp.route('/timeline', methods=['GET'])
+@token_auth.login_required
+def get_timeline():
+    return post_collection_response(
+        token_auth.current_user().followed_posts(), 'api.get_timeline')
+
+
+@bp.route('/timeline/since', methods=['GET'])
+@token_auth.login_required
+def get_timeline_since():
+    cursor = request.args.get('cursor') or None
+    limit = min(request.args.get('limit', 25, type=int), 100)
+    try:
+        rows, more = items_since(
+            post_rows(token_auth.current_user().followed_posts()), Post,
+            cursor, limit)
+    except ValueError:
+        return bad_request('invalid cursor')
+    return posts_since_response(post_views(rows), cursor, more)
+
+
+def posts_since_response(items, cursor, more):
+    """Return the post views newer than cursor."""
+    return jsonify({
+        'items': [item.to_dict() for item in items],
+        '_meta': {
+            'cursor': item_cursor(items[0]) if items else cursor,
+            'more': more
+        }
+    })
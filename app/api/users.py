@@ -9,7 +9,9 @@ from app.api.errors import bad_request
 @bp.route('/users/<int:id>', methods=['GET'])
 @token_auth.login_required
 def get_user(id):
-    return jsonify(User.query.get_or_404(id).to_dict())
+    user = User.get_cached(id) or abort(404)
+    return jsonify(user.to_dict(
+        is_followed_by_me=token_auth.current_user().is_following(user)))
 
 
 @bp.route('/users', methods=['GET'])
@@ -17,7 +19,8 @@ def get_user(id):
 def get_users():
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
-    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users')
+    data = User.to_collection_dict(User.query, page, per_page, 'api.get_users',
+                                   viewer=token_auth.current_user())
     return jsonify(data)
 
 
@@ -28,7 +31,8 @@ def get_followers(id):
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
     data = User.to_collection_dict(user.followers, page, per_page,
-                                   'api.get_followers', id=id)
+                                   'api.get_followers',
+                                   viewer=token_auth.current_user(), id=id)
     return jsonify(data)
 
 
@@ -39,7 +43,8 @@ def get_followed(id):
     page = request.args.get('page', 1, type=int)
     per_page = min(request.args.get('per_page', 10, type=int), 100)
     data = User.to_collection_dict(user.followed, page, per_page,
-                                   'api.get_followed', id=id)
+                                   'api.get_followed',
+                                   viewer=token_auth.current_user(), id=id)
     return jsonify(data)
 
 
@@ -0,0 +1,402 @@
+import asyncio
+import io
+import pickle
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from flask import abort, jsonify, request
+from redis import RedisError
+from sqlalchemy.engine import make_url
+from werkzeug.exceptions import HTTPException
+from app import db, follow_graph, redis_url
+from app.api.auth import token_auth
+from app.api.errors import bad_request
+from app.api.posts import post_page_response, posts_since_response
+from app.models import User, Post, followers
+from app.pagination import keyset_page, items_since
+from app.viewmodels import USER_COLUMNS, UserView, post_rows, \
+    views_with_authors
+
+# endpoint -> coroutine function serving it, see endpoint()
+VIEWS = {}
+USER_FIELDS = [column.key for column in USER_COLUMNS]
+
+
+def endpoint(name):
+    """Serve an endpoint of the Flask application with a coroutine.
+
+    The coroutine is called with the AsyncAPI, an AsyncSession, the ID of
+    the user who authenticated with a token and the arguments of the URL
+    rule, and returns a response like a Flask view.
+    """
+    def decorator(f):
+        VIEWS[name] = f
+        return f
+    return decorator
+
+
+def _environ(scope, body=b''):
+    # the WSGI environment of a request
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode(
+            'utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope['http_version'],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        key = name.decode('latin-1').upper().replace('-', '_')
+        if key not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = 'HTTP_' + key
+        value = value.decode('latin-1')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def _asgi_headers(headers):
+    return [(name.lower().encode('latin-1'), value.encode('latin-1'))
+            for name, value in headers]
+
+
+# the functions below run with the synchronous session of an AsyncSession,
+# through AsyncSession.run_sync()
+
+def _check_token(session, token):
+    user = session.query(User.id, User.token_expiration).filter_by(
+        token=token).first()
+    if user is None or user.token_expiration < datetime.utcnow():
+        return None
+    return user.id
+
+
+def _user_stats(session, user_ids, viewer_id, follows=True):
+    # post counts and, if follows is True, follow counts and the following
+    # status of viewer_id, with one grouped query each instead of queries
+    # per user
+    posts = dict(session.query(Post.user_id, db.func.count()).filter(
+        Post.user_id.in_(user_ids)).group_by(Post.user_id))
+    if not follows:
+        return posts, None, None
+    followed_by = dict(session.query(
+        followers.c.followed_id, db.func.count()).filter(
+            followers.c.followed_id.in_(user_ids)).group_by(
+                followers.c.followed_id))
+    following = dict(session.query(
+        followers.c.follower_id, db.func.count()).filter(
+            followers.c.follower_id.in_(user_ids)).group_by(
+                followers.c.follower_id))
+    followed = set(row[0] for row in session.query(
+        followers.c.followed_id).filter(
+            followers.c.follower_id == viewer_id,
+            followers.c.followed_id.in_(user_ids)))
+    counts = {id: (followed_by.get(id, 0), following.get(id, 0))
+              for id in user_ids}
+    return posts, counts, {id: id in followed for id in user_ids}
+
+
+def _graph_stats(user_ids, viewer_id):
+    # follow counts and following status from the follow graph index, or
+    # None; runs in a thread, since refreshing the index reads the Redis
+    # stream with the blocking client
+    status = follow_graph.following_status(viewer_id, user_ids)
+    counts = {id: (follow_graph.followers_count(id),
+                   follow_graph.followed_count(id)) for id in user_ids}
+    if status is None or any(None in pair for pair in counts.values()):
+        return None
+    return counts, status
+
+
+class AsyncAPI(object):
+    """ASGI application serving the read-only API with asyncio.
+
+    Requests for the endpoints in VIEWS are handled in the event loop, with
+    SQLAlchemy's asyncio engine on ASYNC_DATABASE_URL and an asyncio Redis
+    client, so that one process serves many API clients while they wait on
+    the database. Views run in a request context of the Flask application
+    and return the same representations as the views in app/api. Users are
+    read through the same Redis cache entries as User.get_cached_data_many()
+    and follow counts from the follow graph index when there is one.
+
+    Every other request is passed to the Flask application, in a pool of
+    REQUEST_CONCURRENCY threads; serve web pages with the WSGI server.
+    """
+    def __init__(self, app):
+        from redis.asyncio import BlockingConnectionPool, Redis
+        from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+        from sqlalchemy.orm import sessionmaker
+        from sqlalchemy.pool import AsyncAdaptedQueuePool
+        self.app = app
+        self.executor = ThreadPoolExecutor(app.config['REQUEST_CONCURRENCY'])
+        url = make_url(app.config['ASYNC_DATABASE_URL'])
+        options = dict(app.config['SQLALCHEMY_ENGINE_OPTIONS'])
+        if url.get_backend_name() == 'sqlite' and \
+                url.database not in (None, '', ':memory:'):
+            # SQLAlchemy 1.4 opens a connection per session for SQLite files
+            options['poolclass'] = AsyncAdaptedQueuePool
+            options['pool_size'] = app.config['ASYNC_POOL_SIZE']
+        elif 'pool_size' in options:
+            options['pool_size'] = app.config['ASYNC_POOL_SIZE']
+        self.engine = create_async_engine(url, **options)
+        # the query class of Flask-SQLAlchemy, for paginate()
+        self.session = sessionmaker(self.engine, class_=AsyncSession,
+                                    query_cls=db.Query)
+        self.redis = Redis(connection_pool=BlockingConnectionPool.from_url(
+            redis_url(app.config['REDIS_URL'], app.config['REDIS_PSW']),
+            max_connections=app.config['ASYNC_POOL_SIZE']))
+        self.use_cache = app.config['CACHE_USE_REDIS']
+        self.cache_prefix = app.config['CACHE_PREFIX']
+        self.redis_down_until = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] == 'http':
+            environ = _environ(scope)
+            adapter = self.app.url_map.bind_to_environ(
+                environ, server_name=self.app.config['SERVER_NAME'])
+            try:
+                name, args = adapter.match()
+            except HTTPException:
+                name = None
+            if name in VIEWS:
+                return await self._respond(name, args, environ, send)
+            await self._wsgi(scope, receive, send)
+
+    async def _wsgi(self, scope, receive, send):
+        body = bytearray()
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        loop = asyncio.get_running_loop()
+        status, headers, body = await loop.run_in_executor(
+            self.executor, self._call_wsgi, _environ(scope, bytes(body)))
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    def _call_wsgi(self, environ):
+        # responses are small pages, read them at once
+        start = []
+
+        def start_response(status, headers, exc_info=None):
+            start[:] = [int(status.split(' ', 1)[0]), _asgi_headers(headers)]
+
+        result = self.app(environ, start_response)
+        try:
+            body = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return start[0], start[1], body
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.engine.dispose()
+                await self.redis.close()
+                await self.redis.connection_pool.disconnect()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _respond(self, name, args, environ, send):
+        # the request hooks of the application are not run, they may block
+        start = time.perf_counter()
+        with self.app.request_context(environ):
+            try:
+                rv = await self._dispatch(VIEWS[name], args)
+            except HTTPException as e:
+                rv = self.app.handle_http_exception(e)
+            except Exception as e:
+                rv = self.app.handle_exception(e)
+            response = self.app.make_response(rv)
+            headers = _asgi_headers(response.headers.items())
+            body = response.get_data() if request.method != 'HEAD' else b''
+        self.app.extensions['metrics'].record_request(
+            name, environ['REQUEST_METHOD'], response.status_code,
+            time.perf_counter() - start)
+        await send({'type': 'http.response.start',
+                    'status': response.status_code, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _dispatch(self, view, args):
+        auth = token_auth.get_auth()
+        async with self.session() as session:
+            viewer_id = await session.run_sync(
+                _check_token, auth['token']) if auth and auth['token'] \
+                else None
+            if viewer_id is None:
+                return token_auth.auth_error_callback(401)
+            return await view(self, session, viewer_id, **args)
+
+    def _redis(self):
+        if not self.use_cache or time.time() < self.redis_down_until:
+            return None
+        return self.redis
+
+    def _redis_failed(self, error):
+        self.redis_down_until = time.time() + 10
+        self.app.logger.warning('Async API: Redis unavailable: %s', error)
+
+    async def cache_get_many(self, keys):
+        """Return a dictionary with the values of keys cached in Redis."""
+        redis = self._redis()
+        if redis is None or not keys:
+            return {}
+        try:
+            raws = await redis.mget([self.cache_prefix + key for key in keys])
+        except RedisError as e:
+            self._redis_failed(e)
+            return {}
+        return {key: pickle.loads(raw) for key, raw in zip(keys, raws)
+                if raw is not None}
+
+    async def cache_set_many(self, mapping, ttl):
+        redis = self._redis()
+        if redis is None or not mapping:
+            return
+        try:
+            pipeline = redis.pipeline(transaction=False)
+            for key, value in mapping.items():
+                pipeline.setex(self.cache_prefix + key, ttl,
+                               pickle.dumps(value))
+            await pipeline.execute()
+        except RedisError as e:
+            self._redis_failed(e)
+
+    async def users(self, session, ids):
+        """Return the cached data of users, as User.get_cached_data_many()."""
+        keys = {id: 'user:id:{}'.format(id) for id in ids if id is not None}
+        found = await self.cache_get_many(list(keys.values()))
+        missing = [id for id, key in keys.items() if key not in found]
+        if missing:
+            loaded = {keys[id]: data for id, data in (await session.run_sync(
+                User.load_cache_data, missing)).items()}
+            await self.cache_set_many(loaded,
+                                      self.app.config['CACHE_USER_TTL'])
+            found.update(loaded)
+        return {id: found[key] for id, key in keys.items()
+                if found.get(key) is not None}
+
+    async def user_views(self, session, users, viewer_id):
+        """Return views of users, given as mappings of their columns.
+
+        The result is a tuple (views, status), where status tells for each
+        user ID if viewer_id follows that user.
+        """
+        ids = [user['id'] for user in users]
+        if not ids:
+            return [], {}
+        graph = await asyncio.to_thread(_graph_stats, ids, viewer_id) \
+            if follow_graph.path and ids else None
+        posts, counts, status = await session.run_sync(
+            _user_stats, ids, viewer_id, graph is None)
+        if graph is not None:
+            counts, status = graph
+        views = [UserView(counts=(posts.get(user['id'], 0),) +
+                          counts[user['id']],
+                          **{field: user[field] for field in USER_FIELDS})
+                 for user in users]
+        return views, status
+
+    async def post_views(self, session, rows):
+        """Return views for rows returned by a post_rows() query."""
+        rows = [row._mapping for row in rows]
+        return views_with_authors(rows, await self.users(
+            session, {row['user_id'] for row in rows}))
+
+    async def user_page(self, session, viewer_id, query, endpoint,
+                        **kwargs):
+        """Return a page of the users selected by query(session).
+
+        query must select USER_COLUMNS.
+        """
+        page = request.args.get('page', 1, type=int)
+        per_page = min(request.args.get('per_page', 10, type=int), 100)
+        resources = await session.run_sync(
+            lambda sync_session: query(sync_session).paginate(
+                page, per_page, False))
+        views, status = await self.user_views(
+            session, [row._mapping for row in resources.items], viewer_id)
+        return jsonify(User.page_to_dict(
+            [view.to_dict(is_followed_by_me=status.get(view.id))
+             for view in views], resources, page, per_page, endpoint,
+            **kwargs))
+
+
+@endpoint('api.get_user')
+async def get_user(api, session, viewer_id, id):
+    user = (await api.users(session, [id])).get(id) or abort(404)
+    views, status = await api.user_views(session, [user], viewer_id)
+    return jsonify(views[0].to_dict(is_followed_by_me=status[id]))
+
+
+@endpoint('api.get_users')
+async def get_users(api, session, viewer_id):
+    return await api.user_page(
+        session, viewer_id, lambda s: s.query(*USER_COLUMNS),
+        'api.get_users')
+
+
+@endpoint('api.get_followers')
+async def get_followers(api, session, viewer_id, id):
+    await api.users(session, [id]) or abort(404)
+    return await api.user_page(
+        session, viewer_id, lambda s: s.query(*USER_COLUMNS).join(
+            followers, followers.c.follower_id == User.id).filter(
+                followers.c.followed_id == id), 'api.get_followers', id=id)
+
+
+@endpoint('api.get_followed')
+async def get_followed(api, session, viewer_id, id):
+    await api.users(session, [id]) or abort(404)
+    return await api.user_page(
+        session, viewer_id, lambda s: s.query(*USER_COLUMNS).join(
+            followers, followers.c.followed_id == User.id).filter(
+                followers.c.follower_id == id), 'api.get_followed', id=id)
+
+
+@endpoint('api.get_timeline')
+async def get_timeline(api, session, viewer_id):
+    cursor = request.args.get('cursor') or None
+    per_page = min(request.args.get('per_page', 10, type=int), 100)
+    try:
+        rows, next_cursor = await session.run_sync(
+            lambda s: keyset_page(post_rows(Post.timeline_of(
+                viewer_id, s.query(Post))), Post, cursor, per_page))
+    except ValueError:
+        return bad_request('invalid cursor')
+    return post_page_response(await api.post_views(session, rows), cursor,
+                              per_page, next_cursor, 'api.get_timeline')
+
+
+@endpoint('api.get_timeline_since')
+async def get_timeline_since(api, session, viewer_id):
+    cursor = request.args.get('cursor') or None
+    limit = min(request.args.get('limit', 25, type=int), 100)
+    try:
+        rows, more = await session.run_sync(
+            lambda s: items_since(post_rows(Post.timeline_of(
+                viewer_id, s.query(Post))), Post, cursor, limit))
+    except ValueError:
+        return bad_request('invalid cursor')
+    return posts_since_response(await api.post_views(session, rows), cursor,
+                                more)
@@ -0,0 +1,309 @@
+import json
+import os
+import statistics
+import subprocess
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from unittest import mock
+from flask import current_app, g, render_template
+from flask_login import login_user
+from app import db, cache
+from app.models import User, Post, Notification, followers
+from app.pagination import newest_first
+from app.viewmodels import post_rows, post_views
+
+# follow counts at which User.followed_posts() is measured; the seeded user
+# whose follow count is closest to each of them is used
+FOLLOW_COUNTS = [10, 100, 1000]
+# number of posts loaded and rendered by the listing benchmarks
+LISTING_SIZE = 1000
+
+BENCHMARKS = []
+
+
+def benchmark(name, setup=None):
+    """Register a benchmark.
+
+    setup(sample) runs before each repetition, outside of the measurement,
+    and returns the positional arguments for the benchmark function. Every
+    repetition starts with a fresh session, so objects are loaded again.
+    """
+    def decorator(f):
+        BENCHMARKS.append((name, setup, f))
+        return f
+    return decorator
+
+
+class _StatementCounter(object):
+    def __init__(self):
+        self.count = 0
+        self.statements = []
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+
+@contextmanager
+def count_statements():
+    counter = _StatementCounter()
+    engine = db.engine
+    db.event.listen(engine, 'before_cursor_execute', counter)
+    try:
+        yield counter
+    finally:
+        db.event.remove(engine, 'before_cursor_execute', counter)
+
+
+def _sample_users():
+    """Pick the users the benchmarks run as from the seeded dataset."""
+    counts = db.session.query(
+        followers.c.follower_id, db.func.count().label('n')).group_by(
+            followers.c.follower_id).order_by('n').all()
+    if len(counts) < 2:
+        raise RuntimeError('the database has no follow graph, run '
+                           '"flask bench seed" first')
+    by_follows = {}
+    for target in FOLLOW_COUNTS:
+        user_id, n = min(counts, key=lambda c: abs(c[1] - target))
+        by_follows[target] = (user_id, n)
+    median_user = counts[len(counts) // 2][0]
+    other_user = counts[-1][0] if counts[-1][0] != median_user \
+        else counts[0][0]
+    return {'user_id': median_user, 'other_id': other_user,
+            'by_follows': by_follows}
+
+
+def _user(sample):
+    return (User.query.get(sample['user_id']),)
+
+
+def _users(sample):
+    return User.query.get(sample['user_id']), \
+        User.query.get(sample['other_id'])
+
+
+def _register_followed_posts():
+    def setup_for(target):
+        def setup(sample):
+            return (User.query.get(sample['by_follows'][target][0]),)
+        return setup
+
+    for target in FOLLOW_COUNTS:
+        def followed_posts(user):
+            user.followed_posts().paginate(
+                1, current_app.config['POSTS_PER_PAGE'], False).items
+        benchmark('followed_posts[~{} follows]'.format(target),
+                  setup_for(target))(followed_posts)
+
+
+_register_followed_posts()
+
+
+@benchmark('User.to_dict', _user)
+def user_to_dict(user):
+    user.to_dict()
+
+
+@benchmark('User.to_collection_dict', lambda sample: ())
+def users_to_collection_dict():
+    User.to_collection_dict(User.query, 1, 25, 'api.get_users')
+
+
+def _search_ids(sample):
+    ids = [id for id, in db.session.query(Post.id).order_by(
+        Post.timestamp.desc()).limit(current_app.config['POSTS_PER_PAGE'])]
+    return (ids,)
+
+
+def _search_ids_uncached(sample):
+    # posts are hydrated through the cache, drop them and their authors so
+    # that every repetition reads them from the database
+    ids, = _search_ids(sample)
+    authors = {user_id for user_id, in db.session.query(Post.user_id).filter(
+        Post.id.in_(ids))}
+    cache.delete(*['post:id:{}'.format(id) for id in ids] +
+                 ['user:id:{}'.format(id) for id in authors])
+    return (ids,)
+
+
+def search_hydration(ids):
+    # Elasticsearch is replaced by a stub returning known IDs, so that only
+    # the database side of the search is measured
+    with mock.patch('app.models.query_index',
+                    return_value=(ids, len(ids))):
+        Post.search('benchmark', 1, len(ids))
+
+
+benchmark('SearchableMixin.search hydration',
+          _search_ids_uncached)(search_hydration)
+benchmark('SearchableMixin.search [cached]',
+          _search_ids)(search_hydration)
+
+
+@benchmark('User.is_following', _users)
+def is_following(user, other):
+    user.is_following(other)
+
+
+@benchmark('User.new_messages', _user)
+def new_messages(user):
+    user.new_messages()
+
+
+@benchmark('User.add_notification', _user)
+def add_notification(user):
+    user.add_notification('unread_message_count', 0)
+    # what a commit runs, without committing
+    Notification.before_commit(db.session())
+
+
+def _index_page(sample):
+    user = User.query.get(sample['user_id'])
+    posts = user.followed_posts().limit(
+        current_app.config['POSTS_PER_PAGE']).all()
+    login_user(user)
+    g.locale = 'en'
+    return (posts,)
+
+
+@benchmark('render index.html', _index_page)
+def render_index(posts):
+    render_template('index.html', title='Home', posts=posts, next_url=None,
+                    prev_url=None)
+
+
+@benchmark('render posts (no fragment cache)', _index_page)
+def render_posts_uncached(posts):
+    for post in posts:
+        render_template('_post.html', post=post)
+
+
+def _listing(sample):
+    login_user(User.query.get(sample['user_id']))
+    g.locale = 'en'
+    return ()
+
+
+@benchmark('list {} posts (ORM)'.format(LISTING_SIZE), _listing)
+def list_posts_orm():
+    posts = newest_first(Post.query, Post).limit(LISTING_SIZE).all()
+    # as render_posts() does
+    authors = User.get_cached_many({post.user_id for post in posts})
+    for post in posts:
+        render_template('_post.html', post=post)
+
+
+@benchmark('list {} posts (view models)'.format(LISTING_SIZE), _listing)
+def list_posts_views():
+    posts = post_views(post_rows(newest_first(Post.query, Post)).limit(
+        LISTING_SIZE).all())
+    for post in posts:
+        render_template('_post.html', post=post)
+
+
+def _peak_memory(setup, f, sample):
+    # a separate repetition, since tracing slows down the measured ones
+    with current_app.test_request_context():
+        db.session.remove()
+        args = setup(sample) if setup else ()
+        tracemalloc.start()
+        try:
+            f(*args)
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+            db.session.rollback()
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(repeat=50, warmup=5, only=None):
+    """Run the benchmarks and return the results as a dictionary.
+
+    Must be called with an application context. Each repetition runs in a
+    test request context (for url_for and templates) that is rolled back
+    afterwards, so benchmarks that write leave no trace. The peak memory
+    allocated is measured in one more repetition.
+    """
+    sample = _sample_users()
+    results = {}
+    for name, setup, f in BENCHMARKS:
+        if only and not any(part in name for part in only):
+            continue
+        timings = []
+        statements = []
+        for i in range(warmup + repeat):
+            with current_app.test_request_context():
+                db.session.remove()
+                args = setup(sample) if setup else ()
+                with count_statements() as counter:
+                    start = time.perf_counter()
+                    f(*args)
+                    elapsed = time.perf_counter() - start
+                db.session.rollback()
+            if i >= warmup:
+                timings.append(elapsed)
+                statements.append(counter.count)
+        results[name] = {
+            'median_ms': statistics.median(timings) * 1000,
+            'min_ms': min(timings) * 1000,
+            'mean_ms': statistics.mean(timings) * 1000,
+            'stdev_ms': statistics.pstdev(timings) * 1000,
+            'statements': max(statements),
+            'peak_kib': _peak_memory(setup, f, sample) / 1024,
+        }
+    return {
+        'commit': _git_commit(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'database': db.engine.dialect.name,
+        'repeat': repeat,
+        'follow_counts': {str(target): n for target, (_, n)
+                          in sample['by_follows'].items()},
+        'results': results,
+    }
+
+
+def load(filename):
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def save(report, filename):
+    directory = os.path.dirname(filename)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def format_report(report, baseline=None):
+    """Format results as a table, with changes relative to a baseline."""
+    lines = ['{:<36}{:>11}{:>11}{:>6}{:>10}'.format(
+        'benchmark', 'median ms', 'min ms', 'SQL', 'peak KiB')]
+    if baseline:
+        lines[0] += '{:>11}{:>8}'.format('vs ' + (baseline['commit'] or '?'),
+                                         'SQL')
+    for name, r in report['results'].items():
+        line = '{:<36}{:>11.3f}{:>11.3f}{:>6}{:>10.0f}'.format(
+            name, r['median_ms'], r['min_ms'], r['statements'],
+            r.get('peak_kib', 0))
+        base = baseline['results'].get(name) if baseline else None
+        if base:
+            change = (r['median_ms'] - base['median_ms']) / \
+                base['median_ms'] * 100 if base['median_ms'] else 0.0
+            line += '{:>+10.1f}%{:>+8}'.format(
+                change, r['statements'] - base['statements'])
+        lines.append(line)
+    return '\n'.join(lines)
@@ -0,0 +1,207 @@
+import itertools
+import json
+import random
+from datetime import datetime, timedelta
+from time import time
+from werkzeug.security import generate_password_hash
+from app import db, recent_posts
+from app.models import User, Post, Message, Conversation, Notification, \
+    SearchableMixin, followers
+
+# relative share of posts per language; '' is what langdetect failures store
+LANGUAGES = [('en', 60), ('es', 20), ('fr', 5), ('de', 5), ('pt', 5),
+             ('', 5)]
+# relative activity per hour of the day (UTC), peaking in the evening
+HOURLY_ACTIVITY = [3, 2, 1, 1, 1, 2, 4, 6, 8, 8, 7, 7,
+                   8, 8, 7, 7, 8, 9, 10, 11, 11, 10, 7, 5]
+WORDS = ('the of and to in is you that it he was for on are as with his they '
+         'at be this have from or one had by word but not what all were we '
+         'when your can said there use an each which she do how their if '
+         'will up other about out many then them these so some her would '
+         'make like him into time has look two more write go see number no '
+         'way could people my than first water been call who oil its now '
+         'find long down day did get come made may part microblog flask '
+         'python redis search timeline follow post message').split()
+
+
+class _Sampler(object):
+    """Weighted sampling with replacement in O(log n) per draw."""
+    def __init__(self, rng, population, weights):
+        self.rng = rng
+        self.population = population
+        self.cum_weights = list(itertools.accumulate(weights))
+
+    def sample(self, k=1):
+        return self.rng.choices(self.population, cum_weights=self.cum_weights,
+                                 k=k)
+
+
+def _power_law(rng, mean, alpha=1.5, cap=None):
+    # Pareto distributed value with the given mean (requires alpha > 1)
+    value = rng.paretovariate(alpha) * mean * (alpha - 1) / alpha
+    return min(value, cap) if cap is not None else value
+
+
+def _round(rng, value):
+    # round up with a probability equal to the fractional part, so that
+    # small values still add up to the expected total
+    return int(value) + (rng.random() < value - int(value))
+
+
+def _timestamp(rng, now, days, hour_sampler):
+    day = now - timedelta(days=rng.randrange(days))
+    timestamp = day.replace(hour=hour_sampler.sample()[0],
+                            minute=rng.randrange(60),
+                            second=rng.randrange(60),
+                            microsecond=rng.randrange(1000000))
+    return min(timestamp, now)
+
+
+def _sentence(rng, max_length=140):
+    words = rng.choices(WORDS, k=rng.randint(3, 25))
+    return ' '.join(words)[:max_length]
+
+
+def _next_id(column):
+    return (db.session.query(db.func.max(column)).scalar() or 0) + 1
+
+
+def _insert(table, rows, chunk_size):
+    """Insert rows with one executemany statement per chunk."""
+    count = 0
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return count
+        db.session.execute(table.insert(), chunk)
+        db.session.commit()
+        count += len(chunk)
+
+
+def seed(users=1000, posts=20, follows=25, messages=2, days=30,
+         password='bench', random_seed=None, chunk_size=1000):
+    """Generate a synthetic dataset and insert it with bulk statements.
+
+    posts, follows and messages are per user averages. Activity and
+    popularity both follow power laws: a few users post and follow a lot,
+    and a few users attract most followers. Seeded users are called
+    user<id> and all share the given password.
+
+    Returns a dictionary with the number of rows inserted per table and the
+    range of user IDs created.
+    """
+    rng = random.Random(random_seed)
+    now = datetime.utcnow()
+    first_user_id = _next_id(User.id)
+    user_ids = list(range(first_user_id, first_user_id + users))
+    # shuffle ranks so that popular users are not all adjacent IDs
+    ranks = list(range(1, users + 1))
+    rng.shuffle(ranks)
+    popular = _Sampler(rng, user_ids, [1.0 / rank ** 1.1 for rank in ranks])
+    activity = [_power_law(rng, 1.0, cap=50.0) for _ in user_ids]
+    mean_activity = sum(activity) / users if users else 1.0
+    activity = [weight / mean_activity for weight in activity]
+    active = _Sampler(rng, user_ids, activity)
+    hours = _Sampler(rng, range(24), HOURLY_ACTIVITY)
+    languages = _Sampler(rng, *zip(*LANGUAGES))
+    # hashing is slow on purpose, so all seeded users share a single hash
+    password_hash = generate_password_hash(password)
+    counts = {'first_user_id': first_user_id,
+              'last_user_id': first_user_id + users - 1}
+
+    counts['users'] = _insert(User.__table__, ({
+        'id': id,
+        'username': 'user{}'.format(id),
+        'email': 'user{}@example.com'.format(id),
+        'password_hash': password_hash,
+        'about_me': _sentence(rng),
+        'last_seen': _timestamp(rng, now, days, hours)
+    } for id in user_ids), chunk_size)
+
+    followed = {}
+
+    def follow_rows():
+        for id in user_ids:
+            degree = _round(rng, _power_law(rng, follows, cap=users - 1))
+            targets = set()
+            # popular users are drawn repeatedly, so top up a few times
+            for _ in range(5):
+                targets.update(popular.sample(degree - len(targets)))
+                targets.discard(id)
+                if len(targets) >= degree:
+                    break
+            followed[id] = list(targets)
+            for target in targets:
+                yield {'follower_id': id, 'followed_id': target}
+
+    counts['follows'] = _insert(followers, follow_rows(), chunk_size)
+
+    first_post_id = _next_id(Post.id)
+
+    def post_rows():
+        ids = itertools.count(first_post_id)
+        for id, weight in zip(user_ids, activity):
+            for _ in range(_round(rng, posts * weight)):
+                yield {'id': next(ids), 'body': _sentence(rng),
+                       'timestamp': _timestamp(rng, now, days, hours),
+                       'user_id': id, 'language': languages.sample()[0]}
+
+    with SearchableMixin.deferred_indexing() as deferred:
+        counts['posts'] = _insert(Post.__table__, post_rows(), chunk_size)
+        if counts['posts']:
+            deferred.add_range(Post, first_post_id,
+                               first_post_id + counts['posts'] - 1)
+    # the posts were inserted without the ORM, so the window of recent posts
+    # doesn't have them
+    recent_posts.invalidate()
+
+    unread = {}
+    conversations = {}
+    conversation_ids = itertools.count(_next_id(Conversation.id))
+
+    def message_rows():
+        ids = itertools.count(_next_id(Message.id))
+        for sender in active.sample(users * messages):
+            candidates = followed.get(sender)
+            recipient = rng.choice(candidates) if candidates \
+                else popular.sample()[0]
+            if recipient == sender:
+                continue
+            unread[recipient] = unread.get(recipient, 0) + 1
+            timestamp = _timestamp(rng, now, days, hours)
+            # the seeded users are new, so all their conversations are too
+            user1_id, user2_id = sorted((sender, recipient))
+            conversation = conversations.get((user1_id, user2_id))
+            if conversation is None:
+                conversation = conversations[(user1_id, user2_id)] = {
+                    'id': next(conversation_ids), 'user1_id': user1_id,
+                    'user2_id': user2_id, 'last_message_at': timestamp,
+                    'user1_unread': 0, 'user2_unread': 0}
+            conversation['last_message_at'] = max(
+                conversation['last_message_at'], timestamp)
+            conversation['user1_unread' if recipient == user1_id
+                         else 'user2_unread'] += 1
+            yield {'id': next(ids), 'sender_id': sender,
+                   'recipient_id': recipient, 'body': _sentence(rng),
+                   'timestamp': timestamp,
+                   'conversation_id': conversation['id']}
+
+    # conversations are complete once all messages are generated, and must
+    # be inserted first
+    message_list = list(message_rows())
+    counts['conversations'] = _insert(Conversation.__table__,
+                                      conversations.values(), chunk_size)
+    counts['messages'] = _insert(Message.__table__, message_list,
+                                 chunk_size)
+
+    def notification_rows():
+        ids = itertools.count(_next_id(Notification.id))
+        for recipient, count in unread.items():
+            yield {'id': next(ids), 'name': 'unread_message_count',
+                   'user_id': recipient, 'timestamp': time(),
+                   'payload_json': json.dumps(count)}
+
+    counts['notifications'] = _insert(Notification.__table__,
+                                      notification_rows(), chunk_size)
+    return counts
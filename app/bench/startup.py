@@ -0,0 +1,80 @@
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+# "import time: self [us] | cumulative | imported package", with the package
+# indented by two spaces per nesting level
+_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)')
+
+
+def _import_once(module, cwd):
+    env = dict(os.environ)
+    # measure what a web worker imports, not what the flask command adds
+    env.pop('FLASK_RUN_FROM_CLI', None)
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=cwd, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError('importing {} failed:\n{}'.format(
+            module, result.stderr.strip().splitlines()[-1]))
+    timings = {}
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if match:
+            timings[match.group(4)] = (int(match.group(1)),
+                                       int(match.group(2)),
+                                       (len(match.group(3)) - 1) // 2)
+    return elapsed, timings
+
+
+def measure(module='microblog', repeat=5):
+    """Import module in fresh interpreters, as "python -X importtime" does.
+
+    Returns a dictionary with the median wall time of the interpreter runs
+    and, per imported module, the lowest self and cumulative import times
+    of all runs in microseconds.
+    """
+    cwd = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    walls = []
+    modules = {}
+    for _ in range(repeat):
+        elapsed, timings = _import_once(module, cwd)
+        walls.append(elapsed)
+        for name, (own, cumulative, depth) in timings.items():
+            if name in modules:
+                best = modules[name]
+                own, cumulative = min(own, best[0]), min(cumulative, best[1])
+            modules[name] = (own, cumulative, depth)
+    return {'module': module, 'repeat': repeat,
+            'wall_ms': statistics.median(walls) * 1000, 'modules': modules}
+
+
+def format_report(report, top=25):
+    """Format the slowest packages and modules as tables."""
+    packages = defaultdict(lambda: [0, 0])
+    for name, (own, _, _) in report['modules'].items():
+        package = packages[name.split('.')[0]]
+        package[0] += own
+        package[1] += 1
+    root = report['modules'].get(report['module'])
+    lines = ['import {}: {:.0f} ms in the interpreter, {:.0f} ms '
+             'importing'.format(report['module'], report['wall_ms'],
+                                root[1] / 1000 if root else 0), '',
+             '{:<40}{:>10}{:>9}'.format('package', 'self ms', 'modules')]
+    for name, (own, count) in sorted(packages.items(),
+                                     key=lambda p: -p[1][0])[:top]:
+        lines.append('{:<40}{:>10.1f}{:>9}'.format(name, own / 1000, count))
+    lines += ['', '{:<40}{:>10}{:>9}'.format('module', 'cumul ms', 'self ms')]
+    for name, (own, cumulative, _) in sorted(
+            report['modules'].items(), key=lambda m: -m[1][1])[:top]:
+        lines.append('{:<40}{:>10.1f}{:>9.1f}'.format(
+            name, cumulative / 1000, own / 1000))
+    return '\n'.join(lines)
@@ -0,0 +1,275 @@
+import os
+import pickle
+import threading
+import time
+from collections import Counter, OrderedDict
+from flask import current_app
+from redis import RedisError
+from app.metrics import inc
+
+# returned by get() for keys that are not cached, since None can be cached
+MISSING = object()
+
+
+class Cache(object):
+    """Two-tier cache: a small per-process LRU in front of Redis.
+
+    Values are pickled. Entries in the local tier live for at most
+    CACHE_LOCAL_TTL seconds; deletions are broadcast over Redis pub/sub, so
+    that every process drops its local copy right away. get_or_set()
+    computes missing values once across all processes (single flight) and
+    can cache None results for a shorter time (negative caching).
+
+    When Redis is disabled (CACHE_USE_REDIS) or unavailable, only the local
+    tier is used.
+    """
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.local = OrderedDict()
+        self.counts = Counter()
+        self.subscriber = None
+        self.redis_down_until = 0
+        os.register_at_fork(after_in_child=self._after_fork)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['cache'] = self
+        self.use_redis = app.config['CACHE_USE_REDIS']
+        self.prefix = app.config['CACHE_PREFIX']
+        self.channel = self.prefix + 'invalidate'
+        self.default_ttl = app.config['CACHE_DEFAULT_TTL']
+        self.local_ttl = app.config['CACHE_LOCAL_TTL']
+        self.local_size = app.config['CACHE_LOCAL_SIZE']
+        self.lock_timeout = app.config['CACHE_LOCK_TIMEOUT']
+        self.clear_local()
+
+    def _after_fork(self):
+        self.lock = threading.Lock()
+        self.local = OrderedDict()
+        self.subscriber = None
+
+    def clear_local(self):
+        with self.lock:
+            self.local.clear()
+
+    def _count(self, result, n=1):
+        with self.lock:
+            self.counts[result] += n
+        inc('cache_requests_total', n, result=result)
+
+    def stats(self):
+        """Return the request counts of this process and its hit ratio."""
+        with self.lock:
+            counts = dict(self.counts)
+            size = len(self.local)
+        total = sum(counts.values())
+        hits = counts.get('local_hit', 0) + counts.get('redis_hit', 0)
+        return dict(counts, local_size=size,
+                    hit_ratio=hits / total if total else None)
+
+    def _redis(self):
+        if not self.use_redis or time.time() < self.redis_down_until:
+            return None
+        redis = current_app.redis
+        if self.subscriber is None or not self.subscriber.is_alive():
+            # subscribe before anything read from Redis is kept locally, or
+            # its invalidation could be missed
+            try:
+                pubsub = self._subscribe(redis)
+            except RedisError as e:
+                self._redis_failed(e)
+                return None
+            self.subscriber = threading.Thread(
+                target=self._listen,
+                args=(redis, pubsub, current_app.logger), daemon=True)
+            self.subscriber.start()
+        return redis
+
+    def _redis_failed(self, error):
+        # stop trying for a while instead of failing every request
+        self.redis_down_until = time.time() + 10
+        self.clear_local()
+        current_app.logger.warning('Cache: Redis unavailable: %s', error)
+
+    def _get_local(self, key):
+        with self.lock:
+            entry = self.local.get(key)
+            if entry is None:
+                return MISSING
+            if entry[0] < time.time():
+                del self.local[key]
+                return MISSING
+            self.local.move_to_end(key)
+            return entry[1]
+
+    def _set_local(self, key, value, ttl):
+        with self.lock:
+            self.local[key] = (time.time() + min(ttl, self.local_ttl), value)
+            self.local.move_to_end(key)
+            while len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+
+    def get(self, key):
+        """Return the cached value, or MISSING."""
+        value = self._get_local(key)
+        if value is not MISSING:
+            self._count('local_hit')
+            return value
+        redis = self._redis()
+        if redis is not None:
+            try:
+                raw = redis.get(self.prefix + key)
+            except RedisError as e:
+                self._redis_failed(e)
+            else:
+                if raw is not None:
+                    value = pickle.loads(raw)
+                    self._set_local(key, value, self.local_ttl)
+                    self._count('redis_hit')
+                    return value
+        self._count('miss')
+        return MISSING
+
+    def get_many(self, keys):
+        """Return a dictionary with the cached values of the given keys."""
+        found = {}
+        remote = []
+        for key in keys:
+            value = self._get_local(key)
+            if value is MISSING:
+                remote.append(key)
+            else:
+                found[key] = value
+        if found:
+            self._count('local_hit', len(found))
+        redis = self._redis() if remote else None
+        if redis is not None:
+            try:
+                raws = redis.mget([self.prefix + key for key in remote])
+            except RedisError as e:
+                self._redis_failed(e)
+            else:
+                hits = 0
+                for key, raw in zip(remote, raws):
+                    if raw is not None:
+                        found[key] = pickle.loads(raw)
+                        self._set_local(key, found[key], self.local_ttl)
+                        hits += 1
+                if hits:
+                    self._count('redis_hit', hits)
+        misses = len(keys) - len(found)
+        if misses:
+            self._count('miss', misses)
+        return found
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, mapping, ttl=None):
+        ttl = ttl or self.default_ttl
+        for key, value in mapping.items():
+            self._set_local(key, value, ttl)
+        redis = self._redis()
+        if redis is None:
+            return
+        try:
+            pipeline = redis.pipeline(transaction=False)
+            for key, value in mapping.items():
+                pipeline.setex(self.prefix + key, ttl, pickle.dumps(value))
+            pipeline.execute()
+        except RedisError as e:
+            self._redis_failed(e)
+
+    def delete(self, *keys):
+        """Delete keys from Redis and from the local tier of all processes."""
+        if not keys:
+            return
+        with self.lock:
+            for key in keys:
+                self.local.pop(key, None)
+        redis = self._redis()
+        if redis is None:
+            return
+        try:
+            pipeline = redis.pipeline(transaction=False)
+            pipeline.delete(*[self.prefix + key for key in keys])
+            pipeline.publish(self.channel, '\n'.join(keys))
+            pipeline.execute()
+        except RedisError as e:
+            self._redis_failed(e)
+
+    def get_or_set(self, key, f, ttl=None, negative_ttl=None):
+        """Return the cached value, or compute it with f() and cache it.
+
+        While one process computes a value, others asking for the same key
+        wait for it instead of computing it as well, for at most
+        CACHE_LOCK_TIMEOUT seconds. None results are only cached when a
+        negative_ttl is given.
+        """
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+        redis = self._redis()
+        lock = self.prefix + 'lock:' + key
+        acquired = True
+        if redis is not None:
+            try:
+                acquired = redis.set(lock, b'1', nx=True,
+                                     px=int(self.lock_timeout * 1000))
+            except RedisError as e:
+                self._redis_failed(e)
+        if not acquired:
+            deadline = time.time() + self.lock_timeout
+            while time.time() < deadline:
+                time.sleep(0.02)
+                try:
+                    raw = redis.get(self.prefix + key)
+                except RedisError as e:
+                    self._redis_failed(e)
+                    break
+                if raw is not None:
+                    value = pickle.loads(raw)
+                    self._set_local(key, value, self.local_ttl)
+                    return value
+        try:
+            value = f()
+            if value is not None:
+                self.set(key, value, ttl)
+            elif negative_ttl:
+                self.set(key, value, negative_ttl)
+        finally:
+            if acquired and redis is not None and \
+                    time.time() >= self.redis_down_until:
+                try:
+                    redis.delete(lock)
+                except RedisError:
+                    pass
+        return value
+
+    def _subscribe(self, redis):
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(self.channel)
+        return pubsub
+
+    def _listen(self, redis, pubsub, logger):
+        delay = 1
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = self._subscribe(redis)
+                    delay = 1
+                for message in pubsub.listen():
+                    keys = message['data']
+                    if isinstance(keys, bytes):
+                        keys = keys.decode('utf-8')
+                    with self.lock:
+                        for key in keys.split('\n'):
+                            self.local.pop(key, None)
+            except RedisError as e:
+                logger.warning('Cache: invalidation listener failed: %s', e)
+            pubsub = None
+            # invalidations may have been missed while disconnected
+            self.clear_local()
+            time.sleep(delay)
+            delay = min(delay * 2, 60)
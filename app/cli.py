@@ -33,3 +33,123 @@ def register(app):
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def bench():
+        """Benchmarking and load testing commands."""
+        pass
+
+    @bench.command()
+    @click.option('--users', default=1000, help='Number of users to create.')
+    @click.option('--posts', default=20, help='Average posts per user.')
+    @click.option('--follows', default=25,
+                  help='Average number of users followed per user.')
+    @click.option('--messages', default=2,
+                  help='Average private messages sent per user.')
+    @click.option('--days', default=30,
+                  help='Spread timestamps over this many past days.')
+    @click.option('--password', default='bench',
+                  help='Password shared by all seeded users.')
+    @click.option('--random-seed', type=int,
+                  help='Seed for a reproducible dataset.')
+    def seed(users, posts, follows, messages, days, password, random_seed):
+        """Populate the database with a synthetic dataset."""
+        from app.bench.seed import seed as seed_dataset
+        counts = seed_dataset(users=users, posts=posts, follows=follows,
+                              messages=messages, days=days, password=password,
+                              random_seed=random_seed)
+        click.echo('Created users user{first_user_id} to user{last_user_id} '
+                   'with password "{password}"'.format(password=password,
+                                                       **counts))
+        for table in ('users', 'follows', 'posts', 'conversations',
+                      'messages', 'notifications'):
+            click.echo('{:>14}: {}'.format(table, counts[table]))
+
+    @bench.command()
+    @click.option('--repeat', default=50,
+                  help='Measured repetitions per benchmark.')
+    @click.option('--warmup', default=5,
+                  help='Unmeasured repetitions run first.')
+    @click.option('--only', multiple=True,
+                  help='Only run benchmarks whose name contains this text.')
+    @click.option('--output', help='Save the results to this JSON file.')
+    @click.option('--compare', help='JSON file of a previous run to compare '
+                                    'against.')
+    def micro(repeat, warmup, only, output, compare):
+        """Time model and view hot paths against the current database."""
+        from app.bench import micro as micro_bench
+        baseline = micro_bench.load(compare) if compare else None
+        try:
+            report = micro_bench.run(repeat=repeat, warmup=warmup, only=only)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        click.echo(micro_bench.format_report(report, baseline))
+        if output:
+            micro_bench.save(report, output)
+
+    @bench.command()
+    @click.option('--module', default='microblog',
+                  help='Module to import, the one the WSGI server loads.')
+    @click.option('--repeat', default=5,
+                  help='Interpreters started; the fastest times are kept.')
+    @click.option('--top', default=25, help='Rows per table.')
+    def startup(module, repeat, top):
+        """Report the import time of the application per module."""
+        from app.bench import startup as startup_bench
+        try:
+            report = startup_bench.measure(module=module, repeat=repeat)
+        except RuntimeError as e:
+            raise click.ClickException(str(e))
+        click.echo(startup_bench.format_report(report, top=top))
+
+    @app.cli.group()
+    def followgraph():
+        """Follow graph index commands."""
+        pass
+
+    @followgraph.command()
+    def build():
+        """Build the follow graph index from the database."""
+        from redis import RedisError
+        from app import follow_graph
+        if not app.config['FOLLOW_GRAPH_PATH']:
+            raise click.ClickException('FOLLOW_GRAPH_PATH is not set')
+        try:
+            edges = follow_graph.build_from_database()
+        except RedisError as e:
+            # the position in the change stream is needed to build the index
+            raise click.ClickException('Redis unavailable: {}'.format(e))
+        click.echo('Wrote {} follows to {}'.format(
+            edges, app.config['FOLLOW_GRAPH_PATH']))
+
+    @app.cli.command()
+    @click.option('--burst', is_flag=True,
+                  help='Quit once the queue is empty.')
+    def worker(burst):
+        """Run a background job worker with the application preloaded."""
+        from rq import Worker
+        # imported once here instead of in every forked job process
+        from app import tasks
+        Worker([app.task_queue], connection=app.redis).work(burst=burst)
+
+    @app.cli.group()
+    def notifications():
+        """Notification maintenance commands."""
+        pass
+
+    @notifications.command()
+    @click.option('--days', type=float,
+                  help='Delete notifications not updated for this many days '
+                       '(default: NOTIFICATION_RETENTION_DAYS).')
+    @click.option('--batch-size', type=int,
+                  help='Rows deleted per transaction '
+                       '(default: NOTIFICATION_COMPACT_BATCH).')
+    def compact(days, batch_size):
+        """Delete stale notifications, meant to be run periodically."""
+        from app.models import Notification
+        days = days if days is not None else \
+            app.config['NOTIFICATION_RETENTION_DAYS']
+        deleted = Notification.compact(
+            days * 24 * 3600,
+            batch_size or app.config['NOTIFICATION_COMPACT_BATCH'])
+        click.echo('Deleted {} notifications'.format(deleted))
@@ -0,0 +1,257 @@
+import mmap
+import os
+import struct
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from flask import current_app
+from redis import RedisError
+
+MAGIC = b'MBFOLLW2'
+# magic, stream ID the file is current with, number of users and of edges
+_HEADER = struct.Struct('<8s32sqq')
+HEADER_SIZE = 64
+
+
+def _parse_id(stream_id):
+    if isinstance(stream_id, bytes):
+        stream_id = stream_id.decode('ascii')
+    ms, _, seq = stream_id.partition('-')
+    return int(ms), int(seq or 0)
+
+
+def _csr(pairs, ids):
+    # pairs must be sorted; returns the offsets and targets arrays, with
+    # offsets indexed by the position of the source user in ids
+    nodes = len(ids)
+    offsets = array('q', bytes(8 * (nodes + 1)))
+    targets = array('q', (target for _, target in pairs))
+    for source, _ in pairs:
+        offsets[bisect_left(ids, source) + 1] += 1
+    for i in range(nodes):
+        offsets[i + 1] += offsets[i]
+    return offsets, targets
+
+
+def build(path, edges, stream_id='0-0'):
+    """Write the index file for the given (follower_id, followed_id) pairs.
+
+    The sorted IDs of the users with follows are stored first, and user
+    IDs are mapped to their position in that array with a binary search,
+    so the size of the file depends on the number of users and not on
+    how large their IDs are. The graph is then stored twice in compressed
+    sparse row form, once by follower and once by followed user, as arrays
+    of 64-bit integers: the adjacency list of the user at position i is
+    targets[offsets[i]:offsets[i + 1]], sorted so that edges are found
+    with a binary search. The file is replaced atomically. Returns the
+    number of edges.
+    """
+    out = sorted(set(edges))
+    ids = array('q', sorted(set(id for edge in out for id in edge)))
+    out_offsets, out_targets = _csr(out, ids)
+    in_offsets, in_sources = _csr(sorted((b, a) for a, b in out), ids)
+    tmp = '{}.{}.tmp'.format(path, os.getpid())
+    with open(tmp, 'wb') as f:
+        header = _HEADER.pack(MAGIC, stream_id.encode('ascii'), len(ids),
+                              len(out))
+        f.write(header.ljust(HEADER_SIZE, b'\0'))
+        for a in (ids, out_offsets, out_targets, in_offsets, in_sources):
+            a.tofile(f)
+    os.replace(tmp, path)
+    return len(out)
+
+
+class _Graph(object):
+    # a memory-mapped index file plus the changes applied on top of it
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.version = (stat.st_ino, stat.st_mtime_ns)
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, stream_id, nodes, edges = _HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            raise ValueError('{} is not a follow graph index'.format(path))
+        self.stream_id = stream_id.rstrip(b'\0').decode('ascii')
+        self.nodes = nodes
+        view = memoryview(self.mmap)[HEADER_SIZE:].cast('q')
+        self.ids, view = view[:nodes], view[nodes:]
+        n = nodes + 1
+        self.out_offsets = view[:n]
+        self.out_targets = view[n:n + edges]
+        self.in_offsets = view[n + edges:2 * n + edges]
+        self.in_sources = view[2 * n + edges:2 * n + 2 * edges]
+        self.changes = {}
+        self.out_delta = Counter()
+        self.in_delta = Counter()
+
+    def _index(self, id):
+        # position of a user ID in the index, or None if it has no follows
+        i = bisect_left(self.ids, id)
+        return i if i < self.nodes and self.ids[i] == id else None
+
+    def _base_has(self, a, b):
+        i = self._index(a)
+        if i is None:
+            return False
+        lo, hi = self.out_offsets[i], self.out_offsets[i + 1]
+        i = bisect_left(self.out_targets, b, lo, hi)
+        return i < hi and self.out_targets[i] == b
+
+    def has(self, a, b):
+        present = self.changes.get((a, b))
+        return self._base_has(a, b) if present is None else present
+
+    def _degree(self, offsets, id):
+        i = self._index(id)
+        return 0 if i is None else offsets[i + 1] - offsets[i]
+
+    def followed_count(self, a):
+        return self._degree(self.out_offsets, a) + self.out_delta[a]
+
+    def followers_count(self, b):
+        return self._degree(self.in_offsets, b) + self.in_delta[b]
+
+    def apply(self, a, b, present):
+        if self.has(a, b) != present:
+            delta = 1 if present else -1
+            self.out_delta[a] += delta
+            self.in_delta[b] += delta
+        self.changes[(a, b)] = present
+
+
+class FollowGraph(object):
+    """Answer follow queries from a shared, memory-mapped index.
+
+    The index file at FOLLOW_GRAPH_PATH is built by "flask followgraph
+    build" and mapped read-only by every process, so the operating system
+    keeps a single copy in memory. Follows and unfollows committed since
+    the build are published to a Redis stream, which each process reads at
+    most every FOLLOW_GRAPH_REFRESH_SECONDS; a rebuilt file is picked up at
+    the same time.
+
+    Queries return None when there is no usable index, and callers then
+    fall back to SQL.
+    """
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.graph = None
+        self.last_id = None
+        self.checked = 0
+        self.failed = False
+        os.register_at_fork(after_in_child=self._after_fork)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['follow_graph'] = self
+        self.path = app.config['FOLLOW_GRAPH_PATH']
+        self.stream = app.config['FOLLOW_GRAPH_STREAM']
+        self.stream_maxlen = app.config['FOLLOW_GRAPH_STREAM_MAXLEN']
+        self.refresh_interval = app.config['FOLLOW_GRAPH_REFRESH_SECONDS']
+        self.graph = None
+        self.checked = 0
+
+    def _after_fork(self):
+        self.lock = threading.Lock()
+
+    def _open(self, redis):
+        graph = _Graph(self.path)
+        if redis.xlen(self.stream) >= self.stream_maxlen:
+            oldest = redis.xrange(self.stream, count=1)
+            if oldest and _parse_id(oldest[0][0]) > \
+                    _parse_id(graph.stream_id):
+                raise ValueError('changes since the index was built were '
+                                 'trimmed from the stream, rebuild it')
+        self.graph, self.last_id = graph, graph.stream_id
+
+    def _refresh(self):
+        redis = current_app.redis
+        stat = os.stat(self.path)
+        if self.graph is None or \
+                (stat.st_ino, stat.st_mtime_ns) != self.graph.version:
+            self._open(redis)
+        while True:
+            result = redis.xread({self.stream: self.last_id}, count=1000)
+            if not result:
+                break
+            for entry_id, fields in result[0][1]:
+                self.graph.apply(int(fields[b'follower']),
+                                 int(fields[b'followed']),
+                                 fields[b'present'] == b'1')
+                self.last_id = entry_id
+
+    def _current(self):
+        if not self.path:
+            return None
+        now = time.monotonic()
+        if now - self.checked >= self.refresh_interval:
+            with self.lock:
+                if now - self.checked >= self.refresh_interval:
+                    try:
+                        self._refresh()
+                        self.failed = False
+                    except (OSError, ValueError, RedisError) as e:
+                        # answers could miss recent changes, use SQL instead
+                        self.graph = None
+                        if not self.failed:
+                            current_app.logger.warning(
+                                'Follow graph index unavailable: %s', e)
+                        self.failed = True
+                    self.checked = now
+        return self.graph
+
+    def is_following(self, follower_id, followed_id):
+        graph = self._current()
+        return None if graph is None else graph.has(follower_id, followed_id)
+
+    def following_status(self, follower_id, user_ids):
+        graph = self._current()
+        if graph is None:
+            return None
+        return {user_id: graph.has(follower_id, user_id)
+                for user_id in user_ids}
+
+    def is_mutual(self, a, b):
+        graph = self._current()
+        return None if graph is None else graph.has(a, b) and graph.has(b, a)
+
+    def followers_count(self, user_id):
+        graph = self._current()
+        return None if graph is None else graph.followers_count(user_id)
+
+    def followed_count(self, user_id):
+        graph = self._current()
+        return None if graph is None else graph.followed_count(user_id)
+
+    def publish(self, changes):
+        """Publish committed (follower_id, followed_id, present) changes."""
+        if not self.path or not changes:
+            return
+        graph = self._current()
+        if graph is not None:
+            # this process sees its own changes right away
+            with self.lock:
+                for a, b, present in changes:
+                    graph.apply(a, b, present)
+        try:
+            pipeline = current_app.redis.pipeline(transaction=False)
+            for a, b, present in changes:
+                pipeline.xadd(self.stream, {'follower': a, 'followed': b,
+                                            'present': int(present)},
+                              maxlen=self.stream_maxlen)
+            pipeline.execute()
+        except RedisError as e:
+            current_app.logger.warning(
+                'Follow graph changes not published: %s', e)
+
+    def build_from_database(self):
+        """Build the index file from the followers table."""
+        from app import db
+        from app.models import followers
+        latest = current_app.redis.xrevrange(self.stream, count=1)
+        stream_id = latest[0][0].decode('ascii') if latest else '0-0'
+        edges = db.session.execute(
+            db.select([followers.c.follower_id, followers.c.followed_id]))
+        return build(self.path, ((a, b) for a, b in edges), stream_id)
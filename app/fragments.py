@@ -0,0 +1,37 @@
+from hashlib import md5
+from flask import current_app, g, render_template
+from markupsafe import Markup
+from app import cache
+from app.models import User, Post
+
+
+def post_fragment_key(post, locale):
+    # the fragment shows the author's username and avatar (from the email),
+    # so a profile change leads to new keys and the old fragments expire
+    author = post.author
+    version = md5('{}\n{}'.format(author.username, author.email).encode(
+        'utf-8')).hexdigest()[:12]
+    return 'post:{}:{}:{}'.format(post.id, locale, version)
+
+
+def render_posts(posts):
+    """Return the rendered _post.html of each post.
+
+    Fragments are shared through the cache, so popular posts are rendered
+    once per locale instead of once per page view.
+    """
+    # authors of ORM posts come from the user cache, so that post.author
+    # needs no query (views have theirs); the session only holds weak
+    # references, hence the local variable
+    authors = User.get_cached_many(
+        {post.user_id for post in posts if isinstance(post, Post)})
+    keys = [post_fragment_key(post, g.locale) for post in posts]
+    fragments = cache.get_many(keys)
+    rendered = {}
+    for post, key in zip(posts, keys):
+        if key not in fragments:
+            rendered[key] = fragments[key] = render_template(
+                '_post.html', post=post)
+    if rendered:
+        cache.set_many(rendered, current_app.config['CACHE_FRAGMENT_TTL'])
+    return [Markup(fragments[key]) for key in keys]
@@ -0,0 +1,132 @@
+import re
+import threading
+import time
+from collections import Counter
+from functools import lru_cache
+from flask import current_app, g, has_app_context, has_request_context, \
+    request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app.metrics import observe
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_PARAM = r'(?:\?|%s|%\(\w+\)s|:\w+)'
+_PARAM_LIST = re.compile(r'\(\s*{0}(?:\s*,\s*{0})+\s*\)'.format(_PARAM))
+_SPACE = re.compile(r'\s+')
+
+
+@lru_cache(maxsize=1024)
+def normalize_sql(statement):
+    """Reduce a statement to its shape, without literals and list lengths."""
+    statement = _STRING.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _PARAM_LIST.sub('(?, ...)', statement)
+    return _SPACE.sub(' ', statement).strip()
+
+
+class RequestQueries(object):
+    """Statements issued while handling one request."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.count = 0
+        self.duration = 0.0
+        self.shapes = Counter()
+
+    def add(self, statement, duration):
+        self.count += 1
+        self.duration += duration
+        self.shapes[normalize_sql(statement)] += 1
+
+
+class SQLInstrumentation(object):
+    """Per-request SQL statistics, slow query log and N+1 detection.
+
+    Every request gets a RequestQueries record in g.queries, totals are
+    sent back in a Server-Timing header and accumulated per endpoint.
+    """
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['sql_instrumentation'] = self
+        self.endpoints = {}
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        if not event.contains(Engine, 'before_cursor_execute',
+                              _before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute',
+                         _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute',
+                         _after_cursor_execute)
+            event.listen(Engine, 'handle_error', _handle_error)
+
+    def _before_request(self):
+        g.queries = RequestQueries()
+
+    def _after_request(self, response):
+        queries = g.get('queries')
+        if queries is None:
+            return response
+        elapsed = time.perf_counter() - queries.start
+        endpoint = request.endpoint or 'unknown'
+        threshold = current_app.config['SQL_N_PLUS_ONE_THRESHOLD']
+        for shape, count in queries.shapes.items():
+            if threshold and count >= threshold:
+                current_app.logger.warning(
+                    'Possible N+1 in %s: %d x %s', endpoint, count, shape)
+        if current_app.config['SQL_SERVER_TIMING']:
+            response.headers.add(
+                'Server-Timing', 'db;dur={:.1f};desc="{} queries", '
+                'app;dur={:.1f}'.format(queries.duration * 1000,
+                                        queries.count, elapsed * 1000))
+        with self.lock:
+            stats = self.endpoints.setdefault(endpoint, {
+                'requests': 0, 'statements': 0, 'max_statements': 0,
+                'db_seconds': 0.0, 'seconds': 0.0})
+            stats['requests'] += 1
+            stats['statements'] += queries.count
+            stats['max_statements'] = max(stats['max_statements'],
+                                          queries.count)
+            stats['db_seconds'] += queries.duration
+            stats['seconds'] += elapsed
+        return response
+
+    def endpoint_stats(self):
+        """Return a copy of the per-endpoint totals of this process."""
+        with self.lock:
+            return {endpoint: dict(stats)
+                    for endpoint, stats in self.endpoints.items()}
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context,
+                           executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    duration = time.perf_counter() - conn.info['query_start'].pop()
+    if not has_app_context():
+        return
+    observe('db_query_duration_seconds', duration,
+            operation=statement.split(None, 1)[0].upper())
+    if has_request_context():
+        queries = g.get('queries')
+        if queries is not None:
+            queries.add(statement, duration)
+    if duration >= current_app.config['SQL_SLOW_QUERY_SECONDS']:
+        current_app.logger.warning(
+            'Slow query (%.3fs) in %s: %s', duration,
+            request.endpoint if has_request_context() else 'background',
+            normalize_sql(statement))
+
+
+def _handle_error(exception_context):
+    # after_cursor_execute is not called for failed statements
+    conn = exception_context.connection
+    if conn is not None and conn.info.get('query_start'):
+        conn.info['query_start'].pop()
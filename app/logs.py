@@ -0,0 +1,161 @@
+import atexit
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, SMTPHandler
+from queue import Queue
+from flask import g, request
+from flask.logging import default_handler
+from flask_login import current_user
+
+ACCESS_LOGGER = 'microblog.access'
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, with the fields passed as extra={'json': {}}
+    merged in."""
+    def format(self, record):
+        entry = {
+            'time': datetime.utcfromtimestamp(
+                record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'json', {}))
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class _LoggerFilter(logging.Filter):
+    # passes records of one logger only, or all other records when excluding
+    def __init__(self, name, exclude=False):
+        super().__init__()
+        self.logger_name = name
+        self.exclude = exclude
+
+    def filter(self, record):
+        return (record.name == self.logger_name) != self.exclude
+
+
+class DedupSMTPHandler(SMTPHandler):
+    """SMTP handler that mails each distinct error at most once per interval.
+
+    Errors logged from the same place count as the same error, or for
+    exceptions, the same exception type raised from the same line. Repeats
+    are counted and reported in the next mail sent for them, and no more than
+    max_mails are sent per interval in total.
+    """
+    def __init__(self, *args, interval=600, max_mails=10, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interval = interval
+        self.max_mails = max_mails
+        self.sent = {}
+        self.suppressed = {}
+        self.window_start = 0
+        self.window_mails = 0
+
+    @staticmethod
+    def _key(record):
+        if not record.exc_info or record.exc_info[2] is None:
+            return record.pathname, record.lineno
+        # unhandled exceptions are all logged from one line in Flask, so
+        # tell them apart by where they were raised
+        exc_type, _, tb = record.exc_info
+        while tb.tb_next is not None:
+            tb = tb.tb_next
+        return exc_type, tb.tb_frame.f_code.co_filename, tb.tb_lineno
+
+    def emit(self, record):
+        now = time.time()
+        key = self._key(record)
+        if now - self.sent.get(key, 0) < self.interval:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return
+        if now - self.window_start >= self.interval:
+            self.window_start = now
+            self.window_mails = 0
+        if self.window_mails >= self.max_mails:
+            self.suppressed[key] = self.suppressed.get(key, 0) + 1
+            return
+        self.window_mails += 1
+        self.sent[key] = now
+        suppressed = self.suppressed.pop(key, 0)
+        if suppressed:
+            record = logging.makeLogRecord(record.__dict__)
+            record.msg = '{}\n\n({} more occurrences were not mailed)'.format(
+                record.msg, suppressed)
+        super().emit(record)
+
+
+def start_queue_logging(app, handlers, access_handler=None):
+    """Attach handlers to the application logger through a queue.
+
+    Loggers only put records on the queue, handlers run in a background
+    thread, so writing log files and sending mail never blocks a request.
+    The access log, if given a handler, goes through the same queue.
+    """
+    queue = Queue(-1)
+    queue_handler = QueueHandler(queue)
+    # Flask's own handler writes to stderr from the request thread
+    app.logger.removeHandler(default_handler)
+    app.logger.addHandler(queue_handler)
+    if access_handler is not None:
+        access_handler.addFilter(_LoggerFilter(ACCESS_LOGGER))
+        for handler in handlers:
+            handler.addFilter(_LoggerFilter(ACCESS_LOGGER, exclude=True))
+        handlers = handlers + [access_handler]
+        access_logger = logging.getLogger(ACCESS_LOGGER)
+        access_logger.setLevel(logging.INFO)
+        access_logger.propagate = False
+        access_logger.handlers = [queue_handler]
+        app.after_request(_log_access)
+    listener = QueueListener(queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
+    def restart_after_fork():
+        # the listener thread does not survive a fork (e.g. gunicorn --preload)
+        listener.queue = queue_handler.queue = Queue(-1)
+        listener._thread = None
+        listener.start()
+
+    os.register_at_fork(after_in_child=restart_after_fork)
+    app.extensions['log_listener'] = listener
+    return listener
+
+
+def flush_logs(app):
+    """Wait until queued records are handled.
+
+    Needed before processes that end without running exit handlers, like
+    the work horses RQ forks for each job.
+    """
+    listener = app.extensions.get('log_listener')
+    if listener is not None:
+        listener.queue.join()
+
+
+def _log_access(response):
+    fields = {
+        'method': request.method,
+        'path': request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'bytes': response.calculate_content_length(),
+        'remote_addr': request.remote_addr,
+        'user_id': current_user.get_id(),
+    }
+    queries = g.get('queries')
+    if queries is not None:
+        fields['duration_ms'] = round(
+            (time.perf_counter() - queries.start) * 1000, 2)
+        fields['db_ms'] = round(queries.duration * 1000, 2)
+        fields['db_queries'] = queries.count
+    logging.getLogger(ACCESS_LOGGER).info(
+        '%s %s %s', request.method, request.path, response.status_code,
+        extra={'json': fields})
+    return response
@@ -1,16 +1,22 @@
 from datetime import datetime
 from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app
+    jsonify, current_app, abort
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from langdetect import detect, LangDetectException
 from app import db
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm, \
     MessageForm
-from app.models import User, Post, Message, Notification
+from app.fragments import render_posts
+from app.models import User, Post, Message, Notification, Conversation
+from app.pagination import item_cursor, items_since, keyset_page
 from app.translate import translate
+from app.viewmodels import post_rows, post_views, post_views_by_id, \
+    recent_post_views
 from app.main import bp
 
+# pages assemble their posts from cached fragments
+bp.add_app_template_global(render_posts)
+
 
 @bp.before_app_request
 def before_request():
@@ -27,6 +33,8 @@ def before_request():
 def index():
     form = PostForm()
     if form.validate_on_submit():
+        # imported here, it loads its language profiles on first use
+        from langdetect import detect, LangDetectException
         try:
             language = detect(form.post.data)
         except LangDetectException:
@@ -38,52 +46,96 @@ def index():
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
     page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
+    posts = post_rows(current_user.followed_posts()).paginate(
         page, current_app.config['POSTS_PER_PAGE'], False)
+    items = post_views(posts.items)
     next_url = url_for('main.index', page=posts.next_num) \
         if posts.has_next else None
     prev_url = url_for('main.index', page=posts.prev_num) \
         if posts.has_prev else None
+    # only the first page is kept up to date by polling for new posts
+    since_url = url_for('main.timeline_since') if page == 1 else None
+    newest = max(items, key=lambda p: (p.timestamp, p.id)) \
+        if items else None
+    cursor = item_cursor(newest) if newest else ''
     return render_template('index.html', title=_('Home'), form=form,
-                           posts=posts.items, next_url=next_url,
-                           prev_url=prev_url)
+                           posts=items, next_url=next_url,
+                           prev_url=prev_url, since_url=since_url,
+                           cursor=cursor)
+
+
+@bp.route('/timeline/since')
+@login_required
+def timeline_since():
+    cursor = request.args.get('cursor') or None
+    try:
+        rows, more = items_since(post_rows(current_user.followed_posts()),
+                                 Post, cursor,
+                                 current_app.config['POSTS_PER_PAGE'])
+    except ValueError:
+        abort(400)
+    posts = post_views(rows)
+    return jsonify({
+        'posts': render_posts(posts),
+        'cursor': item_cursor(posts[0]) if posts else cursor,
+        'more': more
+    })
 
 
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
-        if posts.has_prev else None
+    per_page = current_app.config['POSTS_PER_PAGE']
+    cursor = request.args.get('cursor') or None
+    if cursor:
+        # past the shared window of recent posts
+        try:
+            rows, next_cursor = keyset_page(post_rows(Post.query), Post,
+                                            cursor, per_page)
+        except ValueError:
+            abort(400)
+        posts = post_views(rows)
+        next_url = url_for('main.explore', cursor=next_cursor) \
+            if next_cursor else None
+        prev_url = url_for('main.explore')
+    else:
+        page = request.args.get('page', 1, type=int)
+        if page < 1:
+            abort(404)
+        posts, more = recent_post_views(page, per_page)
+        next_url = None
+        if more and page < current_app.config['EXPLORE_CACHE_PAGES']:
+            next_url = url_for('main.explore', page=page + 1)
+        elif more:
+            next_url = url_for('main.explore', cursor=item_cursor(posts[-1]))
+        prev_url = url_for('main.explore', page=page - 1) \
+            if page > 1 else None
     return render_template('index.html', title=_('Explore'),
-                           posts=posts.items, next_url=next_url,
+                           posts=posts, next_url=next_url,
                            prev_url=prev_url)
 
 
 @bp.route('/user/<username>')
 @login_required
 def user(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.get_cached_by_username(username) or abort(404)
     page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
+    posts = post_rows(user.posts.order_by(Post.timestamp.desc())).paginate(
         page, current_app.config['POSTS_PER_PAGE'], False)
     next_url = url_for('main.user', username=user.username,
                        page=posts.next_num) if posts.has_next else None
     prev_url = url_for('main.user', username=user.username,
                        page=posts.prev_num) if posts.has_prev else None
     form = EmptyForm()
-    return render_template('user.html', user=user, posts=posts.items,
+    return render_template('user.html', user=user,
+                           posts=post_views(posts.items),
                            next_url=next_url, prev_url=prev_url, form=form)
 
 
 @bp.route('/user/<username>/popup')
 @login_required
 def user_popup(username):
-    user = User.query.filter_by(username=username).first_or_404()
+    user = User.get_cached_by_username(username) or abort(404)
     form = EmptyForm()
     return render_template('user_popup.html', user=user, form=form)
 
@@ -110,7 +162,7 @@ def edit_profile():
 def follow(username):
     form = EmptyForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=username).first()
+        user = User.get_cached_by_username(username)
         if user is None:
             flash(_('User %(username)s not found.', username=username))
             return redirect(url_for('main.index'))
@@ -130,7 +182,7 @@ def follow(username):
 def unfollow(username):
     form = EmptyForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=username).first()
+        user = User.get_cached_by_username(username)
         if user is None:
             flash(_('User %(username)s not found.', username=username))
             return redirect(url_for('main.index'))
@@ -159,8 +211,9 @@ def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
     page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page,
-                               current_app.config['POSTS_PER_PAGE'])
+    ids, total = Post.search_ids(g.search_form.q.data, page,
+                                current_app.config['POSTS_PER_PAGE'])
+    posts = post_views_by_id(ids) if total else []
     next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
         if total > page * current_app.config['POSTS_PER_PAGE'] else None
     prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
@@ -177,11 +230,12 @@ def send_message(recipient):
     if form.validate_on_submit():
         msg = Message(author=current_user, recipient=user,
                       body=form.message.data)
+        Conversation.between(current_user, user).add_message(msg)
         db.session.add(msg)
         user.add_notification('unread_message_count', user.new_messages())
         db.session.commit()
         flash(_('Your message has been sent.'))
-        return redirect(url_for('main.user', username=recipient))
+        return redirect(url_for('main.conversation', username=recipient))
     return render_template('send_message.html', title=_('Send Message'),
                            form=form, recipient=recipient)
 
@@ -189,18 +243,49 @@ def send_message(recipient):
 @bp.route('/messages')
 @login_required
 def messages():
-    current_user.last_message_read_time = datetime.utcnow()
-    current_user.add_notification('unread_message_count', 0)
-    db.session.commit()
-    page = request.args.get('page', 1, type=int)
-    messages = current_user.messages_received.order_by(
-        Message.timestamp.desc()).paginate(
-            page, current_app.config['POSTS_PER_PAGE'], False)
-    next_url = url_for('main.messages', page=messages.next_num) \
-        if messages.has_next else None
-    prev_url = url_for('main.messages', page=messages.prev_num) \
-        if messages.has_prev else None
-    return render_template('messages.html', messages=messages.items,
+    cursor = request.args.get('cursor') or None
+    try:
+        conversations, next_cursor = keyset_page(
+            current_user.conversations(), Conversation, cursor,
+            current_app.config['POSTS_PER_PAGE'])
+    except ValueError:
+        abort(400)
+    # load the other participants with one query; the list keeps them in
+    # the session, which only holds weak references
+    users = User.query.filter(User.id.in_(
+        {c.user1_id for c in conversations} |
+        {c.user2_id for c in conversations})).all() if conversations else []
+    next_url = url_for('main.messages', cursor=next_cursor) \
+        if next_cursor else None
+    prev_url = url_for('main.messages') if cursor else None
+    return render_template('messages.html', conversations=conversations,
+                           users=users, next_url=next_url, prev_url=prev_url)
+
+
+@bp.route('/messages/<username>')
+@login_required
+def conversation(username):
+    user = User.get_cached_by_username(username) or abort(404)
+    conversation = Conversation.find(current_user, user)
+    if conversation is not None and conversation.unread(current_user):
+        conversation.mark_read(current_user)
+        current_user.add_notification('unread_message_count',
+                                      current_user.new_messages())
+        db.session.commit()
+    cursor = request.args.get('cursor') or None
+    messages, next_cursor = [], None
+    if conversation is not None:
+        try:
+            messages, next_cursor = keyset_page(
+                conversation.messages, Message, cursor,
+                current_app.config['POSTS_PER_PAGE'])
+        except ValueError:
+            abort(400)
+    next_url = url_for('main.conversation', username=username,
+                       cursor=next_cursor) if next_cursor else None
+    prev_url = url_for('main.conversation', username=username) \
+        if cursor else None
+    return render_template('conversation.html', user=user, messages=messages,
                            next_url=next_url, prev_url=prev_url)
 
 
@@ -224,5 +309,6 @@ def notifications():
     return jsonify([{
         'name': n.name,
         'data': n.get_data(),
-        'timestamp': n.timestamp
+        'timestamp': n.timestamp,
+        'version': n.version
     } for n in notifications])
@@ -0,0 +1,320 @@
+import bisect
+import fcntl
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from flask import current_app, g, has_app_context, request, abort
+from redis import Redis, RedisError
+
+# upper bounds in seconds; +Inf is implied
+REQUEST_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+CLIENT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1,
+                  2.5)
+JOB_BUCKETS = (.1, .5, 1, 5, 10, 30, 60, 300, 900, 3600)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'http_requests_total': (
+        'counter', 'HTTP requests by endpoint, method and status.', None),
+    'http_request_duration_seconds': (
+        'histogram', 'HTTP request latency.', REQUEST_BUCKETS),
+    'db_query_duration_seconds': (
+        'histogram', 'SQL statement latency.', CLIENT_BUCKETS),
+    'redis_command_duration_seconds': (
+        'histogram', 'Redis command latency.', CLIENT_BUCKETS),
+    'elasticsearch_request_duration_seconds': (
+        'histogram', 'Elasticsearch request latency.', CLIENT_BUCKETS),
+    'translate_request_duration_seconds': (
+        'histogram', 'Translation service latency.', REQUEST_BUCKETS),
+    'rq_job_duration_seconds': (
+        'histogram', 'Background job duration.', JOB_BUCKETS),
+    'rq_jobs_total': (
+        'counter', 'Background jobs by task and outcome.', None),
+    'cache_requests_total': (
+        'counter', 'Cache lookups by result (local_hit, redis_hit, miss).',
+        None),
+}
+
+
+def observe(name, value, **labels):
+    """Record a value if the current application collects metrics."""
+    if has_app_context():
+        metrics = current_app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.observe(name, value, **labels)
+
+
+def inc(name, value=1, **labels):
+    if has_app_context():
+        metrics = current_app.extensions.get('metrics')
+        if metrics is not None:
+            metrics.inc(name, value, **labels)
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+class TimedRedis(Redis):
+    def execute_command(self, *args, **options):
+        start = time.perf_counter()
+        try:
+            return super().execute_command(*args, **options)
+        finally:
+            observe('redis_command_duration_seconds',
+                    time.perf_counter() - start, command=str(args[0]))
+
+
+@lru_cache(maxsize=None)
+def timed_transport():
+    """Return the Elasticsearch transport class that records durations.
+
+    Defined on first use, so that the client library is only imported when
+    search is configured.
+    """
+    from elasticsearch import Transport
+
+    class TimedTransport(Transport):
+        def perform_request(self, method, url, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return super().perform_request(method, url, *args, **kwargs)
+            finally:
+                observe('elasticsearch_request_duration_seconds',
+                        time.perf_counter() - start, method=method)
+
+    return TimedTransport
+
+
+def timed_job(f):
+    """Record the duration and outcome of a background job."""
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        outcome = 'failed'
+        try:
+            result = f(*args, **kwargs)
+            outcome = 'finished'
+            return result
+        finally:
+            observe('rq_job_duration_seconds', time.perf_counter() - start,
+                    task=f.__name__)
+            inc('rq_jobs_total', task=f.__name__, outcome=outcome)
+            # job processes are short lived, so write out right away
+            metrics = current_app.extensions.get('metrics')
+            if metrics is not None:
+                metrics.flush(force=True)
+    return wrapper
+
+
+def rq_queue_gauges():
+    queue = current_app.task_queue
+    try:
+        series = [({'queue': queue.name, 'state': 'queued'}, queue.count)]
+        for state, registry in (
+                ('started', queue.started_job_registry),
+                ('deferred', queue.deferred_job_registry),
+                ('scheduled', queue.scheduled_job_registry),
+                ('failed', queue.failed_job_registry)):
+            series.append(({'queue': queue.name, 'state': state},
+                           registry.count))
+    except RedisError:
+        return []
+    return [('rq_queue_jobs', 'Background jobs by queue and state.', series)]
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, _escape(v))
+                          for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    """Counters and histograms in Prometheus text format.
+
+    Each process collects values in memory. With METRICS_DIR set, processes
+    periodically add them to a file shared through that directory, so that
+    a scrape of any gunicorn worker sees the totals of all workers, and of
+    RQ jobs run on the same host. Without it, each process reports its own.
+    """
+    def __init__(self, app=None):
+        self.lock = threading.Lock()
+        self.values = {}
+        self.gauges = []
+        self.last_flush = 0
+        # values recorded by a parent process are flushed by the parent
+        os.register_at_fork(after_in_child=self._reset)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['metrics'] = self
+        self.directory = app.config['METRICS_DIR']
+        if self.directory:
+            self.filename = os.path.join(self.directory, 'metrics.json')
+        self.flush_seconds = app.config['METRICS_FLUSH_SECONDS']
+        app.before_request(self._before_request)
+        app.after_request(self._after_request)
+        app.add_url_rule('/metrics', 'metrics', self._metrics_view)
+        self.gauge(rq_queue_gauges)
+
+    def _reset(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def gauge(self, f):
+        """Register a function returning (name, help, [(labels, value)])
+        tuples, evaluated on each scrape."""
+        if f not in self.gauges:
+            self.gauges.append(f)
+        return f
+
+    def observe(self, name, value, **labels):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            data = self.values.get(key)
+            if data is None:
+                # per-bucket counts (the last one is +Inf), sum, count
+                data = self.values[key] = [0] * (len(buckets) + 3)
+            data[bisect.bisect_left(buckets, value)] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def _merge(self, totals, values):
+        for key, data in values.items():
+            if key not in totals:
+                totals[key] = list(data) if isinstance(data, list) else data
+            elif isinstance(data, list):
+                totals[key] = [a + b for a, b in zip(totals[key], data)]
+            else:
+                totals[key] += data
+        return totals
+
+    def _read(self):
+        try:
+            with open(self.filename) as f:
+                return {(name, tuple(tuple(label) for label in labels)): data
+                        for name, labels, data in json.load(f)
+                        if name in METRICS}
+        except (OSError, ValueError):
+            return {}
+
+    def flush(self, force=False):
+        """Add the values collected since the last flush to the shared file.
+
+        The file is updated under an exclusive lock, so that any number of
+        processes can flush concurrently.
+        """
+        if not self.directory or \
+                (not force and time.time() - self.last_flush <
+                 self.flush_seconds):
+            return
+        self.last_flush = time.time()
+        with self.lock:
+            values, self.values = self.values, {}
+        if not values:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.filename + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            totals = self._merge(self._read(), values)
+            tmp = self.filename + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump([[name, labels, data]
+                           for (name, labels), data in totals.items()], f)
+            os.replace(tmp, self.filename)
+
+    def collect(self):
+        """Return the totals of all processes."""
+        if not self.directory:
+            with self.lock:
+                return self._merge({}, self.values)
+        self.flush(force=True)
+        return self._read()
+
+    def render(self):
+        by_name = {}
+        for (name, labels), data in sorted(self.collect().items()):
+            by_name.setdefault(name, []).append((labels, data))
+        lines = []
+        for name, series in by_name.items():
+            kind, help, buckets = METRICS[name]
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, data in series:
+                if kind == 'counter':
+                    lines.append('{}{} {}'.format(
+                        name, _format_labels(labels), _format_value(data)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), data):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        name, _format_labels(
+                            labels + (('le', _format_value(bound)),)),
+                        cumulative))
+                lines.append('{}_sum{} {}'.format(
+                    name, _format_labels(labels), _format_value(data[-2])))
+                lines.append('{}_count{} {}'.format(
+                    name, _format_labels(labels), data[-1]))
+        for f in self.gauges:
+            for name, help, series in f():
+                lines.append('# HELP {} {}'.format(name, help))
+                lines.append('# TYPE {} gauge'.format(name))
+                for labels, value in series:
+                    lines.append('{}{} {}'.format(
+                        name, _format_labels(sorted(labels.items())),
+                        _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _before_request(self):
+        g.request_start = time.perf_counter()
+
+    def _after_request(self, response):
+        start = g.get('request_start')
+        if start is not None and request.endpoint != 'metrics':
+            self.record_request(request.endpoint or 'unknown', request.method,
+                                response.status_code,
+                                time.perf_counter() - start)
+        return response
+
+    def record_request(self, endpoint, method, status, seconds):
+        self.observe('http_request_duration_seconds', seconds,
+                     endpoint=endpoint, method=method)
+        self.inc('http_requests_total', endpoint=endpoint, method=method,
+                 status=status)
+        self.flush()
+
+    def _metrics_view(self):
+        token = current_app.config['METRICS_TOKEN']
+        if token and request.headers.get('Authorization') != \
+                'Bearer ' + token:
+            abort(401)
+        return current_app.response_class(
+            self.render(), mimetype='text/plain; version=0.0.4')
@@ -1,4 +1,5 @@
 import base64
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from hashlib import md5
 import json
@@ -9,22 +10,36 @@ from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 import redis
-import rq
-from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.attributes import set_committed_value
+from app import db, login, cache, follow_graph, recent_posts
+from app.search import add_to_index, add_to_index_bulk, remove_from_index, \
+    query_index
 
 
 class SearchableMixin(object):
+    @classmethod
+    def search_ids(cls, expression, page, per_page):
+        key = 'search:{}:{}:{}:{}'.format(
+            cls.__tablename__, md5(expression.encode('utf-8')).hexdigest(),
+            page, per_page)
+        return cache.get_or_set(
+            key, lambda: query_index(cls.__tablename__, expression, page,
+                                     per_page),
+            ttl=current_app.config['CACHE_SEARCH_TTL'])
+
     @classmethod
     def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
+        ids, total = cls.search_ids(expression, page, per_page)
         if total == 0:
-            return cls.query.filter_by(id=0), 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(
-            db.case(when, value=cls.id)), total
+            return [], 0
+        return cls.hydrate(ids), total
+
+    @classmethod
+    def hydrate(cls, ids):
+        """Return the objects with the given IDs, in the same order."""
+        loaded = {obj.id: obj for obj in cls.query.filter(cls.id.in_(ids))}
+        return [loaded[id] for id in ids if id in loaded]
 
     @classmethod
     def before_commit(cls, session):
@@ -48,21 +63,188 @@ class SearchableMixin(object):
         session._changes = None
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def reindex(cls, batch_size=500):
+        last_id = None
+        while True:
+            query = cls.query.order_by(cls.id)
+            if last_id is not None:
+                query = query.filter(cls.id > last_id)
+            batch = query.limit(batch_size).all()
+            if not batch:
+                break
+            add_to_index_bulk(cls.__tablename__, batch)
+            last_id = batch[-1].id
+
+    @classmethod
+    def reindex_range(cls, first_id, last_id, batch_size=500):
+        indexed = 0
+        while first_id <= last_id:
+            batch = cls.query.filter(cls.id.between(first_id, last_id)) \
+                .order_by(cls.id).limit(batch_size).all()
+            if not batch:
+                break
+            indexed += add_to_index_bulk(cls.__tablename__, batch)
+            first_id = batch[-1].id + 1
+        return indexed
+
+    @classmethod
+    def reindex_ids(cls, ids, batch_size=500):
+        indexed = 0
+        for i in range(0, len(ids), batch_size):
+            batch = cls.query.filter(cls.id.in_(ids[i:i + batch_size])) \
+                .order_by(cls.id).all()
+            if batch:
+                indexed += add_to_index_bulk(cls.__tablename__, batch)
+        return indexed
+
+    @staticmethod
+    @contextmanager
+    def deferred_indexing():
+        """Suspend per-commit indexing, e.g. for the duration of a bulk load.
+
+        Commits made through the session while the context is active only
+        record the IDs of the affected objects. Rows inserted with Core
+        statements, which bypass the session, can be recorded by calling
+        add() on the yielded DeferredIndex. When the context exits normally,
+        the recorded IDs are indexed with bulk requests.
+        """
+        deferred = DeferredIndex()
+        db.event.remove(db.session, 'before_commit',
+                        SearchableMixin.before_commit)
+        db.event.remove(db.session, 'after_commit',
+                        SearchableMixin.after_commit)
+        db.event.listen(db.session, 'after_flush', deferred.after_flush)
+        db.event.listen(db.session, 'after_commit', deferred.after_commit)
+        db.event.listen(db.session, 'after_soft_rollback',
+                        deferred.after_soft_rollback)
+        try:
+            yield deferred
+        finally:
+            db.event.remove(db.session, 'after_flush', deferred.after_flush)
+            db.event.remove(db.session, 'after_commit',
+                            deferred.after_commit)
+            db.event.remove(db.session, 'after_soft_rollback',
+                            deferred.after_soft_rollback)
+            db.event.listen(db.session, 'before_commit',
+                            SearchableMixin.before_commit)
+            db.event.listen(db.session, 'after_commit',
+                            SearchableMixin.after_commit)
+        deferred.flush()
 
 
 db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
 
 
+def id_runs(ids):
+    """Split IDs into sorted (first_id, last_id) runs of consecutive IDs."""
+    runs = []
+    for id in sorted(set(ids)):
+        if runs and id == runs[-1][1] + 1:
+            runs[-1] = (runs[-1][0], id)
+        else:
+            runs.append((id, id))
+    return runs
+
+
+class DeferredIndex(object):
+    """IDs of searchable objects whose indexing has been deferred.
+
+    IDs are kept as exact (first_id, last_id) runs of consecutive IDs per
+    model, so memory use stays small for bulk loads of ascending IDs, while
+    sparse IDs such as those of imported tweets don't pull the rows between
+    them into the index. Runs are merged when ranges is read.
+    """
+    def __init__(self):
+        self._runs = {}
+        self.removed = {}
+        self._pending = []
+
+    @property
+    def ranges(self):
+        """The sorted, merged runs of each model."""
+        for cls, runs in self._runs.items():
+            merged = []
+            for first, last in sorted(runs):
+                if merged and first <= merged[-1][1] + 1:
+                    merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+                else:
+                    merged.append((first, last))
+            self._runs[cls] = merged
+        return self._runs
+
+    def add(self, cls, ids):
+        """Record IDs and return the runs they were split into."""
+        runs = id_runs(ids)
+        self._runs.setdefault(cls, []).extend(runs)
+        return runs
+
+    def add_range(self, cls, first_id, last_id):
+        self._runs.setdefault(cls, []).append((first_id, last_id))
+
+    def after_flush(self, session, flush_context):
+        for obj in list(session.new) + list(session.dirty) + \
+                list(session.deleted):
+            if isinstance(obj, SearchableMixin):
+                self._pending.append((type(obj), obj.id,
+                                      obj in session.deleted))
+
+    def after_commit(self, session):
+        for cls, id, deleted in self._pending:
+            if deleted:
+                self.removed.setdefault(cls, set()).add(id)
+            else:
+                self.add_range(cls, id, id)
+        self._pending = []
+
+    def after_soft_rollback(self, session, previous_transaction):
+        self._pending = []
+
+    def flush(self, batch_size=500):
+        """Index the recorded runs and clear them."""
+        indexed = 0
+        if current_app.elasticsearch:
+            for cls, ids in self.removed.items():
+                for id in ids:
+                    remove_from_index(cls.__tablename__, cls(id=id))
+            # runs are read back from the database, so IDs that have been
+            # deleted in the meantime are not indexed again. Short runs are
+            # read together by ID, long ones by range
+            for cls, runs in self.ranges.items():
+                ids = []
+                for first_id, last_id in runs:
+                    if last_id - first_id < batch_size:
+                        ids.extend(range(first_id, last_id + 1))
+                    else:
+                        indexed += cls.reindex_range(first_id, last_id,
+                                                     batch_size)
+                indexed += cls.reindex_ids(ids, batch_size)
+        self._runs = {}
+        self.removed = {}
+        return indexed
+
+
 class PaginatedAPIMixin(object):
-    @staticmethod
-    def to_collection_dict(query, page, per_page, endpoint, **kwargs):
+    @classmethod
+    def items_to_dict(cls, items, viewer=None):
+        """Return the representations of items, as seen by viewer."""
+        return [item.to_dict() for item in items]
+
+    @classmethod
+    def to_collection_dict(cls, query, page, per_page, endpoint, viewer=None,
+                           **kwargs):
         resources = query.paginate(page, per_page, False)
+        return cls.page_to_dict(cls.items_to_dict(resources.items, viewer),
+                                resources, page, per_page, endpoint, **kwargs)
+
+    @staticmethod
+    def page_to_dict(items, resources, page, per_page, endpoint, **kwargs):
+        """Return the collection of the Pagination resources.
+
+        items are the representations of resources.items.
+        """
         data = {
-            'items': [item.to_dict() for item in resources.items],
+            'items': items,
             '_meta': {
                 'page': page,
                 'per_page': per_page,
@@ -80,6 +262,47 @@ class PaginatedAPIMixin(object):
         }
         return data
 
+    @classmethod
+    def to_cursor_collection_dict(cls, items, cursor, per_page, next_cursor,
+                                  endpoint, viewer=None, **kwargs):
+        data = {
+            'items': cls.items_to_dict(items, viewer),
+            '_meta': {
+                'per_page': per_page,
+                'cursor': cursor,
+                'next_cursor': next_cursor
+            },
+            '_links': {
+                'self': url_for(endpoint, cursor=cursor, per_page=per_page,
+                                **kwargs),
+                'next': url_for(endpoint, cursor=next_cursor,
+                                per_page=per_page, **kwargs)
+                if next_cursor else None
+            }
+        }
+        return data
+
+
+def _from_cache(cls, data, relationship=None, value=None):
+    """Return an object of cls in the session for cached column values.
+
+    An object that the session already holds, such as current_user, is
+    returned unchanged, as it may be fresher than the cache or have pending
+    changes. Otherwise one is added without a query, with relationship set
+    to value; the session only holds weak references, so this also keeps
+    the related object in it.
+    """
+    key = db.session.identity_key(cls, data['id'])
+    obj = db.session.identity_map.get(key)
+    if obj is not None:
+        return obj
+    obj = cls(**data)
+    db.make_transient_to_detached(obj)
+    obj = db.session.merge(obj, load=False)
+    if relationship is not None:
+        set_committed_value(obj, relationship, value)
+    return obj
+
 
 followers = db.Table(
     'followers',
@@ -90,7 +313,10 @@ followers = db.Table(
 
 class User(UserMixin, PaginatedAPIMixin, db.Model):
     id = db.Column(db.BigInteger, primary_key=True)
-    username = db.Column(db.String(64), index=True, unique=True)
+    # the previous username is needed to invalidate cache entries keyed on it
+    username = db.column_property(
+        db.Column(db.String(64), index=True, unique=True),
+        active_history=True)
     email = db.Column(db.String(120), index=True, unique=True)
     password_hash = db.Column(db.String(128))
     posts = db.relationship('Post', backref='author', lazy='dynamic')
@@ -118,6 +344,108 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
     def __repr__(self):
         return '<User {}>'.format(self.username)
 
+    # columns left out of cached users, loaded from the database when used
+    _uncached = ('password_hash', 'token', 'token_expiration')
+    # changes to these columns invalidate cached users, last_seen doesn't
+    _cache_columns = ('username', 'email', 'about_me')
+
+    @staticmethod
+    def _cache_data(user):
+        return {column.name: getattr(user, column.name)
+                for column in User.__table__.columns
+                if column.name not in User._uncached}
+
+    @staticmethod
+    def _cached(key, query):
+        def load():
+            user = query.first()
+            return None if user is None else User._cache_data(user)
+
+        data = cache.get_or_set(
+            key, load, ttl=current_app.config['CACHE_USER_TTL'],
+            negative_ttl=current_app.config['CACHE_NEGATIVE_TTL'])
+        return None if data is None else _from_cache(User, data)
+
+    @staticmethod
+    def get_cached(id):
+        """Return the user with the given ID, from the cache if possible."""
+        return User._cached('user:id:{}'.format(id),
+                            User.query.filter_by(id=id))
+
+    @staticmethod
+    def get_cached_data_many(ids):
+        """Return a dictionary with the cached column values of users.
+
+        Cached users are read with one multi-get and the others with one
+        query, and then cached.
+        """
+        keys = {id: 'user:id:{}'.format(id) for id in ids if id is not None}
+        found = cache.get_many(list(keys.values()))
+        missing = [id for id, key in keys.items() if key not in found]
+        if missing:
+            loaded = {keys[id]: data for id, data in
+                      User.load_cache_data(db.session, missing).items()}
+            cache.set_many(loaded, current_app.config['CACHE_USER_TTL'])
+            found.update(loaded)
+        return {id: found[key] for id, key in keys.items()
+                if found.get(key) is not None}
+
+    @staticmethod
+    def load_cache_data(session, ids):
+        """Read the column values of users that are cached with session."""
+        columns = [column for column in User.__table__.columns
+                   if column.name not in User._uncached]
+        return {row.id: dict(row._mapping)
+                for row in session.query(*columns).filter(User.id.in_(ids))}
+
+    @staticmethod
+    def get_cached_many(ids):
+        """Return a dictionary with the users with the given IDs."""
+        return {id: _from_cache(User, data)
+                for id, data in User.get_cached_data_many(ids).items()}
+
+    @staticmethod
+    def get_cached_by_username(username):
+        return User._cached('user:username:' + username,
+                            User.query.filter_by(username=username))
+
+    @staticmethod
+    def _cache_keys(session):
+        keys = session.info.setdefault('cache_invalidations', set())
+        for obj in session.new | session.dirty | session.deleted:
+            if not isinstance(obj, User):
+                continue
+            if obj in session.dirty and not any(
+                    db.inspect(obj).attrs[column].history.has_changes()
+                    for column in User._cache_columns):
+                continue
+            keys.add('user:id:{}'.format(obj.id))
+            history = db.inspect(obj).attrs.username.history
+            for username in history.sum():
+                keys.add('user:username:{}'.format(username))
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        User._cache_keys(session)
+
+    @staticmethod
+    def after_commit(session):
+        keys = session.info.pop('cache_invalidations', None)
+        if keys:
+            cache.delete(*keys)
+        changes = session.info.pop('follow_changes', None)
+        if changes:
+            # the identity gives the ids without loading expired objects
+            follow_graph.publish([
+                (db.inspect(follower).identity[0],
+                 db.inspect(followed).identity[0], present)
+                for follower, followed, present in changes])
+
+    @staticmethod
+    def after_soft_rollback(session, previous_transaction):
+        session.info.pop('cache_invalidations', None)
+        session.info.pop('follow_changes', None)
+
     def set_password(self, password):
         self.password_hash = generate_password_hash(password)
 
@@ -130,23 +458,74 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
             digest, size)
 
     def follow(self, user):
-        if not self.is_following(user):
+        # the follow graph index can lag behind, so writes check the
+        # database itself, or a row could be inserted twice
+        if not self._follows_in_database(user):
             self.followed.append(user)
+            db.session.info.setdefault('follow_changes', []).append(
+                (self, user, True))
 
     def unfollow(self, user):
-        if self.is_following(user):
+        if self._follows_in_database(user):
             self.followed.remove(user)
+            db.session.info.setdefault('follow_changes', []).append(
+                (self, user, False))
 
-    def is_following(self, user):
+    def _follows_in_database(self, user):
         return self.followed.filter(
             followers.c.followed_id == user.id).count() > 0
 
+    def is_following(self, user):
+        # changes not committed yet are not in the follow graph index
+        for follower, followed, present in reversed(
+                db.session.info.get('follow_changes', ())):
+            if follower is self and followed is user:
+                return present
+        following = follow_graph.is_following(self.id, user.id)
+        if following is None:
+            return self._follows_in_database(user)
+        return following
+
+    def following_status(self, user_ids):
+        """Return a dictionary telling for each user ID if it is followed.
+
+        Resolves all of them at once, from the follow graph index or with a
+        single query, for pages and API responses listing many users.
+        """
+        user_ids = set(user_ids)
+        status = follow_graph.following_status(self.id, user_ids)
+        if status is None:
+            followed = set(row[0] for row in db.session.query(
+                followers.c.followed_id).filter(
+                    followers.c.follower_id == self.id,
+                    followers.c.followed_id.in_(user_ids))) \
+                if user_ids else set()
+            status = {user_id: user_id in followed for user_id in user_ids}
+        for follower, followed, present in db.session.info.get(
+                'follow_changes', ()):
+            if follower is self and followed.id in status:
+                status[followed.id] = present
+        return status
+
+    def is_mutual_follow(self, user):
+        mutual = follow_graph.is_mutual(self.id, user.id)
+        if mutual is None:
+            return self.is_following(user) and user.is_following(self)
+        return mutual
+
+    def post_count(self):
+        return self.posts.count()
+
+    def followers_count(self):
+        count = follow_graph.followers_count(self.id)
+        return self.followers.count() if count is None else count
+
+    def followed_count(self):
+        count = follow_graph.followed_count(self.id)
+        return self.followed.count() if count is None else count
+
     def followed_posts(self):
-        followed = Post.query.join(
-            followers, (followers.c.followed_id == Post.user_id)).filter(
-                followers.c.follower_id == self.id)
-        own = Post.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Post.timestamp.desc())
+        return Post.timeline_of(self.id)
 
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
@@ -163,15 +542,27 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         return User.query.get(id)
 
     def new_messages(self):
-        last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
-        return Message.query.filter_by(recipient=self).filter(
-            Message.timestamp > last_read_time).count()
+        # sums one counter per conversation instead of counting messages
+        return db.session.query(db.func.coalesce(db.func.sum(db.case(
+            (Conversation.user1_id == self.id, Conversation.user1_unread),
+            else_=Conversation.user2_unread)), 0)).filter(db.or_(
+                Conversation.user1_id == self.id,
+                Conversation.user2_id == self.id)).scalar()
+
+    def conversations(self):
+        # one branch per participant column, so each can use its index
+        return Conversation.query.filter(
+            Conversation.user1_id == self.id).union_all(
+                Conversation.query.filter(
+                    Conversation.user2_id == self.id,
+                    Conversation.user1_id != self.id))
 
     def add_notification(self, name, data):
-        self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
-        db.session.add(n)
-        return n
+        """Set the notification with the given name when committing.
+
+        Only the last data set for a name in a transaction is written.
+        """
+        db.session.info.setdefault('notifications', {})[(self, name)] = data
 
     def launch_task(self, name, description, *args, **kwargs):
         rq_job = current_app.task_queue.enqueue('app.tasks.' + name, self.id,
@@ -188,16 +579,16 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         return Task.query.filter_by(name=name, user=self,
                                     complete=False).first()
 
-    def to_dict(self, include_email=False):
+    def to_dict(self, include_email=False, is_followed_by_me=None):
         data = {
             'id': self.id,
             'username': self.username,
             'last_seen': self.last_seen.isoformat() + 'Z',
             'about_me': self.about_me,
             'aws_cognito_uid': self.aws_cognito_uid,
-            'post_count': self.posts.count(),
-            'follower_count': self.followers.count(),
-            'followed_count': self.followed.count(),
+            'post_count': self.post_count(),
+            'follower_count': self.followers_count(),
+            'followed_count': self.followed_count(),
             '_links': {
                 'self': url_for('api.get_user', id=self.id),
                 'followers': url_for('api.get_followers', id=self.id),
@@ -207,8 +598,17 @@ class User(UserMixin, PaginatedAPIMixin, db.Model):
         }
         if include_email:
             data['email'] = self.email
+        if is_followed_by_me is not None:
+            data['is_followed_by_me'] = is_followed_by_me
         return data
 
+    @classmethod
+    def items_to_dict(cls, items, viewer=None):
+        status = viewer.following_status(user.id for user in items) \
+            if viewer is not None else {}
+        return [user.to_dict(is_followed_by_me=status.get(user.id))
+                for user in items]
+
     def from_dict(self, data, new_user=False):
         for field in ['username', 'email', 'about_me']:
             if field in data:
@@ -241,7 +641,12 @@ def load_user(id):
     return User.query.get(int(id))
 
 
-class Post(SearchableMixin, db.Model):
+db.event.listen(db.session, 'after_flush', User.after_flush)
+db.event.listen(db.session, 'after_commit', User.after_commit)
+db.event.listen(db.session, 'after_soft_rollback', User.after_soft_rollback)
+
+
+class Post(SearchableMixin, PaginatedAPIMixin, db.Model):
     __searchable__ = ['body']
     id = db.Column(db.BigInteger, primary_key=True)
     body = db.Column(db.String(140))
@@ -252,11 +657,189 @@ class Post(SearchableMixin, db.Model):
     def __repr__(self):
         return '<Post {}>'.format(self.body)
 
+    @staticmethod
+    def timeline_of(user_id, query=None):
+        """Return the posts of user_id and of the users they follow.
+
+        query is the Post query to start from, Post.query by default.
+        """
+        query = Post.query if query is None else query
+        followed = query.join(
+            followers, (followers.c.followed_id == Post.user_id)).filter(
+                followers.c.follower_id == user_id)
+        own = query.filter_by(user_id=user_id)
+        return followed.union(own).order_by(Post.timestamp.desc())
+
+    @staticmethod
+    def get_cached_data(ids):
+        """Return the column values of the posts with the given IDs.
+
+        The result is a list in the order of the IDs, which leaves out posts
+        that don't exist. Cached posts are read with one multi-get and the
+        others with one query, and then cached.
+        """
+        keys = ['post:id:{}'.format(id) for id in ids]
+        found = cache.get_many(keys)
+        missing = [id for id, key in zip(ids, keys) if key not in found]
+        if missing:
+            loaded = {'post:id:{}'.format(row.id): dict(row._mapping)
+                      for row in db.session.query(
+                          *Post.__table__.columns).filter(
+                              Post.id.in_(missing))}
+            cache.set_many(loaded, current_app.config['CACHE_POST_TTL'])
+            found.update(loaded)
+        return [found[key] for key in keys if key in found]
+
+    @classmethod
+    def hydrate(cls, ids):
+        """Return the posts with the given IDs, in the same order.
+
+        Authors are loaded as well, both through the cache.
+        """
+        rows = Post.get_cached_data(ids)
+        authors = User.get_cached_many({data['user_id'] for data in rows})
+        return [_from_cache(Post, data, 'author', authors.get(data['user_id']))
+                for data in rows]
+
+    @staticmethod
+    def after_flush(session, flush_context):
+        added = [(obj.id, obj.timestamp) for obj in session.new
+                 if isinstance(obj, Post)]
+        removed = [obj.id for obj in session.deleted if isinstance(obj, Post)]
+        # deleted together with the user keys in User.after_commit()
+        session.info.setdefault('cache_invalidations', set()).update(
+            'post:id:{}'.format(obj.id)
+            for obj in session.dirty | session.deleted
+            if isinstance(obj, Post))
+        if added:
+            session.info.setdefault('recent_posts_added', []).extend(added)
+        if removed:
+            session.info.setdefault('recent_posts_removed', []).extend(
+                removed)
+
+    @staticmethod
+    def after_commit(session):
+        added = session.info.pop('recent_posts_added', None)
+        removed = session.info.pop('recent_posts_removed', None)
+        if added or removed:
+            recent_posts.update(added or (), removed or ())
+
+    @staticmethod
+    def after_soft_rollback(session, previous_transaction):
+        session.info.pop('recent_posts_added', None)
+        session.info.pop('recent_posts_removed', None)
+
+    def to_dict(self):
+        data = {
+            'id': self.id,
+            'body': self.body,
+            'timestamp': self.timestamp.isoformat() + 'Z',
+            'language': self.language,
+            'author': {
+                'id': self.author.id,
+                'username': self.author.username
+            },
+            '_links': {
+                'self': url_for('api.get_post', id=self.id),
+                'author': url_for('api.get_user', id=self.user_id),
+                'avatar': self.author.avatar(70)
+            }
+        }
+        return data
+
+
+db.event.listen(db.session, 'after_flush', Post.after_flush)
+db.event.listen(db.session, 'after_commit', Post.after_commit)
+db.event.listen(db.session, 'after_soft_rollback', Post.after_soft_rollback)
+
+
+class Conversation(db.Model):
+    """The private messages exchanged by a pair of users.
+
+    user1_id is the lower of the two user IDs, so that each pair has a
+    single conversation. The time of the last message and the number of
+    messages each participant has not read are maintained as messages are
+    added.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('user1_id', 'user2_id'),
+        db.Index('ix_conversation_user1_last_message_at',
+                 'user1_id', 'last_message_at'),
+        db.Index('ix_conversation_user2_last_message_at',
+                 'user2_id', 'last_message_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user1_id = db.Column(db.BigInteger, db.ForeignKey('user.id'),
+                         nullable=False)
+    user2_id = db.Column(db.BigInteger, db.ForeignKey('user.id'),
+                         nullable=False)
+    last_message_at = db.Column(db.DateTime, nullable=False,
+                                default=datetime.utcnow)
+    user1_unread = db.Column(db.Integer, nullable=False, default=0)
+    user2_unread = db.Column(db.Integer, nullable=False, default=0)
+    user1 = db.relationship('User', foreign_keys=[user1_id])
+    user2 = db.relationship('User', foreign_keys=[user2_id])
+    messages = db.relationship('Message', backref='conversation',
+                               lazy='dynamic')
+    # the keyset pagination helpers order by timestamp
+    timestamp = db.synonym('last_message_at')
+
+    def __repr__(self):
+        return '<Conversation {} {}>'.format(self.user1_id, self.user2_id)
+
+    @staticmethod
+    def find(user, other):
+        user1_id, user2_id = sorted((user.id, other.id))
+        return Conversation.query.filter_by(
+            user1_id=user1_id, user2_id=user2_id).first()
+
+    @staticmethod
+    def between(user, other):
+        """Return the conversation of two users, creating it if needed."""
+        conversation = Conversation.find(user, other)
+        if conversation is None:
+            user1_id, user2_id = sorted((user.id, other.id))
+            try:
+                with db.session.begin_nested():
+                    conversation = Conversation(user1_id=user1_id,
+                                                user2_id=user2_id)
+                    db.session.add(conversation)
+            except IntegrityError:
+                # created at the same time by another request
+                conversation = Conversation.query.filter_by(
+                    user1_id=user1_id, user2_id=user2_id).one()
+        return conversation
+
+    def other(self, user):
+        return self.user2 if user.id == self.user1_id else self.user1
+
+    def _unread_column(self, user):
+        return 'user1_unread' if user.id == self.user1_id else 'user2_unread'
+
+    def unread(self, user):
+        return getattr(self, self._unread_column(user))
+
+    def add_message(self, message):
+        message.conversation = self
+        message.timestamp = message.timestamp or datetime.utcnow()
+        self.last_message_at = message.timestamp
+        column = self._unread_column(message.recipient)
+        # incremented by the database, so concurrent messages are all counted
+        setattr(self, column, getattr(Conversation, column) + 1)
+
+    def mark_read(self, user):
+        setattr(self, self._unread_column(user), 0)
+
 
 class Message(db.Model):
+    __table_args__ = (
+        db.Index('ix_message_conversation_id_timestamp',
+                 'conversation_id', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.BigInteger, db.ForeignKey('user.id'))
     recipient_id = db.Column(db.BigInteger, db.ForeignKey('user.id'))
+    conversation_id = db.Column(db.Integer, db.ForeignKey('conversation.id'))
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
 
@@ -265,15 +848,87 @@ class Message(db.Model):
 
 
 class Notification(db.Model):
+    """The latest state of one kind of notification for a user.
+
+    There is a single row per user and name, updated in place, and version
+    counts its updates.
+    """
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'name',
+                            name='uq_notification_user_id_name'),
+        db.Index('ix_notification_user_id_timestamp', 'user_id', 'timestamp'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True)
     user_id = db.Column(db.BigInteger, db.ForeignKey('user.id'))
     timestamp = db.Column(db.Float, index=True, default=time)
     payload_json = db.Column(db.Text)
+    version = db.Column(db.Integer, nullable=False, default=1)
 
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    @staticmethod
+    def upsert(session, user_id, name, data):
+        table = Notification.__table__
+        values = {'payload_json': json.dumps(data), 'timestamp': time()}
+        update = table.update().where(
+            table.c.user_id == user_id, table.c.name == name).values(
+                version=table.c.version + 1, **values)
+        if session.execute(update).rowcount:
+            return
+        try:
+            with session.begin_nested():
+                session.execute(table.insert().values(
+                    user_id=user_id, name=name, version=1, **values))
+        except IntegrityError:
+            # inserted by a concurrent transaction in the meantime
+            session.execute(update)
+
+    @staticmethod
+    def before_commit(session):
+        pending = session.info.pop('notifications', None)
+        if pending:
+            # users created in this transaction need their IDs
+            session.flush()
+            for (user, name), data in pending.items():
+                # the identity gives the ID without loading an expired user
+                Notification.upsert(session, db.inspect(user).identity[0],
+                                    name, data)
+
+    @staticmethod
+    def after_soft_rollback(session, previous_transaction):
+        session.info.pop('notifications', None)
+
+    @staticmethod
+    def compact(older_than, batch_size=1000):
+        """Delete notifications not updated for older_than seconds.
+
+        Rows are deleted batch_size at a time, each batch in its own
+        transaction, so that locks are held briefly. Returns the number of
+        deleted rows.
+        """
+        cutoff = time() - older_than
+        deleted = 0
+        while True:
+            ids = [row[0] for row in db.session.query(Notification.id).filter(
+                Notification.timestamp < cutoff).order_by(
+                    Notification.id).limit(batch_size)]
+            if not ids:
+                break
+            Notification.query.filter(Notification.id.in_(ids)).delete(
+                synchronize_session=False)
+            db.session.commit()
+            deleted += len(ids)
+            if len(ids) < batch_size:
+                break
+        return deleted
+
+
+db.event.listen(db.session, 'before_commit', Notification.before_commit)
+db.event.listen(db.session, 'after_soft_rollback',
+                Notification.after_soft_rollback)
+
 
 class Task(db.Model):
     id = db.Column(db.String(36), primary_key=True)
@@ -283,6 +938,7 @@ class Task(db.Model):
     complete = db.Column(db.Boolean, default=False)
 
     def get_rq_job(self):
+        import rq
         try:
             rq_job = rq.job.Job.fetch(self.id, connection=current_app.redis)
         except (redis.exceptions.RedisError, rq.exceptions.NoSuchJobError):
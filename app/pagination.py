@@ -0,0 +1,85 @@
+import base64
+import binascii
+from datetime import datetime
+from app import db
+
+
+def encode_cursor(timestamp, id):
+    """Encode the (timestamp, id) position of an item as an opaque token."""
+    raw = '{}|{}'.format(timestamp.isoformat(), id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a token produced by encode_cursor().
+
+    Raises ValueError if the token is malformed.
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        timestamp, id = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(id)
+    except (binascii.Error, UnicodeError, ValueError) as e:
+        raise ValueError('invalid cursor') from e
+
+
+def item_cursor(item):
+    return encode_cursor(item.timestamp, item.id)
+
+
+def newest_first(query, model):
+    """Order a query by (timestamp, id) descending, the keyset order."""
+    return query.order_by(None).order_by(model.timestamp.desc(),
+                                         model.id.desc())
+
+
+def oldest_first(query, model):
+    return query.order_by(None).order_by(model.timestamp.asc(),
+                                         model.id.asc())
+
+
+def older_than(query, model, cursor):
+    timestamp, id = decode_cursor(cursor)
+    return query.filter(db.or_(
+        model.timestamp < timestamp,
+        db.and_(model.timestamp == timestamp, model.id < id)))
+
+
+def newer_than(query, model, cursor):
+    timestamp, id = decode_cursor(cursor)
+    return query.filter(db.or_(
+        model.timestamp > timestamp,
+        db.and_(model.timestamp == timestamp, model.id > id)))
+
+
+def keyset_page(query, model, cursor, per_page):
+    """Return one page of items older than cursor, newest first.
+
+    The result is a tuple (items, next_cursor), where next_cursor is None on
+    the last page. Raises ValueError if cursor is malformed.
+    """
+    query = newest_first(query, model)
+    if cursor:
+        query = older_than(query, model, cursor)
+    items = query.limit(per_page + 1).all()
+    next_cursor = item_cursor(items[per_page - 1]) \
+        if len(items) > per_page else None
+    return items[:per_page], next_cursor
+
+
+def items_since(query, model, cursor, limit):
+    """Return up to limit items newer than cursor, newest first.
+
+    The items are the oldest ones after cursor, so that a client which
+    moves its cursor to the first item and asks again while more is True
+    sees every new item. Without a cursor the newest items are returned.
+    The result is a tuple (items, more), where more is True if there were
+    additional new items beyond the limit. Raises ValueError if cursor is
+    malformed.
+    """
+    if not cursor:
+        items = newest_first(query, model).limit(limit + 1).all()
+        return items[:limit], len(items) > limit
+    query = newer_than(oldest_first(query, model), model, cursor)
+    items = query.limit(limit + 1).all()
+    return items[:limit][::-1], len(items) > limit
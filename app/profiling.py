@@ -0,0 +1,230 @@
+import cProfile
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from functools import wraps
+from urllib.parse import parse_qs
+from flask import current_app
+import jwt
+
+_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]+')
+
+
+def generate_profile_token(admin, expires_in=3600, secret_key=None):
+    """Return a token that makes the requests carrying it get profiled."""
+    return jwt.encode({'profile': admin, 'exp': time.time() + expires_in},
+                      secret_key or current_app.config['SECRET_KEY'],
+                      algorithm='HS256')
+
+
+def verify_profile_token(token, secret_key):
+    try:
+        return jwt.decode(token, secret_key, algorithms=['HS256'])['profile']
+    except Exception:
+        return None
+
+
+class StackSampler(object):
+    """Record the stack of one thread at a fixed interval.
+
+    The result is in the collapsed format used by flamegraph tools: one line
+    per distinct stack, frames separated by semicolons, followed by the
+    number of samples.
+    """
+    def __init__(self, interval=0.005, thread_id=None):
+        self.interval = interval
+        self.thread_id = thread_id or threading.get_ident()
+        self.stacks = Counter()
+        self.labels = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            filename = code.co_filename
+            for path in sorted(sys.path, key=len, reverse=True):
+                if path and filename.startswith(path + os.sep):
+                    filename = filename[len(path) + 1:]
+                    break
+            label = self.labels[code] = '{} ({}:{})'.format(
+                code.co_name, filename, code.co_firstlineno)
+        return label
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(self._label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def collapsed(self):
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in self.stacks.most_common())
+
+
+class Profile(object):
+    """Profile a block of code with cProfile and a stack sampler at once.
+
+    save() writes <name>.prof (pstats), <name>.collapsed (flamegraph input)
+    and <name>.json (what was profiled) to the profile directory.
+    """
+    def __init__(self, directory, interval, keep):
+        self.directory = directory
+        self.interval = interval
+        self.keep = keep
+
+    def __enter__(self):
+        self.sampler = StackSampler(self.interval)
+        self.profiler = cProfile.Profile()
+        self.start = time.perf_counter()
+        self.sampler.start()
+        self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.disable()
+        self.sampler.stop()
+        self.duration = time.perf_counter() - self.start
+
+    def save(self, label, **info):
+        os.makedirs(self.directory, exist_ok=True)
+        now = datetime.utcnow()
+        name = '{:%Y%m%d-%H%M%S}-{}-{}'.format(
+            now, _UNSAFE.sub('_', label).strip('_')[:60], uuid.uuid4().hex[:6])
+        path = os.path.join(self.directory, name)
+        self.profiler.dump_stats(path + '.prof')
+        with open(path + '.collapsed', 'w') as f:
+            f.write(self.sampler.collapsed())
+        info.update({'name': name, 'label': label,
+                     'timestamp': now.isoformat() + 'Z',
+                     'duration': self.duration,
+                     'samples': sum(self.sampler.stacks.values())})
+        with open(path + '.json', 'w') as f:
+            json.dump(info, f)
+        _prune(self.directory, self.keep)
+        return name
+
+
+def _prune(directory, keep):
+    names = sorted(filename[:-5] for filename in os.listdir(directory)
+                   if filename.endswith('.json'))
+    for name in names[:-keep] if keep else []:
+        for ext in ('.json', '.prof', '.collapsed'):
+            try:
+                os.remove(os.path.join(directory, name + ext))
+            except OSError:
+                pass
+
+
+def latest_profiles(directory, limit=50):
+    """Return the metadata of the newest profiles, newest first."""
+    if not directory or not os.path.isdir(directory):
+        return []
+    profiles = []
+    names = sorted((filename for filename in os.listdir(directory)
+                    if filename.endswith('.json')), reverse=True)
+    for filename in names[:limit]:
+        try:
+            with open(os.path.join(directory, filename)) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return profiles
+
+
+class ProfilingMiddleware(object):
+    """WSGI middleware profiling selected requests.
+
+    A request is profiled when it carries a valid profile token, issued to
+    admins on the profiles page, in the X-Profile header or the profile
+    query string argument, or when it is picked at PROFILE_SAMPLE_RATE.
+    """
+    def __init__(self, wsgi_app, app):
+        self.wsgi_app = wsgi_app
+        self.config = app.config
+
+    def _trigger(self, environ):
+        token = environ.get('HTTP_X_PROFILE') or \
+            parse_qs(environ.get('QUERY_STRING', '')).get('profile', [None])[0]
+        if token:
+            admin = verify_profile_token(token, self.config['SECRET_KEY'])
+            if admin:
+                return {'trigger': 'token', 'admin': admin}
+        rate = self.config['PROFILE_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            return {'trigger': 'sample'}
+
+    def __call__(self, environ, start_response):
+        if not self.config['PROFILE_DIR']:
+            return self.wsgi_app(environ, start_response)
+        info = self._trigger(environ)
+        if info is None:
+            return self.wsgi_app(environ, start_response)
+        status = []
+
+        def profiled_start_response(status_line, headers, exc_info=None):
+            status.append(int(status_line.split(None, 1)[0]))
+            return start_response(status_line, headers, exc_info)
+
+        with Profile(self.config['PROFILE_DIR'],
+                     self.config['PROFILE_SAMPLE_INTERVAL'],
+                     self.config['PROFILE_KEEP']) as profile:
+            response = self.wsgi_app(environ, profiled_start_response)
+            try:
+                # the response body is generated while iterating over it
+                body = list(response)
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+        method, path = environ['REQUEST_METHOD'], environ.get('PATH_INFO')
+        profile.save('{} {}'.format(method, path), kind='request',
+                     method=method, path=path,
+                     status=status[0] if status else None, **info)
+        return body
+
+
+def profiled_job(f):
+    """Profile a background job when requested or sampled.
+
+    A job is profiled when it was enqueued with meta={'profile': True} or
+    when it is picked at PROFILE_JOB_SAMPLE_RATE.
+    """
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        from rq import get_current_job
+        config = current_app.config
+        job = get_current_job()
+        requested = job is not None and job.meta.get('profile')
+        rate = config['PROFILE_JOB_SAMPLE_RATE']
+        if not config['PROFILE_DIR'] or not (
+                requested or (rate and random.random() < rate)):
+            return f(*args, **kwargs)
+        profile = Profile(config['PROFILE_DIR'],
+                          config['PROFILE_SAMPLE_INTERVAL'],
+                          config['PROFILE_KEEP'])
+        try:
+            with profile:
+                return f(*args, **kwargs)
+        finally:
+            profile.save(f.__name__, kind='job',
+                         job_id=job.get_id() if job is not None else None,
+                         trigger='meta' if requested else 'sample')
+    return wrapper
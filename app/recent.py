@@ -0,0 +1,126 @@
+import time
+from datetime import datetime
+from flask import current_app
+from redis import RedisError
+
+# member with the lowest possible score, present only in complete windows
+SENTINEL = '-'
+EPOCH = datetime(1970, 1, 1)
+
+
+def _score(timestamp):
+    return (timestamp - EPOCH).total_seconds()
+
+
+def _member(id):
+    # Redis orders members with the same score by their bytes; padding
+    # makes that the ID order, as in SQL
+    return '{:020d}'.format(id)
+
+
+class RecentPosts(object):
+    """Window of the newest post IDs, shared by all processes through Redis.
+
+    The window is a sorted set of the EXPLORE_CACHE_PAGES * POSTS_PER_PAGE
+    newest post IDs, scored by timestamp, with IDs breaking ties. Committed
+    posts are added and deleted posts removed as part of the commit
+    (write-through), and the window is rebuilt from the database when it is
+    missing or incomplete. It expires after EXPLORE_CACHE_TTL seconds, so
+    that posts inserted without the ORM show up eventually.
+
+    Methods return None when the window is disabled or Redis is
+    unavailable, and callers then fall back to SQL.
+    """
+    def __init__(self, app=None):
+        self.redis_down_until = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['recent_posts'] = self
+        self.key = app.config['EXPLORE_CACHE_KEY']
+        self.size = app.config['EXPLORE_CACHE_PAGES'] * \
+            app.config['POSTS_PER_PAGE']
+        self.ttl = app.config['EXPLORE_CACHE_TTL']
+        self.redis_down_until = 0
+
+    def _redis(self):
+        if not self.size or time.time() < self.redis_down_until:
+            return None
+        return current_app.redis
+
+    def _redis_failed(self, error):
+        self.redis_down_until = time.time() + 10
+        current_app.logger.warning('Recent posts: Redis unavailable: %s',
+                                   error)
+
+    def _cap(self, pipeline):
+        # keep the sentinel (rank 0) and the newest self.size posts
+        pipeline.zremrangebyrank(self.key, 1, -(self.size + 1))
+
+    def _rebuild(self, redis):
+        from app import db
+        from app.models import Post
+        rows = db.session.query(Post.id, Post.timestamp).order_by(
+            Post.timestamp.desc(), Post.id.desc()).limit(self.size).all()
+        # posts committed meanwhile were added by their own commit, and
+        # ZADD merges with those instead of replacing them
+        mapping = {_member(id): _score(timestamp) for id, timestamp in rows}
+        mapping[SENTINEL] = float('-inf')
+        pipeline = redis.pipeline()
+        pipeline.zadd(self.key, mapping)
+        self._cap(pipeline)
+        pipeline.expire(self.key, self.ttl)
+        pipeline.execute()
+        return [id for id, _ in rows]
+
+    def get(self, start, count):
+        """Return up to count post IDs from position start, newest first.
+
+        Returns None if the range isn't within the window.
+        """
+        redis = self._redis()
+        if redis is None or start + count > self.size + 1:
+            return None
+        try:
+            pipeline = redis.pipeline(transaction=False)
+            pipeline.zscore(self.key, SENTINEL)
+            pipeline.zrevrangebyscore(self.key, '+inf', '(-inf',
+                                      start=start, num=count)
+            complete, ids = pipeline.execute()
+            if complete is None:
+                return self._rebuild(redis)[start:start + count]
+        except RedisError as e:
+            self._redis_failed(e)
+            return None
+        return [int(id) for id in ids]
+
+    def update(self, added=(), removed=()):
+        """Add (id, timestamp) pairs and remove IDs from the window."""
+        redis = self._redis()
+        if redis is None or not (added or removed):
+            return
+        try:
+            pipeline = redis.pipeline()
+            if added:
+                pipeline.zadd(self.key, {
+                    _member(id): _score(timestamp)
+                    for id, timestamp in added})
+                self._cap(pipeline)
+            if removed:
+                pipeline.zrem(self.key, *[_member(id) for id in removed])
+            pipeline.execute()
+        except RedisError as e:
+            # the window would be out of date, have it rebuilt
+            self._redis_failed(e)
+            self.invalidate()
+
+    def invalidate(self):
+        """Have the window rebuilt, for posts written without the ORM."""
+        if not self.size:
+            return
+        try:
+            current_app.redis.delete(self.key)
+        except RedisError as e:
+            current_app.logger.warning(
+                'Recent posts: window not invalidated: %s', e)
@@ -0,0 +1,147 @@
+import random
+from contextlib import contextmanager
+from time import time
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from redis import RedisError
+from sqlalchemy import event, inspect, orm
+
+# binds whose key starts with this prefix are read replicas of the primary
+REPLICA_BIND_PREFIX = 'replica'
+# requests that don't change anything, see RFC 7231 section 4.2.1
+SAFE_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS'])
+# Redis key of the read-your-writes pin of a user
+PIN_KEY = 'db_primary_until:{}'
+
+
+def replica_bind_keys(app):
+    return sorted(key for key in app.config.get('SQLALCHEMY_BINDS') or ()
+                  if key.startswith(REPLICA_BIND_PREFIX))
+
+
+def _user_id():
+    # the ID of the user who authenticated with a token or a password, or
+    # with the session cookie, without loading anything: reading user.id
+    # could refresh an expired user, which would route a query from here
+    user = g.get('flask_httpauth_user')
+    if user is not None:
+        identity = inspect(user).identity
+        return str(identity[0]) if identity else None
+    return session.get('_user_id')
+
+
+def pin_to_primary(seconds=None):
+    """Send the reads of the current user to the primary.
+
+    Called after a request commits a write, so that the user sees their own
+    changes while the replicas catch up. The pin is a Redis key of the
+    authenticated user, which applies whichever way the user authenticates
+    next, so API clients that don't send cookies back are pinned too.
+    Anonymous users, and every user while Redis is unavailable, are pinned
+    through the browser session instead.
+    """
+    if seconds is None:
+        seconds = current_app.config['SQLALCHEMY_REPLICA_PIN_SECONDS']
+    user_id = _user_id()
+    if user_id is not None:
+        try:
+            current_app.redis.set(PIN_KEY.format(user_id), 1,
+                                  px=max(1, int(seconds * 1000)))
+            return
+        except RedisError as e:
+            current_app.logger.warning(
+                'Replica pin of user %s not saved: %s', user_id, e)
+    session['_db_primary_until'] = time() + seconds
+
+
+def _pinned_to_primary(user_id):
+    if session.get('_db_primary_until', 0) > time():
+        return True
+    if user_id is None:
+        return False
+    try:
+        return bool(current_app.redis.exists(PIN_KEY.format(user_id)))
+    except RedisError:
+        # the user could have just written, don't risk a stale read
+        return True
+
+
+@contextmanager
+def primary_reads():
+    """Send the reads of the block to the primary.
+
+    Used to authenticate API clients: the user is not known yet, so its
+    pin can't be checked, and a user loaded from a replica would stay
+    stale in the session for the rest of the request.
+    """
+    previous = g.get('db_primary_reads', False)
+    g.db_primary_reads = True
+    try:
+        yield
+    finally:
+        g.db_primary_reads = previous
+
+
+class RoutingSession(SignallingSession):
+    """Session that sends the reads of safe requests to a read replica.
+
+    SELECT statements go to a replica, chosen once per request, when the
+    request uses a safe method, the user is not pinned to the primary and
+    the session has no flushed but uncommitted changes. The pin is checked
+    again when the user becomes known, after API clients authenticate.
+    Everything else, including all work done outside of a request (CLI
+    commands, background jobs), goes to the primary.
+    """
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if getattr(clause, 'is_select', False) and not self._flushing and \
+                not self.info.get('dirty'):
+            replica = self._replica()
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+    def _replica(self):
+        if not has_request_context() or request.method not in SAFE_METHODS \
+                or g.get('db_primary_reads'):
+            return None
+        if 'db_replica' not in g:
+            keys = replica_bind_keys(self.app)
+            g.db_replica = self.db.get_engine(
+                self.app, bind=random.choice(keys)) if keys else None
+        if g.db_replica is not None:
+            user_id = _user_id()
+            if 'db_pin_user' not in g or g.db_pin_user != user_id:
+                g.db_pin_user = user_id
+                if _pinned_to_primary(user_id):
+                    g.db_replica = None
+        return g.db_replica
+
+
+def _after_flush(session, flush_context):
+    session.info['dirty'] = True
+
+
+def _after_commit(session):
+    if session.info.pop('dirty', False) and has_request_context() and \
+            request.method not in SAFE_METHODS and \
+            replica_bind_keys(session.app):
+        pin_to_primary()
+
+
+def _after_soft_rollback(session, previous_transaction):
+    session.info.pop('dirty', None)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        # listeners go on the class created by sessionmaker, listeners added
+        # to RoutingSession itself are lost when others listen on the former
+        event.listen(factory, 'after_flush', _after_flush)
+        event.listen(factory, 'after_commit', _after_commit)
+        event.listen(factory, 'after_soft_rollback', _after_soft_rollback)
+        return factory
@@ -10,6 +10,20 @@ def add_to_index(index, model):
     current_app.elasticsearch.index(index=index, id=model.id, body=payload)
 
 
+def add_to_index_bulk(index, models):
+    if not current_app.elasticsearch:
+        return 0
+    from elasticsearch.helpers import bulk
+    actions = [{
+        '_index': index,
+        '_id': model.id,
+        '_source': {field: getattr(model, field)
+                    for field in model.__searchable__}
+    } for model in models]
+    indexed, _ = bulk(current_app.elasticsearch, actions)
+    return indexed
+
+
 def remove_from_index(index, model):
     if not current_app.elasticsearch:
         return
@@ -1,20 +1,34 @@
 import json
 import sys
 import time
-from flask import render_template
+from flask import current_app, has_app_context, render_template
 from rq import get_current_job
 from app import create_app, db
-from app.models import User, Post, Task
+from app.models import User, Post, Task, Notification
 from app.email import send_email
+from app.metrics import timed_job
+from app.profiling import profiled_job
+from app.logs import flush_logs
 
-app = create_app()
-app.app_context().push()
+if has_app_context():
+    # preloaded by "flask worker", the job processes are forked from it
+    app = current_app._get_current_object()
+else:
+    app = create_app()
+    app.app_context().push()
 
 
 def _set_task_progress(progress):
     job = get_current_job()
     if job:
+        # report at most once per interval and per percent, but always 100%
+        last = job.meta.get('progress_reported_at', 0)
+        if progress < 100 and (progress == job.meta.get('progress') or
+                               time.time() - last <
+                               app.config['TASK_PROGRESS_INTERVAL']):
+            return
         job.meta['progress'] = progress
+        job.meta['progress_reported_at'] = time.time()
         job.save_meta()
         task = Task.query.get(job.get_id())
         task.user.add_notification('task_progress', {'task_id': job.get_id(),
@@ -24,6 +38,8 @@ def _set_task_progress(progress):
         db.session.commit()
 
 
+@timed_job
+@profiled_job
 def export_posts(user_id):
     try:
         user = User.query.get(user_id)
@@ -49,3 +65,13 @@ def export_posts(user_id):
     except:
         _set_task_progress(100)
         app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        flush_logs(app)
+
+
+@timed_job
+def compact_notifications():
+    deleted = Notification.compact(
+        app.config['NOTIFICATION_RETENTION_DAYS'] * 24 * 3600,
+        app.config['NOTIFICATION_COMPACT_BATCH'])
+    app.logger.info('Deleted %d stale notifications', deleted)
+    flush_logs(app)
@@ -1,7 +1,10 @@
 import json
-import requests
+from hashlib import md5
 from flask import current_app
 from flask_babel import _
+from app import cache
+from app.cache import MISSING
+from app.metrics import timer
 
 
 def translate(text, source_language, dest_language):
@@ -11,11 +14,24 @@ def translate(text, source_language, dest_language):
     auth = {
         'Ocp-Apim-Subscription-Key'   : current_app.config['MS_TRANSLATOR_KEY'],
         'Ocp-Apim-Subscription-Region': current_app.config['MS_TRANSLATOR_REGION']}
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[
-                {'Text': text}])
-    if r.status_code != 200:
+    key = 'translate:{}:{}:{}'.format(source_language, dest_language,
+                                      md5(text.encode('utf-8')).hexdigest())
+    translation = cache.get(key)
+    if translation is not MISSING:
+        return translation
+    from requests import RequestException
+    try:
+        with timer('translate_request_duration_seconds'):
+            r = current_app.http.post(
+                '{}/translate?api-version=3.0&from={}&to={}'.format(
+                    current_app.config['MS_TRANSLATOR_URL'], source_language,
+                    dest_language), headers=auth, json=[{'Text': text}],
+                timeout=current_app.config['MS_TRANSLATOR_TIMEOUT'])
+    except RequestException:
+        r = None
+    if r is None or r.status_code != 200:
         return _('Error: the translation service failed.')
-    return r.json()[0]['translations'][0]['text']
+    # errors are not cached, so that they are retried
+    translation = r.json()[0]['translations'][0]['text']
+    cache.set(key, translation, current_app.config['CACHE_TRANSLATE_TTL'])
+    return translation
@@ -0,0 +1,108 @@
+from collections import namedtuple
+from app import recent_posts
+from app.models import User, Post
+from app.pagination import newest_first, older_than, item_cursor
+
+POST_COLUMNS = (Post.id, Post.body, Post.timestamp, Post.user_id,
+                Post.language)
+USER_COLUMNS = (User.id, User.username, User.email, User.about_me,
+                User.last_seen, User.aws_cognito_uid)
+
+
+class AuthorView(namedtuple('AuthorView', ['id', 'username', 'email'])):
+    """Read-only author of a PostView."""
+    __slots__ = ()
+
+    avatar = User.avatar
+
+
+class PostView(namedtuple('PostView', [column.key for column in POST_COLUMNS]
+                          + ['author'])):
+    """Read-only stand-in for a Post in listings.
+
+    Views are plain tuples, so loading them skips the identity map and the
+    instance state that ORM objects carry, and they can't be modified.
+    """
+    __slots__ = ()
+
+    to_dict = Post.to_dict
+
+
+class UserView(namedtuple('UserView', [column.key for column in USER_COLUMNS]
+                          + ['counts'])):
+    """Read-only stand-in for a User in API responses.
+
+    counts is a tuple with the numbers of posts, followers and followed
+    users, which a User queries one by one when represented.
+    """
+    __slots__ = ()
+
+    avatar = User.avatar
+    to_dict = User.to_dict
+
+    def post_count(self):
+        return self.counts[0]
+
+    def followers_count(self):
+        return self.counts[1]
+
+    def followed_count(self):
+        return self.counts[2]
+
+
+def post_rows(query):
+    """Make a Post query return rows with the columns of PostView."""
+    return query.with_entities(*POST_COLUMNS)
+
+
+def views_with_authors(rows, users):
+    """Return views for post rows, given the cached data of their authors.
+
+    rows are mappings of the columns of PostView, users a dictionary as
+    returned by User.get_cached_data_many().
+    """
+    authors = {id: AuthorView(id, data['username'], data['email'])
+               for id, data in users.items()}
+    return [PostView(author=authors.get(row['user_id']), **row)
+            for row in rows]
+
+
+def _views(rows):
+    return views_with_authors(rows, User.get_cached_data_many(
+        {row['user_id'] for row in rows}))
+
+
+def post_views(rows):
+    """Return views for rows returned by a post_rows() query."""
+    return _views([row._mapping for row in rows])
+
+
+def post_views_by_id(ids):
+    """Return views of the posts with the given IDs, in the same order.
+
+    Posts and authors are loaded through the cache; posts that don't exist
+    are left out.
+    """
+    return _views(Post.get_cached_data(ids))
+
+
+def recent_post_views(page, per_page):
+    """Return a page of the newest posts of all users.
+
+    The result is a tuple (posts, more), where more is True if there are
+    older posts. Pages within the shared window of recent post IDs are
+    loaded by ID; beyond the window, or without Redis, they are read in
+    timestamp order from the database.
+    """
+    start = (page - 1) * per_page
+    ids = recent_posts.get(start, per_page + 1)
+    query = post_rows(newest_first(Post.query, Post))
+    if not ids:
+        posts = post_views(query.offset(start).limit(per_page + 1).all())
+        return posts[:per_page], len(posts) > per_page
+    posts = post_views_by_id(ids)
+    if len(ids) <= per_page and posts:
+        # the window ends within this page, the rest comes from SQL
+        posts += post_views(older_than(query, Post, item_cursor(
+            posts[-1])).limit(per_page + 1 - len(posts)).all())
+    return posts[:per_page], len(posts) > per_page
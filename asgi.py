@@ -0,0 +1,4 @@
+from app.asgi import AsyncAPI
+from microblog import app as flask_app
+
+app = AsyncAPI(flask_app)
@@ -5,18 +5,86 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 load_dotenv(os.path.join(basedir, '.env'))
 
 
+def _rds_uri(hostname):
+    return '{}://{}:{}@{}:{}/{}'.format(
+        os.environ.get('RDS_PREFIX'),
+        os.environ.get('RDS_USERNAME'), os.environ.get('RDS_PASSWORD'),
+        hostname, os.environ.get('RDS_PORT'), os.environ.get('RDS_DB_NAME'))
+
+
+# asyncio drivers for the URL schemes of the synchronous ones
+_ASYNC_SCHEMES = {
+    'sqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+    'mysql+pymysql': 'mysql+aiomysql',
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+}
+
+
+def _async_uri(uri):
+    scheme, separator, rest = uri.partition('://')
+    return _ASYNC_SCHEMES.get(scheme, scheme) + separator + rest
+
+
 class Config(object):
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
     if os.environ.get('RDS_PREFIX') is not None:
-        SQLALCHEMY_DATABASE_URI = '{}://{}:{}@{}:{}/{}'.format(
-            os.environ.get('RDS_PREFIX'),
-            os.environ.get('RDS_USERNAME'), os.environ.get('RDS_PASSWORD'),
-            os.environ.get('RDS_HOSTNAME'), os.environ.get('RDS_PORT'),
-            os.environ.get('RDS_DB_NAME'))
+        SQLALCHEMY_DATABASE_URI = _rds_uri(os.environ.get('RDS_HOSTNAME'))
+        # read replicas share the credentials and database name of the primary
+        SQLALCHEMY_BINDS = {
+            'replica{}'.format(i): _rds_uri(hostname.strip())
+            for i, hostname in enumerate(
+                (os.environ.get('RDS_REPLICA_HOSTNAMES') or '').split(','))
+            if hostname.strip()}
+        SQLALCHEMY_ENGINE_OPTIONS = {
+            'pool_size': int(os.environ.get('DB_POOL_SIZE') or 5),
+            'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW') or 10),
+            'pool_pre_ping': os.environ.get('DB_POOL_PRE_PING') is not None,
+            'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE') or 3600),
+        }
     else:
         SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
+        SQLALCHEMY_BINDS = {}
+        SQLALCHEMY_ENGINE_OPTIONS = {}
+    # seconds during which a user who wrote reads from the primary only
+    SQLALCHEMY_REPLICA_PIN_SECONDS = int(
+        os.environ.get('DB_REPLICA_PIN_SECONDS') or 10)
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # read-only API served with asyncio, see app/asgi.py; the pool size is
+    # that of both its database and Redis connection pools
+    ASYNC_DATABASE_URL = os.environ.get('ASYNC_DATABASE_URL') or \
+        _async_uri(SQLALCHEMY_DATABASE_URI)
+    ASYNC_POOL_SIZE = int(os.environ.get('ASYNC_POOL_SIZE') or 20)
+    # log statements slower than this, and statements repeated this many
+    # times within one request (a likely N+1 query pattern)
+    SQL_SLOW_QUERY_SECONDS = float(
+        os.environ.get('SQL_SLOW_QUERY_SECONDS') or 0.5)
+    SQL_N_PLUS_ONE_THRESHOLD = int(
+        os.environ.get('SQL_N_PLUS_ONE_THRESHOLD') or 10)
+    SQL_SERVER_TIMING = os.environ.get('SQL_SERVER_TIMING') != '0'
+    # directory shared by all worker processes to aggregate /metrics
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS') or 5)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    # profiles of requests and background jobs are saved here when set
+    PROFILE_DIR = os.environ.get('PROFILE_DIR')
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0)
+    PROFILE_JOB_SAMPLE_RATE = float(
+        os.environ.get('PROFILE_JOB_SAMPLE_RATE') or 0)
+    PROFILE_SAMPLE_INTERVAL = float(
+        os.environ.get('PROFILE_SAMPLE_INTERVAL') or 0.005)
+    PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP') or 200)
+    PROFILE_TOKEN_EXPIRES_IN = 3600
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
+    LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES') or 10 * 1024 * 1024)
+    LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT') or 10)
+    LOG_ACCESS = os.environ.get('LOG_ACCESS') is not None
+    # the same error is mailed at most once per interval, and no more than
+    # LOG_MAIL_MAX error mails are sent per interval
+    LOG_MAIL_INTERVAL = int(os.environ.get('LOG_MAIL_INTERVAL') or 600)
+    LOG_MAIL_MAX = int(os.environ.get('LOG_MAIL_MAX') or 10)
     MAIL_SERVER = os.environ.get('MAIL_SERVER')
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 25)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
@@ -24,16 +92,58 @@ class Config(object):
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD')
     MAIL_SUBJECT_PREFIX = os.environ.get('MAIL_SUBJECT_PREFIX')
     ADMINS = [os.environ.get('ADMIN_EMAIL')]
+    # notifications not updated for this long are deleted by the compaction
+    # job, NOTIFICATION_COMPACT_BATCH rows per transaction
+    NOTIFICATION_RETENTION_DAYS = float(
+        os.environ.get('NOTIFICATION_RETENTION_DAYS') or 7)
+    NOTIFICATION_COMPACT_BATCH = 1000
+    # minimum seconds between progress notifications of a background task
+    TASK_PROGRESS_INTERVAL = float(
+        os.environ.get('TASK_PROGRESS_INTERVAL') or 1)
     EXPORT_POST_SLEEP_SECONDS = int(os.environ.get('EXPORT_POST_SLEEP_SECONDS') or 5)
     LANGUAGES = ['en', 'es']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
     MS_TRANSLATOR_REGION = os.environ.get('MS_TRANSLATOR_REGION')
+    MS_TRANSLATOR_URL = os.environ.get('MS_TRANSLATOR_URL') or \
+        'https://api.cognitive.microsofttranslator.com'
+    MS_TRANSLATOR_TIMEOUT = float(os.environ.get('MS_TRANSLATOR_TIMEOUT') or 5)
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
     ELASTICSEARCH_USER = os.environ.get('ELASTICSEARCH_USER')
     ELASTICSEARCH_PSW = os.environ.get('ELASTICSEARCH_PSW')
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
     REDIS_PSW = os.environ.get('REDIS_PSW')
+    # requests a process serves at the same time, set by gunicorn.conf.py;
+    # client connection pools are sized for it
+    REQUEST_CONCURRENCY = int(os.environ.get('REQUEST_CONCURRENCY') or 1)
+    # one connection per request, plus the cache invalidation subscriber and
+    # a spare
+    REDIS_MAX_CONNECTIONS = int(os.environ.get('REDIS_MAX_CONNECTIONS') or
+                                REQUEST_CONCURRENCY + 2)
     POSTS_PER_PAGE = 25
+    # two-tier cache, see app/cache.py
+    CACHE_USE_REDIS = os.environ.get('CACHE_USE_REDIS') != '0'
+    CACHE_PREFIX = os.environ.get('CACHE_PREFIX') or 'microblog:cache:'
+    CACHE_DEFAULT_TTL = int(os.environ.get('CACHE_DEFAULT_TTL') or 300)
+    CACHE_LOCAL_TTL = int(os.environ.get('CACHE_LOCAL_TTL') or 30)
+    CACHE_LOCAL_SIZE = int(os.environ.get('CACHE_LOCAL_SIZE') or 1000)
+    CACHE_LOCK_TIMEOUT = 5
+    CACHE_NEGATIVE_TTL = 30
+    CACHE_USER_TTL = 300
+    CACHE_POST_TTL = 3600
+    CACHE_SEARCH_TTL = 60
+    CACHE_TRANSLATE_TTL = 24 * 3600
+    CACHE_FRAGMENT_TTL = int(os.environ.get('CACHE_FRAGMENT_TTL') or 3600)
+    # shared follow graph index, see app/followgraph.py
+    FOLLOW_GRAPH_PATH = os.environ.get('FOLLOW_GRAPH_PATH')
+    FOLLOW_GRAPH_STREAM = 'microblog:follows'
+    FOLLOW_GRAPH_STREAM_MAXLEN = int(
+        os.environ.get('FOLLOW_GRAPH_STREAM_MAXLEN') or 100000)
+    FOLLOW_GRAPH_REFRESH_SECONDS = float(
+        os.environ.get('FOLLOW_GRAPH_REFRESH_SECONDS') or 1)
+    # newest posts shared by the explore page, see app/recent.py
+    EXPLORE_CACHE_PAGES = int(os.environ.get('EXPLORE_CACHE_PAGES') or 10)
+    EXPLORE_CACHE_KEY = 'microblog:explore'
+    EXPLORE_CACHE_TTL = int(os.environ.get('EXPLORE_CACHE_TTL') or 3600)
     AUTH_USE_AWS_COGNITO = os.environ.get('AUTH_USE_AWS_COGNITO')
 
     # Setup the flask-cognito-auth extention
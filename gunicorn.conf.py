@@ -0,0 +1,39 @@
+# gunicorn reads this file from the working directory; command line options
+# take precedence, but the pool sizes below are derived from the settings
+# made here
+import os
+
+# "sync" handles one request at a time per worker; "gthread" and "gevent"
+# keep serving other requests while some wait on the database, Redis,
+# Elasticsearch, the translator or SMTP
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS') or 'sync'
+workers = int(os.environ.get('WEB_CONCURRENCY') or 1)
+
+if worker_class == 'gevent':
+    # patched before the application is imported, so that the sockets,
+    # locks and threads it creates are cooperative
+    from gevent import monkey
+    monkey.patch_all()
+    worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS') or
+                             100)
+    concurrency = worker_connections
+elif worker_class == 'gthread':
+    threads = int(os.environ.get('GUNICORN_THREADS') or 8)
+    concurrency = threads
+else:
+    concurrency = 1
+
+# read by config.py to size the Redis, Elasticsearch and HTTP client pools
+os.environ.setdefault('REQUEST_CONCURRENCY', str(concurrency))
+# the connections the database accepts from this host are shared by the
+# workers; requests beyond a worker's share wait for a pooled connection
+_db_connections = int(os.environ.get('DB_MAX_CONNECTIONS') or 20)
+os.environ.setdefault('DB_POOL_SIZE', str(
+    max(1, min(concurrency, _db_connections // workers))))
+os.environ.setdefault('DB_MAX_OVERFLOW', '0')
+
+# import the application once in the master process and fork the workers
+# from it, so that they start right away and share the imported code
+# copy-on-write; clients and connections are only created in the workers,
+# on first use
+preload_app = os.environ.get('GUNICORN_PRELOAD') != '0'
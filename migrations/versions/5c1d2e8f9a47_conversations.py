@@ -0,0 +1,141 @@
+"""conversations
+
+Revision ID: 5c1d2e8f9a47
+Revises: 2178a5a9bb5c
+Create Date: 2026-10-19 10:12:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1d2e8f9a47'
+down_revision = '2178a5a9bb5c'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+
+user = sa.table(
+    'user',
+    sa.column('id', sa.BigInteger),
+    sa.column('last_message_read_time', sa.DateTime))
+message = sa.table(
+    'message',
+    sa.column('id', sa.Integer),
+    sa.column('sender_id', sa.BigInteger),
+    sa.column('recipient_id', sa.BigInteger),
+    sa.column('conversation_id', sa.Integer),
+    sa.column('timestamp', sa.DateTime))
+# a full table, so that inserts return the new primary keys
+conversation = sa.Table(
+    'conversation', sa.MetaData(),
+    sa.Column('id', sa.Integer, primary_key=True),
+    sa.Column('user1_id', sa.BigInteger),
+    sa.Column('user2_id', sa.BigInteger),
+    sa.Column('last_message_at', sa.DateTime),
+    sa.Column('user1_unread', sa.Integer),
+    sa.Column('user2_unread', sa.Integer))
+
+
+def upgrade():
+    op.create_table('conversation',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user1_id', sa.BigInteger(), nullable=False),
+    sa.Column('user2_id', sa.BigInteger(), nullable=False),
+    sa.Column('last_message_at', sa.DateTime(), nullable=False),
+    sa.Column('user1_unread', sa.Integer(), nullable=False),
+    sa.Column('user2_unread', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['user1_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['user2_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user1_id', 'user2_id')
+    )
+    op.create_index('ix_conversation_user1_last_message_at', 'conversation', ['user1_id', 'last_message_at'], unique=False)
+    op.create_index('ix_conversation_user2_last_message_at', 'conversation', ['user2_id', 'last_message_at'], unique=False)
+    with op.batch_alter_table('message') as batch_op:
+        batch_op.add_column(sa.Column('conversation_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_message_conversation_id_conversation', 'conversation', ['conversation_id'], ['id'])
+        batch_op.create_index('ix_message_conversation_id_timestamp', ['conversation_id', 'timestamp'], unique=False)
+    backfill(op.get_bind())
+
+
+def backfill(connection):
+    """Group existing messages into conversations, BATCH_SIZE at a time.
+
+    Messages received after the recipient last opened the messages page
+    count as unread, as they did before conversations. Messages without a
+    sender or a recipient (both columns are nullable) belong to no
+    conversation and are skipped; their conversation_id stays NULL.
+    """
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select([message.c.id, message.c.sender_id,
+                       message.c.recipient_id, message.c.timestamp])
+            .where(message.c.id > last_id)
+            .where(message.c.sender_id.isnot(None))
+            .where(message.c.recipient_id.isnot(None))
+            .order_by(message.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1].id
+        pairs = {tuple(sorted((row.sender_id, row.recipient_id)))
+                 for row in rows}
+        conversations = {
+            (c.user1_id, c.user2_id): dict(c._mapping)
+            for c in connection.execute(conversation.select().where(
+                conversation.c.user1_id.in_({pair[0] for pair in pairs})))
+            if (c.user1_id, c.user2_id) in pairs}
+        read_times = dict(connection.execute(
+            sa.select([user.c.id, user.c.last_message_read_time]).where(
+                user.c.id.in_({row.recipient_id for row in rows}))).fetchall())
+        changed = set()
+        for row in rows:
+            pair = tuple(sorted((row.sender_id, row.recipient_id)))
+            c = conversations.get(pair)
+            if c is None:
+                c = conversations[pair] = {
+                    'id': None, 'user1_id': pair[0], 'user2_id': pair[1],
+                    'last_message_at': row.timestamp,
+                    'user1_unread': 0, 'user2_unread': 0}
+            if row.timestamp and (c['last_message_at'] is None or
+                                  row.timestamp > c['last_message_at']):
+                c['last_message_at'] = row.timestamp
+            read_time = read_times.get(row.recipient_id)
+            if read_time is None or (row.timestamp and
+                                     row.timestamp > read_time):
+                unread = 'user1_unread' if row.recipient_id == pair[0] \
+                    else 'user2_unread'
+                c[unread] += 1
+            changed.add(pair)
+        for pair in changed:
+            c = conversations[pair]
+            if c['last_message_at'] is None:
+                c['last_message_at'] = sa.func.now()
+            values = {k: v for k, v in c.items() if k != 'id'}
+            if c['id'] is None:
+                c['id'] = connection.execute(
+                    conversation.insert().values(**values)
+                ).inserted_primary_key[0]
+            else:
+                connection.execute(conversation.update().where(
+                    conversation.c.id == c['id']).values(**values))
+        connection.execute(
+            message.update().where(message.c.id == sa.bindparam('message_id'))
+            .values(conversation_id=sa.bindparam('conversation')),
+            [{'message_id': row.id,
+              'conversation': conversations[tuple(sorted(
+                  (row.sender_id, row.recipient_id)))]['id']}
+             for row in rows])
+
+
+def downgrade():
+    with op.batch_alter_table('message') as batch_op:
+        batch_op.drop_index('ix_message_conversation_id_timestamp')
+        batch_op.drop_constraint('fk_message_conversation_id_conversation', type_='foreignkey')
+        batch_op.drop_column('conversation_id')
+    op.drop_index('ix_conversation_user2_last_message_at', table_name='conversation')
+    op.drop_index('ix_conversation_user1_last_message_at', table_name='conversation')
+    op.drop_table('conversation')
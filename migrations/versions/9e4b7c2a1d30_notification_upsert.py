@@ -0,0 +1,64 @@
+"""notification upsert
+
+Revision ID: 9e4b7c2a1d30
+Revises: 5c1d2e8f9a47
+Create Date: 2026-10-19 11:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e4b7c2a1d30'
+down_revision = '5c1d2e8f9a47'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+
+notification = sa.table(
+    'notification',
+    sa.column('id', sa.Integer),
+    sa.column('name', sa.String),
+    sa.column('user_id', sa.BigInteger),
+    sa.column('timestamp', sa.Float))
+
+
+def delete_duplicates(connection):
+    """Keep only the newest notification per user and name.
+
+    Older versions were never deleted reliably, so there can be many; they
+    are deleted BATCH_SIZE at a time.
+    """
+    newest = sa.select([sa.func.max(notification.c.id)]).group_by(
+        notification.c.user_id, notification.c.name)
+    # materialized, since MySQL can't select from the table being deleted from
+    keep = set(row[0] for row in connection.execute(newest))
+    last_id = 0
+    while True:
+        ids = [row[0] for row in connection.execute(
+            sa.select([notification.c.id]).where(notification.c.id > last_id)
+            .order_by(notification.c.id).limit(BATCH_SIZE))]
+        if not ids:
+            break
+        last_id = ids[-1]
+        stale = [id for id in ids if id not in keep]
+        if stale:
+            connection.execute(notification.delete().where(
+                notification.c.id.in_(stale)))
+
+
+def upgrade():
+    delete_duplicates(op.get_bind())
+    with op.batch_alter_table('notification') as batch_op:
+        batch_op.add_column(sa.Column('version', sa.Integer(), nullable=False, server_default='1'))
+        batch_op.create_unique_constraint('uq_notification_user_id_name', ['user_id', 'name'])
+        batch_op.create_index('ix_notification_user_id_timestamp', ['user_id', 'timestamp'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('notification') as batch_op:
+        batch_op.drop_index('ix_notification_user_id_timestamp')
+        batch_op.drop_constraint('uq_notification_user_id_name', type_='unique')
+        batch_op.drop_column('version')
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# ******************************
+# File: load_test.py
+#
+# Description
+# -----------
+# Load driver that replays a weighted mix of page and API requests against
+# a running Microblog instance and reports latency percentiles and
+# throughput per endpoint.
+#
+# Note: The target database should be populated with `flask bench seed`,
+#       and the application served the way it runs in production, e.g.
+#       gunicorn --bind :8000 microblog:app
+#       Only the built-in authentication module is supported.
+#
+#       The "translate" endpoint is left out of the default mix. To see how
+#       requests waiting on a slow service affect the others, start
+#       scripts/slow_upstream.py, point MS_TRANSLATOR_URL at it (with any
+#       MS_TRANSLATOR_KEY) and run e.g. --mix translate=1,api_user=3 with a
+#       concurrency above the number of workers, once per worker class.
+#
+#       The read-only API can also be served by the asynchronous server
+#       (uvicorn asgi:app). To compare it with the WSGI server, run the same
+#       API-only mix against both, e.g. --mix api_user=1,api_users=1,
+#       api_followers=1,api_timeline=1,api_timeline_since=1 with a high
+#       concurrency.
+# ******************************
+import argparse
+import json
+import random
+import re
+import sys
+import threading
+import time
+import requests
+
+# endpoint name -> (default weight, function returning a URL path)
+ENDPOINTS = {
+    'index': (30, lambda ctx: '/index'),
+    'explore': (15, lambda ctx: '/explore'),
+    'user': (15, lambda ctx: '/user/user{}'.format(ctx.random_user_id())),
+    'search': (5, lambda ctx: '/search?q={}'.format(
+        ctx.rng.choice(SEARCH_TERMS))),
+    'notifications': (20, lambda ctx: '/notifications?since={}'.format(
+        time.time() - 60)),
+    'api_user': (5, lambda ctx: '/api/users/{}'.format(
+        ctx.random_user_id())),
+    'api_timeline': (10, lambda ctx: '/api/timeline'),
+    'api_users': (0, lambda ctx: '/api/users?page={}'.format(
+        ctx.rng.randrange(1, ctx.args.users // 10 + 1))),
+    'api_followers': (0, lambda ctx: '/api/users/{}/followers'.format(
+        ctx.random_user_id())),
+    'api_timeline_since': (0, lambda ctx: '/api/timeline/since'),
+    'translate': (0, lambda ctx: '/translate'),
+}
+# form data of the endpoints requested with POST
+FORMS = {
+    # a new text every time, since translations are cached
+    'translate': lambda ctx: {'text': 'hello {}'.format(ctx.rng.random()),
+                              'source_language': 'en',
+                              'dest_language': 'es'},
+}
+SEARCH_TERMS = ['flask', 'python', 'redis', 'timeline', 'follow', 'message']
+_CSRF = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+# parse command line arguments
+def parse_arguments():
+    p = argparse.ArgumentParser(description="""
+    Replay a weighted request mix against a running Microblog instance.
+    """)
+    p.add_argument('-u', '--url', default='http://localhost:8000',
+                   help="base URL of the instance, defaults to %(default)s")
+    p.add_argument('-c', '--concurrency', type=int, default=8,
+                   help="number of simulated users sending requests in " +
+                        "parallel, defaults to %(default)s")
+    p.add_argument('-d', '--duration', type=float, default=60,
+                   help="test duration in seconds, defaults to %(default)s")
+    p.add_argument('-n', '--users', type=int, default=1000,
+                   help="number of seeded users to pick from" +
+                        ", defaults to %(default)s")
+    p.add_argument('--first-user-id', type=int, default=1,
+                   help="ID of the first seeded user, defaults to %(default)s")
+    p.add_argument('-p', '--password', default='bench',
+                   help="password of the seeded users" +
+                        ", defaults to %(default)s")
+    p.add_argument('-m', '--mix', type=str,
+                   help="comma separated endpoint=weight pairs replacing " +
+                        "the default mix, with endpoints from: " +
+                        ", ".join(ENDPOINTS))
+    p.add_argument('-j', '--json', type=str,
+                   help="write the results to this JSON file")
+    p.add_argument('-s', '--seed', type=int, help="random seed")
+    args = p.parse_args()
+    args.weights = {name: weight for name, (weight, _) in ENDPOINTS.items()
+                    if weight}
+    if args.mix:
+        try:
+            args.weights = {name: float(weight) for name, weight in (
+                pair.split('=') for pair in args.mix.split(','))}
+        except ValueError:
+            p.error("invalid mix: {}".format(args.mix))
+        unknown = set(args.weights) - set(ENDPOINTS)
+        if unknown:
+            p.error("unknown endpoint(s): {}".format(', '.join(unknown)))
+    return args
+
+
+class VirtualUser(object):
+    """A logged in user with a browser session and an API token."""
+    def __init__(self, args, rng):
+        self.args = args
+        self.rng = rng
+        self.session = requests.Session()
+        self.user_id = self.random_user_id()
+        self.username = 'user{}'.format(self.user_id)
+        self.token = None
+
+    def random_user_id(self):
+        return self.args.first_user_id + self.rng.randrange(self.args.users)
+
+    def login(self):
+        url = self.args.url + '/auth/login'
+        r = self.session.get(url)
+        match = _CSRF.search(r.text)
+        r = self.session.post(url, data={
+            'username': self.username, 'password': self.args.password,
+            'csrf_token': match.group(1) if match else ''},
+            allow_redirects=False)
+        if r.status_code != 302 or '/auth/login' in r.headers['Location']:
+            raise RuntimeError('login failed for {}'.format(self.username))
+        r = self.session.post(self.args.url + '/api/tokens',
+                              auth=(self.username, self.args.password))
+        r.raise_for_status()
+        self.token = r.json()['token']
+
+    def request(self, name):
+        path = ENDPOINTS[name][1](self)
+        headers = {'Authorization': 'Bearer ' + self.token} \
+            if name.startswith('api_') else None
+        start = time.perf_counter()
+        if name in FORMS:
+            r = self.session.post(self.args.url + path, data=FORMS[name](self),
+                                  headers=headers, allow_redirects=False)
+        else:
+            r = self.session.get(self.args.url + path, headers=headers,
+                                 allow_redirects=False)
+        return time.perf_counter() - start, r.status_code
+
+
+def _percentile(sorted_values, percent):
+    # nearest-rank percentile
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(percent / 100.0 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    names = list(args.weights)
+    weights = [args.weights[name] for name in names]
+    samples = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    vusers = [VirtualUser(args, random.Random(rng.random()))
+              for _ in range(args.concurrency)]
+    for vuser in vusers:
+        vuser.login()
+    deadline = time.monotonic() + args.duration
+
+    def worker(vuser):
+        while time.monotonic() < deadline:
+            name = vuser.rng.choices(names, weights)[0]
+            try:
+                elapsed, status = vuser.request(name)
+            except requests.RequestException:
+                elapsed, status = None, None
+            with lock:
+                if status is None or status >= 400:
+                    errors[name] += 1
+                else:
+                    samples[name].append(elapsed)
+
+    threads = [threading.Thread(target=worker, args=(vuser,))
+               for vuser in vusers]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall_time = time.monotonic() - start
+
+    results = {'url': args.url, 'concurrency': args.concurrency,
+               'duration': wall_time, 'endpoints': {}}
+    for name in names + ['total']:
+        values = sorted(samples[name]) if name != 'total' else \
+            sorted(v for values in samples.values() for v in values)
+        results['endpoints'][name] = {
+            'requests': len(values),
+            'errors': errors[name] if name != 'total'
+            else sum(errors.values()),
+            'throughput': len(values) / wall_time,
+            'p50': _percentile(values, 50),
+            'p95': _percentile(values, 95),
+            'p99': _percentile(values, 99),
+        }
+    return results
+
+
+def print_results(results):
+    def ms(value):
+        return '{:9.1f}'.format(value * 1000) if value is not None \
+            else '        -'
+
+    print('{:<14}{:>9}{:>8}{:>9}{:>9}{:>9}{:>9}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms'))
+    for name, r in results['endpoints'].items():
+        print('{:<14}{:>9}{:>8}{:>9.1f}{}{}{}'.format(
+            name, r['requests'], r['errors'], r['throughput'], ms(r['p50']),
+            ms(r['p95']), ms(r['p99'])))
+
+
+if __name__ == '__main__':
+    param = parse_arguments()
+    try:
+        results = run(param)
+    except (RuntimeError, requests.RequestException) as e:
+        sys.stderr.write('error: {}\n'.format(e))
+        sys.exit(1)
+    print_results(results)
+    if param.json:
+        with open(param.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# ******************************
+# File: slow_upstream.py
+#
+# Description
+# -----------
+# Stand-in for the Microsoft Translator API that answers after a delay,
+# used with load_test.py to measure how requests waiting on a slow service
+# affect the others.
+#
+# Note: Start the application with MS_TRANSLATOR_URL set to the address
+#       of this server and any MS_TRANSLATOR_KEY.
+# ******************************
+import argparse
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# parse command line arguments
+def parse_arguments():
+    p = argparse.ArgumentParser(description="""
+    Serve translations slowly.
+    """)
+    p.add_argument('-p', '--port', type=int, default=9000,
+                   help="port to listen on, defaults to %(default)s")
+    p.add_argument('-d', '--delay', type=float, default=2,
+                   help="seconds before each response, defaults to " +
+                        "%(default)s")
+    return p.parse_args()
+
+
+class SlowTranslator(BaseHTTPRequestHandler):
+    delay = 2
+
+    def do_POST(self):
+        texts = json.loads(self.rfile.read(
+            int(self.headers.get('Content-Length', 0))) or b'[]')
+        time.sleep(self.delay)
+        body = json.dumps([{'translations': [{'text': item['Text'][::-1]}]}
+                           for item in texts]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == '__main__':
+    param = parse_arguments()
+    SlowTranslator.delay = param.delay
+    server = ThreadingHTTPServer(('', param.port), SlowTranslator)
+    print('Translating with a {}s delay on port {}'.format(param.delay,
+                                                           param.port))
+    server.serve_forever()
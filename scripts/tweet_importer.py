@@ -13,14 +13,22 @@
 # ******************************
 import argparse
 import csv
+import functools
+import glob
+import gzip
 import hashlib
 import inspect
+import io
+import itertools
+import json
+import logging
 import os
 import re
 import pycountry
-import random
-import string
 import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from sqlalchemy.exc import IntegrityError
 
@@ -29,16 +37,19 @@ cur_file = inspect.getfile(inspect.currentframe())
 cur_dir = os.path.dirname(os.path.abspath(cur_file))
 parent_dir = os.path.dirname(cur_dir)
 sys.path.insert(0, parent_dir)
-from app import create_app, db
-from app.models import User, Post
+from app import create_app, db, recent_posts
+from app.models import User, Post, SearchableMixin
 
 
 # constants
-PSW_LEN = 16
+# imported accounts cannot log in: this marker never matches a password hash
+UNUSABLE_PASSWORD = '!'
 EMAIL_DOMAIN = 'microblog.xyz'
 DFLT_TS = datetime(1970, 1, 1)
 OBFUSCATE_USERNAME = True
 _BATCH_SIZE = 100
+_SKIP_CHUNK_SIZE = 1 << 20
+_log = logging.getLogger('tweet_importer')
 # regexp for emojis (source: https://stackoverflow.com/a/58356570)
 _EMOJI = re.compile("["
                     u"\U0001F600-\U0001F64F"  # emoticons
@@ -76,153 +87,558 @@ def parse_arguments():
     Import Twitter posts into Microblog database.
       Supported dataset: https://www.trackmyhashtag.com/data/COVID-19.zip
     """)
-    p.add_argument('filename', type=str,
-                   help="CSV file to be imported")
+    p.add_argument('filenames', type=str, nargs='+', metavar='filename',
+                   help="CSV file(s) or glob pattern(s) to be imported, " +
+                        "optionally compressed as .csv.gz or .csv.zst " +
+                        "(the latter requires the zstandard package)")
     p.add_argument('-m', '--max-posts', type=int,
                    default=0,  # import all lines by default
                    help="maximum number of posts to be imported" +
                         ", defaults to 0 (unlimited)")
     p.add_argument('-o', '--offset', type=int, default=1,
-                   help="line offset within CSV file to start import at" +
-                        ", defaults to 1")
+                   help="line offset within the first CSV file to start " +
+                        "import at, defaults to 1")
+    p.add_argument('-c', '--checkpoint', type=str,
+                   help="file to record import progress in after each " +
+                        "committed batch. If it exists, the import resumes " +
+                        "from the recorded position and --offset is ignored")
+    p.add_argument('-l', '--progress-log', type=str,
+                   help="file to append JSON progress records to" +
+                        ", defaults to stderr")
+    p.add_argument('-b', '--bulk', action='store_true',
+                   help="insert each batch of rows with a single bulk " +
+                        "statement per table instead of row by row")
+    p.add_argument('-s', '--batch-size', type=int, default=_BATCH_SIZE,
+                   help="number of rows per batch" +
+                        ", defaults to {}".format(_BATCH_SIZE))
+    p.add_argument('-w', '--workers', type=int, default=1,
+                   help="number of processes parsing rows in parallel" +
+                        ", defaults to 1 (parse in the importing process)")
     args = p.parse_args()
     if args.max_posts < 0:
         p.error("maximum number of posts must be at least 0")
-    if args.max_posts < 1:
+    if args.offset < 1:
         p.error("line offset must be at least 1")
+    if args.batch_size < 1:
+        p.error("batch size must be at least 1")
+    if args.workers < 1:
+        p.error("number of workers must be at least 1")
     return args
 
 
-def _print_progress(stats):
+def _setup_progress_log(filename=None):
     """
-    Print import progress. Customise this function if required.
+    Send progress records, one JSON object per line, to a file or stderr.
     """
-    print("{}:{}".format(datetime.now().strftime('%Y-%m-%d %H:%M:%S'), stats))
+    handler = logging.FileHandler(filename) if filename \
+        else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    _log.addHandler(handler)
+    _log.setLevel(logging.INFO)
+
+
+def _log_event(event, level=logging.INFO, **fields):
+    record = {'ts': datetime.utcnow().isoformat() + 'Z', 'event': event}
+    record.update(fields)
+    _log.log(level, json.dumps(record, default=str))
+
+
+def _print_progress(stats, timing, **fields):
+    """
+    Log import progress and throughput since the previous progress record.
+    """
+    now = time.monotonic()
+    elapsed = now - timing['last']
+    rows = stats['tweet_cnt'] - timing['last_cnt']
+    _log_event('progress', elapsed=round(now - timing['start'], 3),
+               rows_per_sec=round(rows / elapsed, 1) if elapsed else None,
+               stats=stats, **fields)
+    timing['last'] = now
+    timing['last_cnt'] = stats['tweet_cnt']
 
 
 def _log_line_error(line_number, payload):
     """
     Log an import error for a specific line.
     """
-    print("Error on line {}: {}".format(line_number, payload))
+    _log_event('line_error', logging.WARNING, line_no=line_number,
+               error=str(payload))
+
+
+@functools.lru_cache(maxsize=None)
+def _language_code(name):
+    """
+    Map a language name to its two-digit code. pycountry looks names up
+    linearly, so results are memoized per process.
+    """
+    language = pycountry.languages.get(name=name)
+    if language and hasattr(language, 'alpha_2'):  # get two-digit lang code
+        return language.alpha_2
+    return None
 
 
 def _parse_covid_tweet(tweet):
     """
     Parse a tweet from the COVID-19 dataset from
        https://www.trackmyhashtag.com/data/COVID-19.zip
+    Returns a tuple of column dictionaries for the user and post tables.
     """
     # prepare user record
-    user = User()
-    user.id = int(tweet["User Id"].strip('"'))
-    user.username = tweet['Screen Name'].lower()
+    user = {'id': int(tweet["User Id"].strip('"'))}
+    user['username'] = tweet['Screen Name'].lower()
     if OBFUSCATE_USERNAME:  # optionally hash the username using SHA224
-        user_hash = hashlib.sha224(user.username.encode('utf-8'))
-        user.username = user_hash.hexdigest()
-    user.email = "{}@{}".format(user.username, EMAIL_DOMAIN)
-    user.about_me = re.sub(_EMOJI, '', tweet['User Bio'])[0:140]
-    # generate a random password
-    psw_chars = string.ascii_letters + string.digits + string.punctuation
-    psw = ''.join(random.choice(psw_chars) for _ in range(PSW_LEN))
-    user.password_hash = user.set_password(psw)
+        user_hash = hashlib.sha224(user['username'].encode('utf-8'))
+        user['username'] = user_hash.hexdigest()
+    user['email'] = "{}@{}".format(user['username'], EMAIL_DOMAIN)
+    user['about_me'] = _EMOJI.sub('', tweet['User Bio'])[0:140]
+    user['password_hash'] = UNUSABLE_PASSWORD
     # prepare post record
-    post = Post()
-    post.id = int(tweet['Tweet Id'].strip('"'))
-    post.body = re.sub(_EMOJI, '', tweet['Tweet Content'])[0:140]
-    post.user_id = user.id
+    post = {'id': int(tweet['Tweet Id'].strip('"'))}
+    post['body'] = _EMOJI.sub('', tweet['Tweet Content'])[0:140]
+    post['user_id'] = user['id']
     try:
-        post.timestamp = datetime.strptime(tweet['Tweet Posted Time (UTC)'],
-                                           '%d %b %Y %H:%M:%S')
+        post['timestamp'] = datetime.strptime(
+            tweet['Tweet Posted Time (UTC)'], '%d %b %Y %H:%M:%S')
     except Exception:  # unexpected error when parsing datetime
-        post.timestamp = DFLT_TS  # default timestamp if parsing fails
-    language = pycountry.languages.get(name=tweet['Tweet Language'])
-    if language and hasattr(language, 'alpha_2'):  # get two-digit lang code
-        post.language = language.alpha_2
+        post['timestamp'] = DFLT_TS  # default timestamp if parsing fails
+    post['language'] = _language_code(tweet['Tweet Language'])
     return user, post
 
 
-def import_csv(filename, max_import_count=0, offset=0):
+def _parse_chunk(chunk):
+    """
+    Parse a list of (line_no, offset, row) tuples. Runs in worker processes,
+    so parse errors are returned rather than raised.
+    """
+    parsed = []
+    for line_no, offset, row in chunk:
+        try:
+            user_row, post_row = _parse_covid_tweet(row)
+            parsed.append((line_no, offset, user_row, post_row, None))
+        except Exception as e:
+            parsed.append((line_no, offset, None, None, e))
+    return parsed
+
+
+def _parse_rows(rows, workers=1, chunk_size=_BATCH_SIZE):
+    """
+    Parse (line_no, offset, row) tuples, yielding (line_no, offset,
+    user_row, post_row, error) tuples in input order. With more than one
+    worker, chunks of rows are parsed in a process pool while the caller
+    writes earlier results to the database. The number of chunks in flight
+    is bounded, so large files are never read ahead into memory.
+    """
+    chunks = iter(lambda: list(itertools.islice(rows, chunk_size)), [])
+    if workers <= 1:
+        for chunk in chunks:
+            yield from _parse_chunk(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for chunk in chunks:
+                pending.append(executor.submit(_parse_chunk, chunk))
+                if len(pending) >= 2 * workers:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+        finally:
+            # the caller may stop early, e.g. when max_count is reached
+            for future in pending:
+                future.cancel()
+
+
+def _new_stats():
+    # statistics: sum of posts* and users* should match tweet_cnt
+    return {'line_no': 0, 'tweet_cnt': 0,
+            'post_ok': 0, 'post_dup': 0, 'post_err': 0,
+            'user_ok': 0, 'user_dup': 0, 'user_err': 0, 'user_posterr': 0,
+            }
+
+
+def _insert_rows(batch, stats, max_count=0):
+    """
+    Insert a batch of parsed rows one by one, committing each record.
+    Duplicates are detected through IntegrityError. Returns the number of
+    rows consumed, which is less than the batch size if max_count is hit,
+    and the IDs of the posts inserted.
+    """
+    consumed = 0
+    inserted = []
+    for line_no, user_row, post_row in batch:
+        # flags to remember insert success
+        user_ok = False
+        post_ok = False
+        # attempt to insert user
+        try:
+            db.session.add(User(**user_row))
+            db.session.commit()
+            user_ok = True  # remember user insert success
+        except IntegrityError:  # record already exists
+            stats['user_dup'] += 1
+        except Exception as e:  # unexpected error
+            stats['user_err'] += 1
+            _log_line_error(line_no, e)
+        # roll back in case user insert failed
+        if not user_ok:
+            db.session.rollback()
+        # attempt to insert post
+        try:
+            db.session.add(Post(**post_row))
+            db.session.commit()
+            post_ok = True  # remember post insert success
+            inserted.append(post_row['id'])
+            stats['post_ok'] += 1
+            stats['user_ok'] += 1 if user_ok else 0
+        except IntegrityError:  # record already exists
+            stats['post_dup'] += 1
+        except Exception as e:  # unexpected error
+            stats['post_err'] += 1
+            _log_line_error(line_no, e)
+        # roll back in case post insert failed
+        if not post_ok:
+            db.session.rollback()
+            stats['user_posterr'] += 1 if user_ok else 0
+        # total number of lines processed
+        stats['tweet_cnt'] += 1
+        stats['line_no'] = line_no
+        consumed += 1
+        # max count reached. finish.
+        if 0 < max_count <= stats['post_ok']:
+            break
+    return consumed, inserted
+
+
+def _bulk_insert_rows(batch, stats, max_count=0):
+    """
+    Insert a batch of parsed rows with one multi-row INSERT per table, in a
+    single transaction. Users are deduplicated in memory and existing users
+    and posts are found with one IN query each, so no IntegrityError round
+    trips are needed. If the batch fails anyway (e.g. two distinct users
+    mapping to the same username), it is retried row by row.
+    Returns the number of rows consumed and the IDs of the posts inserted,
+    like _insert_rows().
+    """
+    user_ids = {user_row['id'] for _, user_row, _ in batch}
+    post_ids = {post_row['id'] for _, _, post_row in batch}
+    known_users = {id for id, in db.session.query(User.id).filter(
+        User.id.in_(user_ids))}
+    known_posts = {id for id, in db.session.query(Post.id).filter(
+        Post.id.in_(post_ids))}
+    # classify rows on a copy of the statistics, so that they can be
+    # discarded if the batch has to be retried row by row
+    batch_stats = dict(stats)
+    users = {}
+    posts = {}
+    consumed = 0
+    for line_no, user_row, post_row in batch:
+        user_ok = user_row['id'] not in known_users and \
+            user_row['id'] not in users
+        if user_ok:
+            users[user_row['id']] = user_row
+        else:
+            batch_stats['user_dup'] += 1
+        if post_row['id'] in known_posts or post_row['id'] in posts:
+            batch_stats['post_dup'] += 1
+            batch_stats['user_posterr'] += 1 if user_ok else 0
+        else:
+            posts[post_row['id']] = post_row
+            batch_stats['post_ok'] += 1
+            batch_stats['user_ok'] += 1 if user_ok else 0
+        batch_stats['tweet_cnt'] += 1
+        batch_stats['line_no'] = line_no
+        consumed += 1
+        if 0 < max_count <= batch_stats['post_ok']:
+            break
+    try:
+        if users:
+            db.session.execute(User.__table__.insert(), list(users.values()))
+        if posts:
+            db.session.execute(Post.__table__.insert(), list(posts.values()))
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        _log_line_error(batch[0][0], 'bulk insert failed, retrying batch '
+                                     'row by row: {}'.format(e))
+        return _insert_rows(batch[:consumed], stats, max_count)
+    stats.update(batch_stats)
+    return consumed, list(posts)
+
+
+def _expand_sources(patterns):
+    """
+    Expand file names and glob patterns into a sorted list of files.
+    """
+    sources = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or \
+            ([pattern] if os.path.exists(pattern) else [])
+        sources += [match for match in matches if match not in sources]
+    return sources
+
+
+def _open_source(filename):
+    """
+    Open a plain, gzip or zstandard compressed file for binary reading.
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'rb')
+    if filename.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise RuntimeError('the zstandard package is required to read '
+                               '{}'.format(filename))
+        reader = zstandard.ZstdDecompressor().stream_reader(
+            open(filename, 'rb'), closefd=True)
+        return io.BufferedReader(reader)
+    return open(filename, 'rb')
+
+
+def _skip_to(stream, offset, position):
+    """
+    Move a stream forward from position to an offset of its uncompressed
+    content. Plain files seek directly. Compressed streams are decompressed
+    up to that point (gzip does so within seek()), but the skipped data is
+    never parsed as CSV.
+    """
+    if stream.seekable():
+        stream.seek(offset)
+        return
+    remaining = offset - position
+    while remaining > 0:
+        chunk = stream.read(min(remaining, _SKIP_CHUNK_SIZE))
+        if not chunk:
+            raise EOFError('offset {} is beyond the end of the file'.format(
+                offset))
+        remaining -= len(chunk)
+
+
+class _CountingLines(object):
+    """
+    Iterate over the decoded lines of a binary stream while keeping track
+    of the number of bytes consumed. The csv module only requests the lines
+    it needs for the current record, so after a record is returned, offset
+    is the exact position at which the next record starts.
+    """
+    def __init__(self, stream, offset=0):
+        self.stream = stream
+        self.offset = offset
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = self.stream.readline()
+        if not line:
+            raise StopIteration
+        self.offset += len(line)
+        return line.decode('utf-8')
+
+
+def _read_rows(stream, offset=0, line_no=0):
+    """
+    Yield (line_no, offset, row) tuples from a CSV stream, where offset is
+    the position just after the row. The header is always read from the
+    start of the stream; rows are read from offset, if given.
+    """
+    lines = _CountingLines(stream)
+    reader = csv.DictReader(lines)
+    if reader.fieldnames is None:
+        return  # empty file
+    if offset > lines.offset:
+        _skip_to(stream, offset, lines.offset)
+        lines.offset = offset
+    for row in reader:
+        yield line_no, lines.offset, row
+        line_no += 1
+
+
+def _load_checkpoint(filename):
+    if not filename or not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def _load_index_runs(filename, count):
+    """
+    Read the ID runs of the posts to index recorded along with a checkpoint.
+    Runs appended after the checkpoint was last saved belong to a batch
+    that is imported again, so they are dropped from the file.
+    """
+    if not filename:
+        return []
+    runs = []
+    if count and os.path.exists(filename + '.index'):
+        with open(filename + '.index', 'r') as f:
+            runs = [tuple(int(id) for id in line.split())
+                    for line in itertools.islice(f, count)]
+    with open(filename + '.index', 'w') as f:
+        f.writelines('{} {}\n'.format(*run) for run in runs)
+    return runs
+
+
+def _append_index_runs(filename, runs):
+    """
+    Record the ID runs of the posts inserted by a batch. They are kept in a
+    file next to the checkpoint, appended to after each batch, as there is
+    a run per post when post IDs are sparse.
+    """
+    if not filename or not runs:
+        return
+    with open(filename + '.index', 'a') as f:
+        f.writelines('{} {}\n'.format(*run) for run in runs)
+
+
+def _save_checkpoint(filename, checkpoint):
+    """
+    Atomically replace the checkpoint file.
+    """
+    if not filename:
+        return
+    checkpoint['updated'] = datetime.utcnow().isoformat() + 'Z'
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+
+def import_csv(filenames, max_import_count=0, offset=0, bulk=False,
+               batch_size=_BATCH_SIZE, workers=1, checkpoint_file=None):
     """
     Main function that coordinates the overall data import process.
     """
+    if isinstance(filenames, str):
+        filenames = [filenames]
+    sources = _expand_sources(filenames)
+    if not sources:
+        raise FileNotFoundError('no files match {}'.format(
+            ' '.join(filenames)))
     # ensure parameters are larger or equal than zero
     max_count = max(0, max_import_count)
     start_line = max(1, offset)
-    print("Importing up to {} posts from {}, starting at offset {}".
-          format("UNLIMITED" if max_count <= 0 else max_count,
-                 filename, start_line))
-    # statistics: sum of posts* and users* should match tweet_cnt
-    stats = {'line_no': 0, 'tweet_cnt': 0,
-             'post_ok': 0, 'post_dup': 0, 'post_err': 0,
-             'user_ok': 0, 'user_dup': 0, 'user_err': 0, 'user_posterr': 0,
-             }
-    # process the input file
-    with open(filename, 'r') as csv_file:
-        for line_no, row in enumerate(csv.DictReader(csv_file)):
-            if line_no <= start_line-1:
-                continue  # skip the first n lines
-            # flags to remember insert success
-            user_ok = False
-            post_ok = False
-            # construct user and post objects from tweet dictionary
-            try:
-                user, post = _parse_covid_tweet(row)
-            except Exception as e:
-                stats['user_err'] += 1
-                stats['post_err'] += 1
-                _log_line_error(line_no, e)
-                continue  # failed to parse line, try the next record
-            # attempt to insert user
-            try:
-                db.session.add(user)
-                db.session.commit()
-                user_ok = True  # remember user insert success
-            except IntegrityError:  # record already exists
-                stats['user_dup'] += 1
-            except Exception as e:  # unexpected error
+    batch_size = max(1, batch_size)
+    checkpoint = _load_checkpoint(checkpoint_file)
+    if checkpoint is None:
+        checkpoint = {'done': [], 'file': None, 'offset': 0, 'line_no': 0,
+                      'stats': _new_stats(), 'index_runs': 0}
+        skip = start_line  # skip the first n lines of the first file
+    else:
+        skip = 0
+    stats = checkpoint['stats']
+    _log_event('start', max_count=max_count, files=sources,
+               resume_file=checkpoint['file'],
+               resume_offset=checkpoint['offset'])
+    insert_batch = _bulk_insert_rows if bulk else _insert_rows
+    now = time.monotonic()
+    timing = {'start': now, 'last': now, 'last_cnt': stats['tweet_cnt']}
+    # index imported posts in bulk once the load is complete, instead of
+    # one request per post after each commit
+    with SearchableMixin.deferred_indexing() as deferred:
+        for first_id, last_id in _load_index_runs(
+                checkpoint_file, checkpoint['index_runs']):
+            deferred.add_range(Post, first_id, last_id)
+        for filename in sources:
+            if filename in checkpoint['done']:
+                continue
+            with _open_source(filename) as stream:
+                if checkpoint['file'] == filename:
+                    # resume right after the last committed row
+                    rows = _read_rows(stream, checkpoint['offset'],
+                                      checkpoint['line_no'] + 1)
+                else:
+                    checkpoint.update({'file': filename, 'offset': 0,
+                                       'line_no': 0})
+                    rows = itertools.islice(_read_rows(stream), skip, None)
+                skip = 0
+                finished = _import_rows(rows, stats, checkpoint,
+                                        insert_batch, max_count, batch_size,
+                                        workers, checkpoint_file, timing,
+                                        deferred)
+            if finished:
+                break
+            checkpoint['done'].append(filename)
+            checkpoint.update({'file': None, 'offset': 0, 'line_no': 0})
+            _save_checkpoint(checkpoint_file, checkpoint)
+            _log_event('file_done', file=filename, stats=stats)
+        _log_event('index', ranges=len(deferred.ranges.get(Post, [])))
+    # bulk inserts bypass the session, which keeps the explore window current
+    recent_posts.invalidate()
+    _log_event('done', elapsed=round(time.monotonic() - timing['start'], 3),
+               stats=stats)
+    return stats
+
+
+def _import_rows(rows, stats, checkpoint, insert_batch, max_count,
+                 batch_size, workers, checkpoint_file, timing, deferred):
+    """
+    Parse and insert the rows of one file in batches, recording a checkpoint
+    after each committed batch. Returns True once max_count is reached.
+    """
+    def count_errors(consumed):
+        # parse errors are counted along with the rows read before them, as
+        # rows after the last one consumed are read again when resuming
+        for position, line_no, error in errors:
+            if position < consumed or consumed == len(batch):
                 stats['user_err'] += 1
-                _log_line_error(line_no, e)
-            # roll back in case user insert failed
-            if not user_ok:
-                db.session.rollback()
-            # attempt to insert post
-            try:
-                db.session.add(post)
-                db.session.commit()
-                post_ok = True  # remember post insert success
-                stats['post_ok'] += 1
-                stats['user_ok'] += 1 if user_ok else 0
-            except IntegrityError:  # record already exists
-                stats['post_dup'] += 1
-            except Exception as e:  # unexpected error
                 stats['post_err'] += 1
-                _log_line_error(line_no, e)
-            # roll back in case post insert failed
-            if not post_ok:
-                db.session.rollback()
-                stats['user_posterr'] += 1 if user_ok else 0
-            # total number of lines processed
-            stats['tweet_cnt'] += 1
-            # max count reached. finish.
-            if 0 < max_count <= stats['post_ok']:
-                stats['line_no'] = line_no
-                _print_progress(stats)
-                break
-            # print progress after each batch
-            if stats['tweet_cnt'] % _BATCH_SIZE == 0:
-                stats['line_no'] = line_no
-                _print_progress(stats)
+                _log_line_error(line_no, error)
+
+    def commit_batch():
+        consumed, inserted = insert_batch(batch, stats, max_count)
+        count_errors(consumed)
+        # the posts inserted are indexed after the load. Rows inserted with
+        # Core statements bypass the session listeners, so they have to be
+        # recorded here; duplicates are not, as they were not imported
+        runs = deferred.add(Post, inserted)
+        _append_index_runs(checkpoint_file, runs)
+        checkpoint['index_runs'] += len(runs)
+        checkpoint['offset'] = offsets[consumed - 1]
+        checkpoint['line_no'] = batch[consumed - 1][0]
+        _save_checkpoint(checkpoint_file, checkpoint)
+        # print progress after each batch
+        _print_progress(stats, timing, file=checkpoint['file'],
+                        offset=checkpoint['offset'])
+        return 0 < max_count <= stats['post_ok']
+
+    batch = []
+    offsets = []
+    # (number of rows in the batch before it, line_no, error) per parse error
+    errors = []
+    # construct user and post records from tweet dictionaries
+    for line_no, offset, user_row, post_row, error in _parse_rows(
+            rows, workers, batch_size):
+        if error is not None:
+            errors.append((len(batch), line_no, error))
+            continue  # failed to parse line, try the next record
+        batch.append((line_no, user_row, post_row))
+        offsets.append(offset)
+        if len(batch) < batch_size:
+            continue
+        # max count reached. finish.
+        if commit_batch():
+            return True
+        batch = []
+        offsets = []
+        errors = []
+    if batch:
+        return commit_batch()
+    count_errors(0)
+    return False
 
 
 if __name__ == '__main__':
     param = parse_arguments()
+    _setup_progress_log(param.progress_log)
     # set up flask app
     app = create_app()
     app_context = app.app_context()
     app_context.push()
     # perform the actual import
-    import_csv(filename=param.filename, max_import_count=param.max_posts,
-               offset=param.offset)
+    import_csv(filenames=param.filenames, max_import_count=param.max_posts,
+               offset=param.offset, bulk=param.bulk,
+               batch_size=param.batch_size, workers=param.workers,
+               checkpoint_file=param.checkpoint)
     # tear down flask app
     db.session.remove()
     app_context.pop()
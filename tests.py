@@ -1,15 +1,40 @@
 #!/usr/bin/env python
+import asyncio
+import csv
+import gzip
 from datetime import datetime, timedelta
+import json
+import logging
+import os
+import tempfile
+from queue import Queue
+from time import sleep, time
 import unittest
-from app import create_app, db
-from app.models import User, Post
+from unittest import mock
+from flask import Flask, g, render_template, session
+from app import create_app, db, cli
+from app.cache import Cache, MISSING
+from app.bench import micro
+from app.bench.micro import count_statements
+from app.followgraph import FollowGraph, build
+from app.fragments import render_posts
+from app.logs import DedupSMTPHandler
+from app.metrics import Metrics
+from app.models import User, Post, Message, Conversation, Notification, \
+    followers
+from app.pagination import newest_first
+from app.profiling import generate_profile_token, latest_profiles
+from app.viewmodels import post_rows, post_views, recent_post_views
 from config import Config
+from scripts import tweet_importer
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
     ELASTICSEARCH_URL = None
+    CACHE_USE_REDIS = False
+    EXPLORE_CACHE_PAGES = 0
 
 
 class UserModelCase(unittest.TestCase):
@@ -98,5 +123,1217 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f4, [p4])
 
 
+class PostAPICase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+        self.u1 = User(id=1, username='john', email='john@example.com')
+        self.u2 = User(id=2, username='susan', email='susan@example.com')
+        db.session.add_all([self.u1, self.u2])
+        now = datetime.utcnow()
+        db.session.add_all([
+            Post(id=i, body='post {}'.format(i), user_id=1 + i % 2,
+                 timestamp=now + timedelta(seconds=i // 2))
+            for i in range(1, 8)])
+        self.u1.follow(self.u2)
+        token = self.u1.get_token()
+        db.session.commit()
+        self.headers = {'Authorization': 'Bearer ' + token}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def get(self, url, **headers):
+        return self.client.get(url, headers=dict(self.headers, **headers))
+
+    def test_sql_instrumentation(self):
+        self.app.config['SQL_N_PLUS_ONE_THRESHOLD'] = 2
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            r = self.get('/api/users')
+        self.assertEqual(r.status_code, 200)
+        self.assertRegex(r.headers['Server-Timing'],
+                         r'^db;dur=[\d.]+;desc="\d+ queries", app;dur=')
+        # the follower counts of every user are separate queries
+        self.assertTrue(any('Possible N+1 in api.get_users' in line
+                            for line in logs.output))
+        stats = self.app.extensions['sql_instrumentation'].endpoint_stats()
+        self.assertEqual(stats['api.get_users']['requests'], 1)
+        self.assertGreaterEqual(stats['api.get_users']['statements'], 6)
+
+    def test_followed_by_me(self):
+        db.session.add_all([
+            User(id=i, username='user{}'.format(i),
+                 email='user{}@example.com'.format(i)) for i in (3, 4, 5)])
+        db.session.commit()
+        self.assertEqual(self.u1.following_status([2, 3]), {2: True, 3: False})
+
+        def follow_lookups(url):
+            # statements reading the follows of the token's user, as
+            # opposed to the follow counts of the users listed
+            with count_statements() as counter:
+                data = self.get(url).get_json()
+            return data, len([statement for statement in counter.statements
+                              if ' '.join(statement.split()).startswith(
+                                  'SELECT followers.followed_id')])
+
+        data, lookups = follow_lookups('/api/users')
+        self.assertEqual({u['id']: u['is_followed_by_me']
+                          for u in data['items']},
+                         {1: False, 2: True, 3: False, 4: False, 5: False})
+        self.assertEqual(lookups, 1)
+        data, lookups = follow_lookups('/api/users?per_page=2')
+        self.assertEqual(len(data['items']), 2)
+        self.assertEqual(lookups, 1)
+        data = self.get('/api/users/2').get_json()
+        self.assertTrue(data['is_followed_by_me'])
+
+    def test_cursor_pagination(self):
+        ids = []
+        url = '/api/posts?per_page=3'
+        while url:
+            data = self.get(url).get_json()
+            ids += [item['id'] for item in data['items']]
+            url = data['_links']['next']
+        self.assertEqual(ids, [7, 6, 5, 4, 3, 2, 1])
+        r = self.get('/api/users/2/posts')
+        self.assertEqual([item['id'] for item in r.get_json()['items']],
+                         [7, 5, 3, 1])
+        r = self.get('/api/posts?cursor=bogus')
+        self.assertEqual(r.status_code, 400)
+
+    def test_conditional_get(self):
+        r = self.get('/api/timeline')
+        self.assertEqual(r.status_code, 200)
+        self.assertIsNotNone(r.headers.get('Last-Modified'))
+        etag = r.headers['ETag']
+        r = self.get('/api/timeline', **{'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.data, b'')
+        db.session.add(Post(id=8, body='new post', user_id=2,
+                            timestamp=datetime.utcnow() + timedelta(hours=1)))
+        db.session.commit()
+        r = self.get('/api/timeline', **{'If-None-Match': etag})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.get_json()['items'][0]['id'], 8)
+
+    def test_timeline_since(self):
+        data = self.get('/api/timeline/since?limit=2').get_json()
+        self.assertEqual([item['id'] for item in data['items']], [7, 6])
+        self.assertTrue(data['_meta']['more'])
+        cursor = data['_meta']['cursor']
+        data = self.get('/api/timeline/since?cursor=' + cursor).get_json()
+        self.assertEqual(data['items'], [])
+        self.assertEqual(data['_meta']['cursor'], cursor)
+        db.session.add(Post(id=8, body='new post', user_id=2,
+                            timestamp=datetime.utcnow() + timedelta(hours=1)))
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['_user_id'] = '1'
+        data = self.client.get('/timeline/since?cursor=' + cursor).get_json()
+        self.assertEqual(len(data['posts']), 1)
+        self.assertIn('new post', data['posts'][0])
+        self.assertFalse(data['more'])
+
+    def test_timeline_since_backlog(self):
+        cursor = self.get('/api/timeline/since').get_json()['_meta']['cursor']
+        later = datetime.utcnow() + timedelta(hours=1)
+        db.session.add_all([
+            Post(id=i, body='post {}'.format(i), user_id=2,
+                 timestamp=later + timedelta(seconds=i))
+            for i in range(8, 13)])
+        db.session.commit()
+        # more new posts than the limit are all seen, oldest batch first
+        batches = []
+        more = True
+        while more:
+            data = self.get('/api/timeline/since?limit=2&cursor=' +
+                            cursor).get_json()
+            batches.append([item['id'] for item in data['items']])
+            cursor = data['_meta']['cursor']
+            more = data['_meta']['more']
+        self.assertEqual(batches, [[9, 8], [11, 10], [12]])
+
+
+class FakeElasticsearch(object):
+    def __init__(self):
+        self.indexed = []
+
+    def index(self, index, id, body):
+        self.indexed.append(id)
+
+
+class SearchIndexCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.app.elasticsearch = FakeElasticsearch()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_deferred_indexing(self):
+        bulk_indexed = []
+
+        def add_to_index_bulk(index, models):
+            bulk_indexed.extend(model.id for model in models)
+            return len(models)
+
+        with mock.patch('app.models.add_to_index_bulk', add_to_index_bulk):
+            with Post.deferred_indexing() as deferred:
+                db.session.add(Post(id=10, body='orm'))
+                db.session.commit()
+                db.session.execute(Post.__table__.insert(), [
+                    {'id': i, 'body': 'core'} for i in (20, 21, 22)])
+                db.session.commit()
+                deferred.add(Post, [20, 21, 22])
+                self.assertEqual(self.app.elasticsearch.indexed, [])
+                self.assertEqual(deferred.ranges[Post], [(10, 10), (20, 22)])
+        self.assertEqual(bulk_indexed, [10, 20, 21, 22])
+
+        # per-commit indexing is restored afterwards
+        db.session.add(Post(id=30, body='orm'))
+        db.session.commit()
+        self.assertEqual(self.app.elasticsearch.indexed, [30])
+
+
+TWEET_FIELDS = ['Tweet Id', 'Tweet Posted Time (UTC)', 'Tweet Content',
+                'Tweet Language', 'User Id', 'Screen Name', 'User Bio']
+
+
+def tweet_row(tweet_id, user_id, text='hello', screen_name=None):
+    return {'Tweet Id': '"{}"'.format(tweet_id),
+            'Tweet Posted Time (UTC)': '01 Apr 2020 10:00:00',
+            'Tweet Content': text, 'Tweet Language': 'English',
+            'User Id': '"{}"'.format(user_id),
+            'Screen Name': screen_name or 'user{}'.format(user_id),
+            'User Bio': ''}
+
+
+class ImporterCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmpdir.cleanup()
+
+    def write_csv(self, name, rows, open=open):
+        path = os.path.join(self.tmpdir.name, name)
+        with open(path, 'wt', newline='') as f:
+            writer = csv.DictWriter(f, TWEET_FIELDS)
+            writer.writeheader()
+            # the default line offset of 1 skips the first row
+            writer.writerow(tweet_row(1, 1, 'skipped'))
+            writer.writerows(rows)
+        return path
+
+    def imported(self):
+        return [id for id, in db.session.query(Post.id).order_by(Post.id)], \
+            [id for id, in db.session.query(User.id).order_by(User.id)]
+
+    def test_import(self):
+        rows = [tweet_row(100, 10), tweet_row(101, 10),
+                dict(tweet_row(0, 10), **{'Tweet Id': 'bogus'}),
+                tweet_row(100, 11), tweet_row(102, 12)]
+        expected = {'line_no': 5, 'tweet_cnt': 4,
+                    'post_ok': 3, 'post_dup': 1, 'post_err': 1,
+                    'user_ok': 2, 'user_dup': 1, 'user_err': 1,
+                    'user_posterr': 1}
+        for bulk, name, open_ in ((False, 'tweets.csv', open),
+                                  (True, 'tweets.csv.gz', gzip.open)):
+            path = self.write_csv(name, rows, open_)
+            with self.assertLogs('tweet_importer') as logs:
+                stats = tweet_importer.import_csv(path, bulk=bulk)
+            self.assertEqual(stats, expected)
+            self.assertEqual(self.imported(),
+                             ([100, 101, 102], [10, 11, 12]))
+            self.assertTrue(any('line_error' in line and '"line_no": 3' in
+                                line for line in logs.output))
+            Post.query.delete()
+            User.query.delete()
+            db.session.commit()
+
+    def test_bulk_fallback(self):
+        # distinct users with the same username make the bulk insert fail
+        path = self.write_csv('tweets.csv', [
+            tweet_row(200, 20, screen_name='same'),
+            tweet_row(201, 21, screen_name='same')])
+        with self.assertLogs('tweet_importer') as logs, mock.patch.object(
+                tweet_importer.recent_posts, 'invalidate') as invalidate:
+            stats = tweet_importer.import_csv(path, bulk=True)
+        self.assertTrue(any('row by row' in line for line in logs.output))
+        invalidate.assert_called_once_with()
+        self.assertEqual(self.imported(), ([200, 201], [20]))
+        self.assertEqual((stats['post_ok'], stats['user_ok'],
+                          stats['user_dup']), (2, 1, 1))
+
+    def test_parallel_parse(self):
+        rows = [tweet_row(400 + i, 40 + i % 3) for i in range(7)]
+        rows.insert(4, dict(tweet_row(0, 40), **{'User Id': 'bogus'}))
+        path = self.write_csv('tweets.csv', rows)
+        with self.assertLogs('tweet_importer'):
+            stats = tweet_importer.import_csv(path, batch_size=2, workers=2)
+        self.assertEqual(self.imported(),
+                         ([400 + i for i in range(7)], [40, 41, 42]))
+        self.assertEqual((stats['tweet_cnt'], stats['post_ok'],
+                          stats['post_err']), (7, 7, 1))
+
+    def test_resume(self):
+        rows = [tweet_row(300 + i, 30) for i in range(6)]
+        rows.insert(2, dict(tweet_row(0, 30), **{'Tweet Id': 'bogus'}))
+        path = self.write_csv('tweets.csv.gz', rows, gzip.open)
+        checkpoint = os.path.join(self.tmpdir.name, 'checkpoint.json')
+        # the limit is reached in the middle of a batch, before the row
+        # that fails to parse
+        with self.assertLogs('tweet_importer'):
+            stats = tweet_importer.import_csv(
+                path, max_import_count=2, bulk=True, batch_size=3,
+                checkpoint_file=checkpoint)
+        self.assertEqual((stats['post_ok'], stats['post_err']), (2, 0))
+        self.assertEqual(self.imported()[0], [300, 301])
+        with self.assertLogs('tweet_importer'):
+            stats = tweet_importer.import_csv(
+                path, bulk=True, batch_size=3, checkpoint_file=checkpoint)
+        self.assertEqual(self.imported()[0], [300 + i for i in range(6)])
+        self.assertEqual((stats['tweet_cnt'], stats['post_ok'],
+                          stats['post_dup'], stats['post_err']), (6, 6, 0, 1))
+
+    def test_deferred_indexing(self):
+        # tweet IDs are sparse: existing posts fall between imported ones
+        base = 1250000000000000000
+        db.session.add(User(id=1, username='john', email='john@example.com'))
+        db.session.add_all([Post(id=base + i, body='existing', user_id=1)
+                            for i in (5, 10)])
+        db.session.commit()
+        path = self.write_csv('tweets.csv', [
+            tweet_row(base + i, 2) for i in (0, 1, 10, 20)])
+        self.app.elasticsearch = FakeElasticsearch()
+        bulk_indexed = []
+
+        def add_to_index_bulk(index, models):
+            bulk_indexed.extend(model.id for model in models)
+            return len(models)
+
+        with mock.patch('app.models.add_to_index_bulk', add_to_index_bulk):
+            stats = tweet_importer.import_csv(path, bulk=True)
+        self.assertEqual((stats['post_ok'], stats['post_dup']), (3, 1))
+        # neither the existing posts in between nor the duplicate are indexed
+        self.assertEqual(bulk_indexed, [base, base + 1, base + 20])
+
+
+class BenchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        cli.register(self.app)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmpdir.cleanup()
+
+    def test_seed_and_micro(self):
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['bench', 'seed', '--users', '5',
+                                     '--posts', '3', '--follows', '2',
+                                     '--random-seed', '1'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('Created users user1 to user5', result.output)
+        self.assertEqual(User.query.count(), 5)
+        self.assertGreater(Post.query.count(), 0)
+
+        output = os.path.join(self.tmpdir.name, 'micro.json')
+        result = runner.invoke(args=['bench', 'micro', '--repeat', '1',
+                                     '--warmup', '0', '--output', output])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('User.to_dict', result.output)
+        report = micro.load(output)
+        self.assertEqual(set(report['results']),
+                         set(name for name, _, _ in micro.BENCHMARKS))
+        self.assertIn('vs ', micro.format_report(report, report))
+
+
+class FakeRedisKeys(object):
+    def __init__(self):
+        self.keys = {}
+
+    def set(self, name, value, px=None):
+        self.keys[name] = value
+
+    def exists(self, name):
+        return int(name in self.keys)
+
+
+class ReplicaConfig(TestConfig):
+    SQLALCHEMY_BINDS = {'replica0': 'sqlite://'}
+
+
+class ReplicaRoutingCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(ReplicaConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        # the replica has the schema but lags behind: it has no rows yet
+        db.metadata.create_all(db.get_engine(self.app, bind='replica0'))
+        db.session.add(User(id=1, username='john', email='john@example.com'))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        db.metadata.drop_all(db.get_engine(self.app, bind='replica0'))
+        self.app_context.pop()
+
+    def test_reads_go_to_replica(self):
+        with self.app.app_context(), \
+                self.app.test_request_context('/', method='GET'):
+            self.assertEqual(User.query.count(), 0)
+        with self.app.app_context(), \
+                self.app.test_request_context('/', method='POST'):
+            self.assertEqual(User.query.count(), 1)
+        # work outside of requests always uses the primary
+        self.assertEqual(User.query.count(), 1)
+
+    def test_read_your_writes(self):
+        with self.app.app_context(), \
+                self.app.test_request_context('/', method='POST'):
+            db.session.add(Post(id=1, body='hi', user_id=1))
+            db.session.flush()
+            self.assertEqual(Post.query.count(), 1)
+            db.session.commit()
+            pinned_until = session['_db_primary_until']
+            self.assertGreater(pinned_until, time())
+        with self.app.app_context(), \
+                self.app.test_request_context('/', method='GET'):
+            session['_db_primary_until'] = pinned_until
+            self.assertEqual(Post.query.count(), 1)
+        with self.app.app_context(), \
+                self.app.test_request_context('/', method='GET'):
+            session['_db_primary_until'] = time() - 1
+            self.assertEqual(Post.query.count(), 0)
+
+    def test_read_your_writes_api(self):
+        user = User.query.get(1)
+        token = user.get_token()
+        db.session.commit()
+        # the replica has the user and its token, but not later changes
+        row = {c.key: getattr(user, c.key) for c in User.__table__.columns}
+        db.get_engine(self.app, bind='replica0').execute(
+            User.__table__.insert(), row)
+        db.session.add(User(id=2, username='susan', email='susan@example.com'))
+        db.session.commit()
+        self.app.redis = FakeRedisKeys()
+        client = self.app.test_client(use_cookies=False)
+        headers = {'Authorization': 'Bearer ' + token}
+
+        def request(method, url, **kwargs):
+            # each request in its own application context, as when served
+            with self.app.app_context():
+                return client.open(url, method=method, headers=headers,
+                                   **kwargs)
+
+        def users_seen():
+            return request('GET', '/api/users').get_json()['_meta'][
+                'total_items']
+
+        self.assertEqual(users_seen(), 1)
+        r = request('PUT', '/api/users/1', json={'about_me': 'updated'})
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('db_primary_until:1', self.app.redis.keys)
+        self.assertEqual(users_seen(), 2)
+        r = request('GET', '/api/users/1')
+        self.assertEqual(r.get_json()['about_me'], 'updated')
+        # once the pin expires reads go to the replica again
+        self.app.redis.keys.clear()
+        self.assertEqual(users_seen(), 1)
+
+
+class MetricsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.metrics = self.app.extensions['metrics']
+        self.metrics.values = {}
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_metrics_endpoint(self):
+        client = self.app.test_client()
+        client.get('/auth/login')
+        client.get('/auth/login')
+        User.query.all()
+        with mock.patch('app.metrics.rq_queue_gauges', return_value=[]):
+            text = client.get('/metrics').get_data(as_text=True)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+        self.assertIn('http_request_duration_seconds_count'
+                      '{endpoint="auth.login",method="GET"} 2', text)
+        self.assertIn('http_requests_total'
+                      '{endpoint="auth.login",method="GET",status="200"} 2',
+                      text)
+        self.assertIn('db_query_duration_seconds_bucket'
+                      '{operation="SELECT",le="+Inf"}', text)
+
+    def test_shared_directory(self):
+        with tempfile.TemporaryDirectory() as directory:
+            # one application per worker process
+            workers = []
+            for duration in (0.02, 3):
+                app = Flask(__name__)
+                app.config.from_object(TestConfig)
+                app.config['METRICS_DIR'] = directory
+                worker = Metrics(app)
+                workers.append(worker)
+                worker.observe('http_request_duration_seconds', duration,
+                               endpoint='main.index', method='GET')
+                worker.flush(force=True)
+            key = ('http_request_duration_seconds',
+                   (('endpoint', 'main.index'), ('method', 'GET')))
+            data = workers[0].collect()[key]
+        self.assertEqual(data[-1], 2)
+        self.assertAlmostEqual(data[-2], 3.02)
+        self.assertEqual(data[2] + data[9], 2)
+
+
+class ProfilingCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = create_app(TestConfig)
+        self.app.config['PROFILE_DIR'] = self.directory.name
+        self.app.config['ADMINS'] = ['admin@example.com']
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        db.session.add_all([
+            User(id=1, username='admin', email='admin@example.com'),
+            User(id=2, username='john', email='john@example.com')])
+        db.session.commit()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.directory.cleanup()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = str(user_id)
+
+    def test_profile_request(self):
+        self.client.get('/auth/login', headers={'X-Profile': 'forged'})
+        self.assertEqual(latest_profiles(self.directory.name), [])
+
+        token = generate_profile_token('admin@example.com')
+        r = self.client.get('/auth/login?profile=' + token)
+        self.assertEqual(r.status_code, 200)
+        profiles = latest_profiles(self.directory.name)
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]['label'], 'GET /auth/login')
+        self.assertEqual(profiles[0]['status'], 200)
+        self.assertEqual(profiles[0]['admin'], 'admin@example.com')
+        for ext in ('prof', 'collapsed'):
+            self.assertTrue(os.path.exists(os.path.join(
+                self.directory.name, profiles[0]['name'] + '.' + ext)))
+
+    def test_profiles_view(self):
+        self.login(2)
+        self.assertEqual(self.client.get('/admin/profiles').status_code, 403)
+        self.login(1)
+        r = self.client.get('/admin/profiles')
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(b'X-Profile', r.data)
+
+
+class LoggingCase(unittest.TestCase):
+    def test_error_mail_dedup(self):
+        handler = DedupSMTPHandler('localhost', 'app@example.com',
+                                   ['admin@example.com'], 'Failure',
+                                   interval=600, max_mails=2)
+        records = [logging.makeLogRecord({
+            'msg': 'failure', 'pathname': path, 'lineno': 1,
+            'levelno': logging.ERROR}) for path in ('a', 'a', 'a', 'b', 'c')]
+        with mock.patch('logging.handlers.SMTPHandler.emit') as emit:
+            for record in records:
+                handler.emit(record)
+            self.assertEqual(emit.call_count, 2)
+            handler.sent[('a', 1)] -= 600
+            handler.window_start -= 600
+            handler.emit(records[0])
+        self.assertEqual(emit.call_count, 3)
+        self.assertIn('2 more occurrences', emit.call_args[0][0].msg)
+
+    def test_error_mail_dedup_exceptions(self):
+        app = Flask(__name__)
+        app.config['PROPAGATE_EXCEPTIONS'] = False
+
+        @app.route('/a')
+        def a():
+            raise ValueError('a')
+
+        @app.route('/b')
+        def b():
+            raise KeyError('b')
+
+        handler = DedupSMTPHandler('localhost', 'app@example.com',
+                                   ['admin@example.com'], 'Failure')
+        app.logger.addHandler(handler)
+        client = app.test_client()
+        with mock.patch('logging.handlers.SMTPHandler.emit') as emit:
+            for url in ('/a', '/b', '/a'):
+                self.assertEqual(client.get(url).status_code, 500)
+        self.assertEqual(emit.call_count, 2)
+
+
+class FakeRedisPubSub(object):
+    """Key/value commands and pub/sub shared by several cache instances."""
+    def __init__(self):
+        self.values = {}
+        self.queues = []
+
+    def get(self, name):
+        return self.values.get(name)
+
+    def mget(self, names):
+        return [self.values.get(name) for name in names]
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def setex(self, name, ttl, value):
+        self.values[name] = value
+
+    def delete(self, *names):
+        for name in names:
+            self.values.pop(name, None)
+
+    def publish(self, channel, message):
+        for queue in self.queues:
+            queue.put({'data': message.encode('utf-8')})
+
+    def execute(self):
+        pass
+
+    def pubsub(self, ignore_subscribe_messages=False):
+        redis = self
+
+        class PubSub(object):
+            def subscribe(self, channel):
+                self.queue = Queue()
+                redis.queues.append(self.queue)
+
+            def listen(self):
+                while True:
+                    yield self.queue.get()
+
+        return PubSub()
+
+
+class CacheCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.cache = self.app.extensions['cache']
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_get_or_set(self):
+        calls = []
+
+        def compute(value):
+            calls.append(value)
+            return value
+
+        self.assertEqual(self.cache.get_or_set('a', lambda: compute(1)), 1)
+        self.assertEqual(self.cache.get_or_set('a', lambda: compute(2)), 1)
+        # None is only cached with a negative TTL
+        self.assertIsNone(self.cache.get_or_set('b', lambda: compute(None)))
+        self.assertIsNone(self.cache.get_or_set('b', lambda: compute(None),
+                                                negative_ttl=10))
+        self.assertIsNone(self.cache.get_or_set('b', lambda: compute(3)))
+        self.assertEqual(calls, [1, None, None])
+        self.cache.delete('a')
+        self.assertEqual(self.cache.get_many(['a', 'b']), {'b': None})
+        self.assertIsNotNone(self.cache.stats()['hit_ratio'])
+
+    def test_invalidation_broadcast(self):
+        self.app.redis = FakeRedisPubSub()
+        reader = Cache(self.app)
+        self.app.extensions['cache'] = self.cache
+        self.cache.use_redis = reader.use_redis = True
+        self.cache.set('a', 1)
+        # the reader only ever reads, but still hears about the deletion
+        self.assertEqual(reader.get('a'), 1)
+        self.assertIn('a', reader.local)
+        self.cache.delete('a')
+        for _ in range(100):
+            if 'a' not in reader.local:
+                break
+            sleep(0.01)
+        self.assertIs(reader.get('a'), MISSING)
+
+    def test_cached_users(self):
+        self.assertIsNone(User.get_cached_by_username('john'))
+        db.session.add(User(id=1, username='john', email='john@example.com',
+                            about_me='hi'))
+        db.session.commit()
+        db.session.remove()
+
+        # the negative entry was dropped when the user was created
+        user = User.get_cached_by_username('john')
+        self.assertEqual(user.about_me, 'hi')
+        self.assertIs(User.get_cached(1), user)
+        with mock.patch.object(self.cache, 'delete') as delete:
+            user.last_seen = datetime.utcnow()
+            db.session.commit()
+        delete.assert_not_called()
+
+        user.username = 'johnny'
+        db.session.commit()
+        db.session.remove()
+        self.assertIsNone(User.get_cached_by_username('john'))
+        self.assertEqual(User.get_cached(1).username, 'johnny')
+        self.assertEqual(User.get_cached_by_username('johnny').id, 1)
+
+        # a user the session already holds is not overwritten by the cache
+        db.session.remove()
+        user = User.query.get(1)
+        user.about_me = 'pending'
+        self.assertIs(User.get_cached(1), user)
+        self.assertEqual(user.about_me, 'pending')
+        self.assertIn(user, db.session.dirty)
+
+    def test_post_hydration(self):
+        u1 = User(id=1, username='john', email='john@example.com')
+        u2 = User(id=2, username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2] + [
+            Post(id=i, body='post {}'.format(i), user_id=1 + i % 2)
+            for i in range(1, 4)])
+        db.session.commit()
+        db.session.remove()
+
+        with count_statements() as counter:
+            posts = Post.hydrate([3, 1, 99, 2])
+        self.assertEqual(counter.count, 2)
+        self.assertEqual([p.id for p in posts], [3, 1, 2])
+        db.session.remove()
+        with count_statements() as counter:
+            posts = Post.hydrate([3, 1, 2])
+            authors = [p.author.username for p in posts]
+        self.assertEqual(counter.count, 0)
+        self.assertEqual(authors, ['susan', 'susan', 'john'])
+
+        # edits and deletions are seen right away
+        posts[0].body = 'edited'
+        db.session.delete(posts[1])
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual([p.body for p in Post.hydrate([3, 1, 2])],
+                         ['edited', 'post 2'])
+
+    def test_post_fragments(self):
+        u = User(id=1, username='john', email='john@example.com')
+        p = Post(id=1, body='hello', author=u, timestamp=datetime.utcnow())
+        db.session.add_all([u, p])
+        db.session.commit()
+        with self.app.test_request_context():
+            g.locale = 'en'
+            with mock.patch('app.fragments.render_template',
+                            wraps=render_template) as render:
+                html = render_posts([p])
+                self.assertEqual(render_posts([p]), html)
+                self.assertEqual(render.call_count, 1)
+                self.assertIn('hello', html[0])
+
+                # a profile change or another locale render new fragments
+                u.username = 'johnny'
+                db.session.commit()
+                self.assertIn('johnny', render_posts([p])[0])
+                g.locale = 'es'
+                render_posts([p])
+                self.assertEqual(render.call_count, 3)
+
+
+class ConversationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_conversations(self):
+        u1 = User(id=1, username='john', email='john@example.com')
+        u2 = User(id=2, username='susan', email='susan@example.com')
+        u3 = User(id=3, username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        for sender, recipient in ((u1, u2), (u2, u1), (u1, u2), (u3, u2)):
+            msg = Message(author=sender, recipient=recipient, body='hi')
+            Conversation.between(sender, recipient).add_message(msg)
+            db.session.add(msg)
+            db.session.commit()
+        self.assertEqual(Conversation.query.count(), 2)
+        self.assertEqual(u1.new_messages(), 1)
+        self.assertEqual(u2.new_messages(), 3)
+        self.assertEqual([c.other(u2) for c in newest_first(
+            u2.conversations(), Conversation)], [u3, u1])
+
+        with self.client.session_transaction() as sess:
+            sess['_user_id'] = '2'
+        r = self.client.get('/messages')
+        self.assertEqual(r.status_code, 200)
+        self.assertIn(b'/messages/mary', r.data)
+        r = self.client.get('/messages/john')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(u2.new_messages(), 1)
+        self.assertEqual(u1.new_messages(), 1)
+        self.assertEqual(self.client.get('/messages?cursor=x').status_code,
+                         400)
+
+
+class NotificationCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_upsert(self):
+        u = User(id=1, username='john', email='john@example.com')
+        db.session.add(u)
+        with count_statements() as counter:
+            for i in range(5):
+                u.add_notification('task_progress', i)
+            u.add_notification('unread_message_count', 1)
+            db.session.commit()
+        # the user, then per notification an UPDATE that matches no row and
+        # an INSERT within a savepoint
+        self.assertEqual(counter.count, 1 + 2 * 4)
+        with count_statements() as counter:
+            u.add_notification('task_progress', 99)
+            u.add_notification('task_progress', 100)
+            db.session.commit()
+        self.assertEqual(counter.count, 1)
+        notifications = {n.name: n for n in Notification.query}
+        self.assertEqual(len(notifications), 2)
+        self.assertEqual(notifications['task_progress'].get_data(), 100)
+        self.assertEqual(notifications['task_progress'].version, 2)
+        self.assertEqual(notifications['unread_message_count'].version, 1)
+
+        u.add_notification('discarded', 1)
+        db.session.rollback()
+        db.session.commit()
+        self.assertEqual(Notification.query.count(), 2)
+
+    def test_compact(self):
+        db.session.add(User(id=1, username='john', email='john@example.com'))
+        db.session.add_all([
+            Notification(user_id=1, name='n{}'.format(i), payload_json='0',
+                         timestamp=time() - 3600 * i) for i in range(5)])
+        db.session.commit()
+        self.assertEqual(Notification.compact(3600 * 1.5, batch_size=2), 3)
+        self.assertEqual(sorted(n.name for n in Notification.query),
+                         ['n0', 'n1'])
+
+
+class FakeRedisStream(object):
+    def __init__(self):
+        self.entries = []
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def execute(self):
+        pass
+
+    def xadd(self, name, fields, maxlen=None):
+        entry_id = '{}-0'.format(len(self.entries) + 1).encode()
+        self.entries.append((entry_id, {
+            k.encode(): str(v).encode() for k, v in fields.items()}))
+
+    def xlen(self, name):
+        return len(self.entries)
+
+    def xrange(self, name, count=None):
+        return self.entries[:count]
+
+    def xrevrange(self, name, count=None):
+        return self.entries[::-1][:count]
+
+    def xread(self, streams, count=None):
+        last = list(streams.values())[0]
+        if isinstance(last, bytes):
+            last = last.decode()
+        last = int(last.split('-')[0])
+        entries = self.entries[last:last + count]
+        return [[b'stream', entries]] if entries else []
+
+
+class FollowGraphConfig(TestConfig):
+    FOLLOW_GRAPH_REFRESH_SECONDS = 0
+
+
+class FollowGraphCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        FollowGraphConfig.FOLLOW_GRAPH_PATH = os.path.join(
+            self.tmpdir.name, 'follows.bin')
+        self.app = create_app(FollowGraphConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.app.redis = FakeRedisStream()
+        self.graph = self.app.extensions['follow_graph']
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        self.tmpdir.cleanup()
+
+    def test_index(self):
+        u1 = User(id=1, username='john', email='john@example.com')
+        u2 = User(id=2, username='susan', email='susan@example.com')
+        u3 = User(id=3, username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        u2.follow(u1)
+        db.session.commit()
+        # without an index file the answers come from the database
+        self.assertIsNone(self.graph.is_following(1, 2))
+        self.assertTrue(u1.is_following(u2))
+        self.assertEqual(self.graph.build_from_database(), 2)
+
+        for user in (u1, u2, u3):
+            db.session.refresh(user)
+        with count_statements() as counter:
+            self.assertTrue(u1.is_mutual_follow(u2))
+            self.assertFalse(u1.is_following(u3))
+            self.assertEqual(u1.following_status([2, 3]),
+                             {2: True, 3: False})
+            self.assertEqual(u2.followers_count(), 1)
+        self.assertEqual(counter.count, 0)
+
+        # changes are seen by other processes through the stream
+        u3.follow(u2)
+        u1.unfollow(u2)
+        self.assertFalse(u1.is_following(u2))
+        db.session.commit()
+        other = FollowGraph(self.app)
+        for graph in (self.graph, other):
+            self.assertTrue(graph.is_following(3, 2))
+            self.assertFalse(graph.is_mutual(1, 2))
+            self.assertEqual(graph.followers_count(2), 1)
+            self.assertEqual(graph.followed_count(1), 0)
+
+    def test_stale_index_writes(self):
+        u1 = User(id=1, username='john', email='john@example.com')
+        u2 = User(id=2, username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        u1.follow(u2)
+        db.session.commit()
+        # a worker whose index has not seen the follow yet
+        with mock.patch.object(self.graph, 'is_following',
+                               return_value=False):
+            u1.follow(u2)
+            db.session.commit()
+        self.assertEqual(db.session.query(followers).count(), 1)
+        with mock.patch.object(self.graph, 'is_following',
+                               return_value=False):
+            u1.unfollow(u2)
+            db.session.commit()
+        self.assertEqual(db.session.query(followers).count(), 0)
+
+    def test_large_ids(self):
+        # imported users keep their Twitter IDs
+        a, b, c = 12, 1250000000000000000, 1250000000000000007
+        self.assertEqual(build(self.graph.path, [(a, b), (b, c), (c, b)]), 3)
+        self.assertLess(os.path.getsize(self.graph.path), 1024)
+        self.assertTrue(self.graph.is_following(a, b))
+        self.assertFalse(self.graph.is_following(b, a))
+        self.assertFalse(self.graph.is_following(b + 1, c))
+        self.assertTrue(self.graph.is_mutual(b, c))
+        self.assertEqual(self.graph.followers_count(b), 2)
+        self.assertEqual(self.graph.followed_count(a), 1)
+        self.assertEqual(self.graph.followers_count(c + 1), 0)
+        self.assertEqual(self.graph.following_status(a, [b, c]),
+                         {b: True, c: False})
+
+
+class ViewModelCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_post_views(self):
+        u = User(id=1, username='john', email='john@example.com')
+        p = Post(id=1, body='hello', author=u, timestamp=datetime.utcnow(),
+                 language='es')
+        db.session.add_all([u, p])
+        db.session.commit()
+        with self.app.test_request_context():
+            g.locale = 'en'
+            expected = (render_template('_post.html', post=p), p.to_dict())
+            db.session.remove()
+            views = post_views(post_rows(Post.query).all())
+            self.assertEqual(len(db.session.identity_map), 0)
+            self.assertEqual((render_template('_post.html', post=views[0]),
+                              views[0].to_dict()), expected)
+        with self.assertRaises(AttributeError):
+            views[0].body = 'changed'
+
+
+class FakeRedisSortedSet(object):
+    def __init__(self):
+        self.members = {}
+
+    def pipeline(self, transaction=True):
+        self.results = []
+        return self
+
+    def execute(self):
+        return self.results
+
+    def _ranked(self):
+        return sorted(self.members, key=lambda m: (self.members[m], m))
+
+    def zadd(self, name, mapping):
+        self.members.update(mapping)
+
+    def zrem(self, name, *members):
+        for member in members:
+            self.members.pop(member, None)
+
+    def zremrangebyrank(self, name, start, end):
+        for member in self._ranked()[start:max(len(self.members) + end + 1,
+                                               0)]:
+            del self.members[member]
+
+    def zscore(self, name, member):
+        self.results.append(self.members.get(member))
+
+    def zrevrangebyscore(self, name, max, min, start, num):
+        ranked = [m for m in reversed(self._ranked())
+                  if self.members[m] > float('-inf')]
+        self.results.append([m.encode() for m in ranked[start:start + num]])
+
+    def expire(self, name, ttl):
+        pass
+
+    def delete(self, name):
+        self.members.clear()
+
+
+class RecentPostsConfig(TestConfig):
+    EXPLORE_CACHE_PAGES = 2
+    POSTS_PER_PAGE = 3
+
+
+class RecentPostsCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(RecentPostsConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.app.redis = FakeRedisSortedSet()
+        self.recent_posts = self.app.extensions['recent_posts']
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_posts(self, first, last):
+        now = datetime.utcnow()
+        db.session.add_all([
+            Post(id=i, body='post {}'.format(i), user_id=1,
+                 timestamp=now + timedelta(seconds=i))
+            for i in range(first, last + 1)])
+        db.session.commit()
+
+    def test_window(self):
+        db.session.add(User(id=1, username='john', email='john@example.com'))
+        self.add_posts(1, 8)
+        # built from the database on first use
+        self.assertEqual(self.recent_posts.get(0, 4), [8, 7, 6, 5])
+        self.add_posts(9, 10)
+        self.assertEqual(self.recent_posts.get(0, 7), [10, 9, 8, 7, 6, 5])
+        # only the window is cached
+        self.assertIsNone(self.recent_posts.get(6, 3))
+        db.session.delete(Post.query.get(9))
+        db.session.commit()
+        self.assertEqual(self.recent_posts.get(0, 4), [10, 8, 7, 6])
+        self.recent_posts.invalidate()
+        self.assertEqual(self.recent_posts.get(0, 4), [10, 8, 7, 6])
+
+    def test_same_timestamp(self):
+        db.session.add(User(id=1, username='john', email='john@example.com'))
+        now = datetime.utcnow()
+        db.session.add_all([Post(id=i, body='post {}'.format(i), user_id=1,
+                                 timestamp=now) for i in range(8, 12)])
+        db.session.commit()
+        expected = [p.id for p in newest_first(Post.query, Post)]
+        self.assertEqual(expected, [11, 10, 9, 8])
+        self.assertEqual(self.recent_posts.get(0, 2) +
+                         self.recent_posts.get(2, 2), expected)
+
+    def test_recent(self):
+        db.session.add(User(id=1, username='john', email='john@example.com'))
+        self.add_posts(1, 8)
+        self.assertEqual(self.recent_posts.get(0, 1), [8])
+        with count_statements() as counter:
+            posts, more = recent_post_views(1, 3)
+        # the posts and their author
+        self.assertEqual(counter.count, 2)
+        self.assertEqual([p.id for p in posts], [8, 7, 6])
+        self.assertTrue(more)
+        db.session.delete(Post.query.get(6))
+        db.session.commit()
+        # the window has 5 posts left, the last page continues with SQL
+        posts, more = recent_post_views(2, 3)
+        self.assertEqual([p.id for p in posts], [4, 3, 2])
+        self.assertTrue(more)
+        posts, more = recent_post_views(3, 3)
+        self.assertEqual([p.id for p in posts], [1])
+        self.assertFalse(more)
+
+
+def _installed(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+@unittest.skipUnless(_installed('aiosqlite'), 'aiosqlite is not installed')
+class AsyncAPICase(unittest.TestCase):
+    def setUp(self):
+        from app.asgi import AsyncAPI
+        fd, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        config = type('AsyncConfig', (TestConfig,), {
+            'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + self.path,
+            'ASYNC_DATABASE_URL': 'sqlite+aiosqlite:///' + self.path})
+        self.app = create_app(config)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u1 = User(id=1, username='john', email='john@example.com')
+        u2 = User(id=2, username='susan', email='susan@example.com')
+        u3 = User(id=3, username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        now = datetime.utcnow()
+        db.session.add_all([
+            Post(id=i, body='post {}'.format(i), user_id=1 + i % 3,
+                 timestamp=now + timedelta(seconds=i)) for i in range(1, 8)])
+        u1.follow(u2)
+        u3.follow(u1)
+        self.headers = {'Authorization': 'Bearer ' + u1.get_token()}
+        db.session.commit()
+        self.client = self.app.test_client()
+        self.api = AsyncAPI(self.app)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.api.engine.dispose())
+        self.loop.close()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+        os.remove(self.path)
+
+    def get(self, url, headers=None):
+        path, _, query = url.partition('?')
+        headers = dict(self.headers if headers is None else headers,
+                       Host='localhost')
+        scope = {'type': 'http', 'http_version': '1.1', 'method': 'GET',
+                 'scheme': 'http', 'path': path, 'root_path': '',
+                 'query_string': query.encode('ascii'),
+                 'server': ('localhost', 80),
+                 'headers': [(name.lower().encode('latin-1'),
+                              value.encode('latin-1'))
+                             for name, value in headers.items()]}
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+
+        async def send(message):
+            messages.append(message)
+
+        self.loop.run_until_complete(self.api(scope, receive, send))
+        return messages[0]['status'], json.loads(b''.join(
+            message.get('body', b'') for message in messages[1:]))
+
+    def test_same_representations(self):
+        for url in ['/api/users/2', '/api/users?per_page=2&page=2',
+                    '/api/users/1/followers', '/api/users/1/followed',
+                    '/api/timeline?per_page=2', '/api/timeline/since?limit=2',
+                    '/api/users/99', '/api/timeline?cursor=bogus']:
+            r = self.client.get(url, headers=self.headers)
+            self.assertEqual(self.get(url), (r.status_code, r.get_json()),
+                             url)
+
+    def test_authentication(self):
+        status, data = self.get('/api/users', {})
+        self.assertEqual(status, 401)
+        status, data = self.get('/api/users',
+                                {'Authorization': 'Bearer bogus'})
+        self.assertEqual(status, 401)
+
+    def test_other_requests(self):
+        # endpoints not served by the asynchronous views go to Flask
+        status, data = self.get('/api/posts?per_page=2')
+        self.assertEqual(status, 200)
+        self.assertEqual([item['id'] for item in data['items']], [7, 6])
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)